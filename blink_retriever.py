@@ -1,6 +1,7 @@
 from typing import List, Dict, Any
 from logging import Logger
 from functools import lru_cache
+from contextlib import contextmanager
 import _jsonnet
 import json
 import copy
@@ -23,6 +24,7 @@ from blink.crossencoder.train_cross import modify, evaluate
 from blink.crossencoder.data_process import prepare_crossencoder_data
 from blink.indexer.faiss_indexer import DenseFlatIndexer, DenseHNSWFlatIndexer
 
+import main_dense
 from main_dense import (
     modify,
     prepare_crossencoder_data,
@@ -34,8 +36,36 @@ from main_dense import (
     _load_candidates,
 )
 
+from faiss_utils import read_index
+
 BLINK_MODELS_PATH = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))["BLINK_MODELS_PATH"]
 
+
+class MmapDenseFlatIndexer(DenseFlatIndexer):
+    def deserialize_from(self, index_file: str):
+        self.index = read_index(index_file, mmap=True)
+
+
+class MmapDenseHNSWFlatIndexer(DenseHNSWFlatIndexer):
+    def deserialize_from(self, index_file: str):
+        self.index = read_index(index_file, mmap=True)
+
+
+@contextmanager
+def mmap_blink_indexers():
+    """
+    main_dense._load_candidates makes and deserializes the faiss indexer itself, so its
+    indexer classes are swapped by ones that memory-map the index while it runs.
+    """
+    indexer_classes = (main_dense.DenseFlatIndexer, main_dense.DenseHNSWFlatIndexer)
+    main_dense.DenseFlatIndexer = MmapDenseFlatIndexer
+    main_dense.DenseHNSWFlatIndexer = MmapDenseHNSWFlatIndexer
+    try:
+        yield
+    finally:
+        main_dense.DenseFlatIndexer, main_dense.DenseHNSWFlatIndexer = indexer_classes
+
+
 @lru_cache(maxsize=None)
 def load_blink_and_ner_models(
         biencoder_config: str,
@@ -47,6 +77,7 @@ def load_blink_and_ner_models(
         faiss_index: str,
         index_path: str,
         fast: bool,
+        mmap_index: bool = False,
     ):
     print("Loading BLINK models...")
     blink_models = load_blink_models(
@@ -59,6 +90,7 @@ def load_blink_and_ner_models(
         faiss_index=faiss_index,
         index_path=index_path,
         fast=fast,
+        mmap_index=mmap_index,
         logger=None
     )
     print("done.")
@@ -79,6 +111,7 @@ def load_blink_models(
         faiss_index: str,
         index_path: str,
         fast: bool = False,
+        mmap_index: bool = False,
         logger: Logger = None
     ):
 
@@ -111,11 +144,12 @@ def load_blink_models(
         id2text,
         wikipedia_id2local_id,
         faiss_indexer,
-    ) = _load_candidates(
-        entity_catalogue, 
-        entity_encoding, 
-        faiss_index=faiss_index, 
+    ) = _load_candidates_maybe_mmap(
+        entity_catalogue,
+        entity_encoding,
+        faiss_index=faiss_index,
         index_path=index_path,
+        mmap_index=mmap_index,
         logger=logger,
     )
 
@@ -133,8 +167,19 @@ def load_blink_models(
     }
 
 
-def _run_blink_prediction(
-    query_text: str,
+def _load_candidates_maybe_mmap(*args, mmap_index: bool = False, **kwargs):
+    if not mmap_index:
+        return _load_candidates(*args, **kwargs)
+    with mmap_blink_indexers():
+        return _load_candidates(*args, **kwargs)
+
+
+def _run_blink_prediction(query_text: str, **kwargs) -> List[Dict]:
+    return _run_blink_predictions([query_text], **kwargs)[0]
+
+
+def _run_blink_predictions(
+    query_texts: List[str],
     top_k: int,
     fast: bool,
     ner_model: NER,
@@ -149,17 +194,23 @@ def _run_blink_prediction(
     wikipedia_id2local_id: Any,
     faiss_indexer=None,
     logger=None,
-) -> List[Dict]:
+) -> List[List[Dict]]:
+    """
+    Runs the NER + biencoder (+ crossencoder) on all the query_texts together, and returns
+    the predictions of each query_text, i.e., one prediction per mention found in it.
+    """
 
-    predictions = []
+    predictions = [[] for _ in query_texts]
 
     id2url = {
         v: "https://en.wikipedia.org/wiki?curid=%s" % k
         for k, v in wikipedia_id2local_id.items()
     }
 
-    # Identify mentions
-    samples = _annotate(ner_model, [query_text])
+    # Identify mentions. sent_idx of each sample (mention) is the index of its query_text.
+    samples = _annotate(ner_model, query_texts)
+    if not samples:
+        return predictions
 
     # don't look at labels
     keep_all = True
@@ -180,13 +231,13 @@ def _run_blink_prediction(
         e_title = id2title[e_id]
         e_text = id2text[e_id]
         e_url = id2url[e_id]
-        predictions.append({"id": e_id, "title": e_title, "text": e_text, "url": e_url})
+        predictions[sample["sent_idx"]].append({"id": e_id, "title": e_title, "text": e_text, "url": e_url})
 
     if fast:
         # use only biencoder
         return predictions
     else:
-        predictions = []
+        predictions = [[] for _ in query_texts]
 
 
     # prepare crossencoder data
@@ -215,7 +266,7 @@ def _run_blink_prediction(
         e_title = id2title[e_id]
         e_text = id2text[e_id]
         e_url = id2url[e_id]
-        predictions.append({"id": e_id, "title": e_title, "text": e_text, "url": e_url})
+        predictions[sample["sent_idx"]].append({"id": e_id, "title": e_title, "text": e_text, "url": e_url})
 
     return predictions
 
@@ -228,6 +279,7 @@ class BlinkRetriever:
             faiss_index: str = "flat", # "flat" or "hnsw",
             fast: bool = False,
             top_k: int = 1,
+            mmap_index: bool = False, # memory-map the faiss index instead of reading it in.
         ):
 
         assert faiss_index in ("flat", "hnsw")
@@ -253,6 +305,7 @@ class BlinkRetriever:
             faiss_index=faiss_index,
             index_path=index_path,
             fast=fast,
+            mmap_index=mmap_index,
         )
         self._top_k = top_k
         self._fast = fast
@@ -267,6 +320,18 @@ class BlinkRetriever:
         }
         return _run_blink_prediction(**arguments)
 
+    def retrieve_paragraphs_batch(self, query_texts: List[str]) -> List[List[Dict]]:
+        if not query_texts:
+            return []
+        arguments = {
+            "query_texts": query_texts,
+            "top_k": self._top_k,
+            "fast": self._fast,
+            "ner_model": self._ner_model,
+            **self._blink_models
+        }
+        return _run_blink_predictions(**arguments)
+
 def main():
     print("Call one ....")
     print(run_blink_prediction(query_text="BERT and ERNIE are Muppets."))
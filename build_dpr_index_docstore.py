@@ -0,0 +1,94 @@
+"""
+Build the memory-mapped docstore (see paragraph_store.py) with data from DPR corpus.
+DprRetriever reads the texts of its hits from it, if available, instead of the sparse
+(Lucene) counterpart index, which then isn't needed for serving.
+
+The docstore also has the title index (title -> docstore positions) that DprRetriever
+memory-maps for allowed_titles retrievals. --title-index-only adds it to an existing docstore.
+"""
+
+from typing import Dict, Iterable
+import argparse
+import shutil
+import os
+import json
+import _jsonnet
+from tqdm import tqdm
+
+from paragraph_store import ParagraphStore, TitleRowIndex, build_paragraph_store, normalize_title
+
+
+WIKIPEDIA_CORPUSES_PATH = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))["WIKIPEDIA_CORPUSES_PATH"]
+
+
+def read_dpr_corpus_paragraphs(filepath: str) -> Iterable[Dict]:
+    with open(filepath, "r") as file:
+        for line in tqdm(file):
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            # see build_dpr_index_preprocess_corpus.py: contents is \n delimited.
+            title, paragraph_text, paragraph_index = document["contents"].split("\n")
+            yield {
+                "id": document["id"],
+                "title": title,
+                "paragraph_text": paragraph_text,
+                "paragraph_index": int(paragraph_index.strip()),
+            }
+
+
+def build_title_index(docstore_path: str) -> int:
+    # the TitleRowIndex of the docstore positions (DprRetriever maps them to its faiss rows).
+    paragraph_store = ParagraphStore(docstore_path)
+    title_index = TitleRowIndex.build(
+        normalize_title(paragraph_store.get_title(position)) for position in tqdm(range(len(paragraph_store)))
+    )
+    paragraph_store.close()
+    title_index.save(docstore_path)
+    return len(title_index)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Generate the docstore of the dpr corpus.")
+    parser.add_argument(
+        "dataset_name", help='name of the dataset', type=str,
+        choices=(
+            "hotpotqa", "strategyqa", "iirc", "2wikimultihopqa", "musique"
+        )
+    )
+    parser.add_argument("--force", help='force delete before creating new docstore.',
+                        action="store_true", default=False)
+    parser.add_argument("--title-index-only", help='only (re)build the title index of the existing docstore.',
+                        action="store_true", default=False)
+    args = parser.parse_args()
+
+    corpus_filepath = os.path.join(
+        WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-corpus", "paragraphs.jsonl"
+    )
+    docstore_path = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-docstore")
+
+    if args.title_index_only:
+        if not ParagraphStore.exists(docstore_path):
+            exit(f"The docstore_path {docstore_path} doesn't have a docstore.")
+        num_titles = build_title_index(docstore_path)
+        print(f"Indexed {num_titles} titles in {docstore_path}")
+        return
+
+    if not os.path.exists(corpus_filepath):
+        exit(f"The corpus_filepath (input) {corpus_filepath} not available.")
+
+    if args.force:
+        shutil.rmtree(docstore_path, ignore_errors=True)
+
+    if os.path.exists(docstore_path) and os.listdir(docstore_path):
+        exit(f"The non-empty docstore_path (output) {docstore_path} already exists.")
+
+    num_paragraphs = build_paragraph_store(read_dpr_corpus_paragraphs(corpus_filepath), docstore_path)
+    print(f"Stored {num_paragraphs} paragraphs in {docstore_path}")
+    num_titles = build_title_index(docstore_path)
+    print(f"Indexed {num_titles} titles in {docstore_path}")
+
+
+if __name__ == "__main__":
+    main()
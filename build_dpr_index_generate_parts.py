@@ -1,5 +1,17 @@
+"""
+Encode (a shard of) the DPR corpus into a flat index (index and docid files), either:
+
+    pyserini (default): with pyserini.encode, in one go.
+    native (--native): in chunks of chunk_size rows, each saved as soon as it's encoded, with
+        the progress in progress.json. Rerunning resumes from the last completed chunk, so an
+        interrupted encoding only costs the remaining chunks. The chunks are checked against the
+        shard rows of the corpus before they are combined into the flat index.
+"""
+
+from typing import Dict, Iterable, Tuple
 import subprocess
 import argparse
+import itertools
 import shutil
 import os
 import json
@@ -8,6 +20,163 @@ import _jsonnet
 
 WIKIPEDIA_CORPUSES_PATH = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))["WIKIPEDIA_CORPUSES_PATH"]
 
+DPR_CONTEXT_ENCODER = "facebook/dpr-ctx_encoder-multiset-base"
+DPR_CONTEXT_MAX_LENGTH = 300
+
+NATIVE_PROGRESS_FILE_NAME = "progress.json"
+NATIVE_CHUNKS_DIRECTORY_NAME = "chunks"
+
+
+def make_encode_command(
+        corpus_path: str,
+        output_path: str,
+        shard_index: int = 0,
+        num_shards: int = 1,
+        batch_size: int = 32,
+        device: str = "cuda:0",
+    ) -> str:
+    fp16 = "--fp16" if device.startswith("cuda") else "" # fp16 is only for gpus.
+    command = f'''
+python -m pyserini.encode
+    input   --corpus {corpus_path}
+            --fields title text index
+            --delimiter \\n
+            --shard-id {shard_index}
+            --shard-num {num_shards}
+    output  --embeddings {output_path}
+            --to-faiss
+    encoder --encoder {DPR_CONTEXT_ENCODER}
+            --fields text
+            --max-length {DPR_CONTEXT_MAX_LENGTH}
+            --device {device}
+            --batch {batch_size}
+            {fp16}
+'''.strip()
+    return command
+
+
+def get_shard_range(total_count: int, shard_index: int, num_shards: int) -> Tuple[int, int]:
+    # Same split as pyserini.encode, so that native and pyserini shards are interchangeable.
+    shard_size = total_count // num_shards
+    start = shard_index * shard_size
+    end = total_count if shard_index == num_shards - 1 else start + shard_size
+    return start, end
+
+
+def read_corpus_rows(corpus_filepath: str, start: int, end: int) -> Iterable[Dict]:
+    # The DPR corpus jsonl (see build_dpr_index_preprocess_corpus.py): contents is \n delimited.
+    with open(corpus_filepath, "r") as file:
+        for line in itertools.islice(file, start, end):
+            document = json.loads(line)
+            title, text, _ = document["contents"].split("\n")
+            yield {"id": document["id"], "title": title, "text": text}
+
+
+def _get_chunk_path(output_path: str, chunk_index: int) -> str:
+    return os.path.join(output_path, NATIVE_CHUNKS_DIRECTORY_NAME, f"chunk_{chunk_index:06d}.npy")
+
+
+def _write_progress(output_path: str, progress: Dict) -> None:
+    progress_path = os.path.join(output_path, NATIVE_PROGRESS_FILE_NAME)
+    with open(progress_path + ".tmp", "w") as file:
+        json.dump(progress, file, indent=4)
+    os.replace(progress_path + ".tmp", progress_path)
+
+
+def encode_shard_natively(
+        corpus_filepath: str,
+        output_path: str,
+        shard_index: int = 0,
+        num_shards: int = 1,
+        batch_size: int = 32,
+        device: str = "cuda:0",
+        chunk_size: int = 10000,
+    ) -> int:
+    """
+    Encodes the shard rows of the corpus into output_path (see module docstring), resuming from
+    the chunks of an earlier (interrupted) run with the same settings. Returns the number of rows.
+    """
+    import numpy as np
+    import torch
+    import faiss
+
+    with open(corpus_filepath, "r") as file:
+        total_count = sum(1 for _ in file)
+    start, end = get_shard_range(total_count, shard_index, num_shards)
+    num_chunks = -(-(end - start) // chunk_size)
+    chunk_row_counts = [min(chunk_size, end - start - chunk_index * chunk_size) for chunk_index in range(num_chunks)]
+
+    # chunks of a different corpus, shard or encoder (or precision, fp16 is only for gpus) can't be reused.
+    fp16 = device.startswith("cuda")
+    settings = {
+        "corpus_size": os.path.getsize(corpus_filepath), "corpus_mtime": os.path.getmtime(corpus_filepath),
+        "total_count": total_count,
+        "shard_index": shard_index, "num_shards": num_shards, "start": start, "end": end,
+        "chunk_size": chunk_size, "encoder": DPR_CONTEXT_ENCODER, "max_length": DPR_CONTEXT_MAX_LENGTH,
+        "fp16": fp16,
+    }
+    progress_path = os.path.join(output_path, NATIVE_PROGRESS_FILE_NAME)
+    progress = {"settings": settings, "completed_chunks": 0}
+    if os.path.exists(progress_path):
+        with open(progress_path, "r") as file:
+            previous_progress = json.load(file)
+        if previous_progress["settings"] == settings:
+            progress = previous_progress
+        else:
+            print("The settings of the existing chunks don't match, so starting over.")
+    if progress["completed_chunks"] == 0:
+        shutil.rmtree(os.path.join(output_path, NATIVE_CHUNKS_DIRECTORY_NAME), ignore_errors=True)
+    os.makedirs(os.path.join(output_path, NATIVE_CHUNKS_DIRECTORY_NAME), exist_ok=True)
+
+    # only trust the completed chunks that are there with the right number of rows.
+    for chunk_index in range(progress["completed_chunks"]):
+        chunk_path = _get_chunk_path(output_path, chunk_index)
+        if not os.path.exists(chunk_path) or np.load(chunk_path, mmap_mode="r").shape[0] != chunk_row_counts[chunk_index]:
+            print(f"Chunk {chunk_index} is missing or incomplete, so resuming from it.")
+            progress["completed_chunks"] = chunk_index
+            break
+    _write_progress(output_path, progress)
+
+    first_chunk_index = progress["completed_chunks"]
+    if first_chunk_index < num_chunks:
+        from pyserini.encode import DprDocumentEncoder
+        print(f"Encoding chunks {first_chunk_index}-{num_chunks - 1} of rows {start}-{end - 1} ...")
+        encoder = DprDocumentEncoder(DPR_CONTEXT_ENCODER, device=device)
+        rows = read_corpus_rows(corpus_filepath, start + first_chunk_index * chunk_size, end)
+        for chunk_index in range(first_chunk_index, num_chunks):
+            texts = [row["text"] for row in itertools.islice(rows, chunk_row_counts[chunk_index])]
+            embeddings = []
+            # torch.cuda.amp.autocast rather than torch.autocast, which the pinned torch 1.7.1 doesn't have.
+            with torch.no_grad(), torch.cuda.amp.autocast(enabled=fp16):
+                for batch_start in range(0, len(texts), batch_size):
+                    embeddings.append(encoder.encode(
+                        texts[batch_start:batch_start + batch_size], max_length=DPR_CONTEXT_MAX_LENGTH
+                    ))
+            embeddings = np.concatenate(embeddings).astype(np.float32)
+            assert embeddings.shape[0] == chunk_row_counts[chunk_index]
+            chunk_path = _get_chunk_path(output_path, chunk_index)
+            with open(chunk_path + ".tmp", "wb") as file:
+                np.save(file, embeddings)
+            os.replace(chunk_path + ".tmp", chunk_path)
+            progress["completed_chunks"] = chunk_index + 1
+            _write_progress(output_path, progress)
+            print(f"Encoded chunk {chunk_index + 1}/{num_chunks}.")
+
+    # same index and docid files as pyserini.encode --to-faiss.
+    index = None
+    for chunk_index in range(num_chunks):
+        embeddings = np.load(_get_chunk_path(output_path, chunk_index))
+        if index is None:
+            index = faiss.IndexFlatIP(embeddings.shape[1])
+        index.add(embeddings)
+    assert index is not None and index.ntotal == end - start, \
+        f"The encoded rows ({index.ntotal if index else 0}) don't match the corpus shard rows ({end - start})."
+    with open(os.path.join(output_path, "docid"), "w") as file:
+        for row in read_corpus_rows(corpus_filepath, start, end):
+            file.write(row["id"] + "\n")
+    faiss.write_index(index, os.path.join(output_path, "index"))
+    return index.ntotal
+
 
 def main():
 
@@ -21,6 +190,12 @@ def main():
     parser.add_argument("--shard-index", help="shard index", type=int, default=0)
     parser.add_argument("--num-shards", help="number of total shards", type=int, default=1)
     parser.add_argument("--batch-size", help="batch size", type=int, default=32)
+    parser.add_argument("--device", help="device to encode on, e.g., cuda:0 or cpu", type=str, default="cuda:0")
+    parser.add_argument("--native", help="encode natively in resumable chunks instead of with pyserini",
+                        action="store_true", default=False)
+    parser.add_argument("--chunk-size", help="rows per chunk (native)", type=int, default=10000)
+    parser.add_argument("--output-path", help="output directory (default: the flat index directory)",
+                        type=str, default=None)
     parser.add_argument("--force", help='force delete before creating new index.',
                         action="store_true", default=False)
     args = parser.parse_args()
@@ -28,7 +203,9 @@ def main():
     assert 0 <= args.shard_index < args.num_shards
 
     corpus_path = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-corpus")
-    flat_index_path = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-flat-index")
+    flat_index_path = args.output_path or os.path.join(
+        WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-flat-index"
+    )
 
     if not os.path.exists(corpus_path):
         exit(f"The corpus_path (input) {corpus_path} not available.")
@@ -36,25 +213,24 @@ def main():
     if args.force:
         shutil.rmtree(flat_index_path, ignore_errors=True)
 
+    if args.native:
+        # an existing output is resumed, unless --force.
+        os.makedirs(flat_index_path, exist_ok=True)
+        num_rows = encode_shard_natively(
+            os.path.join(corpus_path, "paragraphs.jsonl"), flat_index_path,
+            shard_index=args.shard_index, num_shards=args.num_shards, batch_size=args.batch_size,
+            device=args.device, chunk_size=args.chunk_size,
+        )
+        print(f"Encoded {num_rows} rows into {flat_index_path}")
+        return
+
     if os.path.exists(flat_index_path) and os.listdir(flat_index_path):
         exit(f"The non-empty flat_index_path (output) {flat_index_path} already exists.")
 
-    command = f'''
-python -m pyserini.encode
-    input   --corpus {corpus_path}
-            --fields title text index
-            --delimiter \\n
-            --shard-id {args.shard_index}
-            --shard-num {args.num_shards}
-    output  --embeddings {flat_index_path}
-            --to-faiss
-    encoder --encoder facebook/dpr-ctx_encoder-multiset-base
-            --fields text
-            --max-length 300
-            --device cuda:0
-            --batch {args.batch_size}
-            --fp16
-'''.strip()
+    command = make_encode_command(
+        corpus_path, flat_index_path, shard_index=args.shard_index, num_shards=args.num_shards,
+        batch_size=args.batch_size, device=args.device,
+    )
     print("Running command:")
     print(command)
 
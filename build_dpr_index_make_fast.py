@@ -1,3 +1,16 @@
+"""
+Make faster (and/or smaller) versions of DPR flat indices:
+
+    hnsw: HNSW graph over the full vectors (built by pyserini), tuned with efSearch.
+    ivf_flat: inverted lists (nlist clusters) of the full vectors, tuned with nprobe.
+    ivf_pq: inverted lists of product quantized vectors (pq_m x pq_nbits bits each), tuned with nprobe.
+    sq8: 8-bit scalar quantized vectors (4x smaller than flat), exhaustive search.
+
+The ivf_* and sq8 quantizers are trained on a random sample of train_sample_size vectors.
+With --save-embeddings, the full vectors are also saved (as float16 or float32 embeddings.npy)
+next to them, which DprRetriever memory-maps to score small allowed_titles subsets exactly.
+"""
+
 import subprocess
 import argparse
 import shutil
@@ -5,10 +18,72 @@ import os
 import json
 import _jsonnet
 
+import numpy as np
+
 
 WIKIPEDIA_CORPUSES_PATH = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))["WIKIPEDIA_CORPUSES_PATH"]
 
 
+def build_quantized_index(
+        flat_index_path: str,
+        output_index_path: str,
+        index_type: str,
+        nlist: int,
+        pq_m: int,
+        pq_nbits: int,
+        train_sample_size: int,
+        add_batch_size: int = 100000,
+        seed: int = 13370,
+        embeddings_dtype: str = None,
+    ) -> None:
+    import faiss
+    from faiss_utils import DPR_INDEX_FACTORY_STRINGS, EMBEDDINGS_FILE_NAME
+
+    flat_index = faiss.read_index(os.path.join(flat_index_path, "index"))
+    num_vectors, dimension = flat_index.ntotal, flat_index.d
+
+    factory_string = DPR_INDEX_FACTORY_STRINGS[index_type].format(nlist=nlist, pq_m=pq_m, pq_nbits=pq_nbits)
+    print(f"Building {factory_string} index of {num_vectors} vectors ...")
+    # DPR scores are inner products, same as the flat index.
+    index = faiss.index_factory(dimension, factory_string, faiss.METRIC_INNER_PRODUCT)
+
+    train_sample_size = min(train_sample_size, num_vectors)
+    if index_type.startswith("ivf"):
+        assert train_sample_size >= nlist, "train_sample_size must be at least nlist."
+    sample_rows = np.sort(np.random.RandomState(seed).choice(num_vectors, train_sample_size, replace=False))
+    train_vectors = np.stack([flat_index.reconstruct(int(row)) for row in sample_rows]).astype(np.float32)
+    print(f"Training on {train_sample_size} vectors ...")
+    index.train(train_vectors)
+    del train_vectors
+
+    os.makedirs(output_index_path, exist_ok=True)
+    embeddings = None
+    if embeddings_dtype is not None:
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(output_index_path, EMBEDDINGS_FILE_NAME), mode="w+",
+            dtype=embeddings_dtype, shape=(num_vectors, dimension),
+        )
+
+    for start in range(0, num_vectors, add_batch_size):
+        count = min(add_batch_size, num_vectors - start)
+        vectors = flat_index.reconstruct_n(start, count)
+        index.add(vectors)
+        if embeddings is not None:
+            embeddings[start:start + count] = vectors
+        print(f"Added {start + count}/{num_vectors} vectors.")
+
+    if embeddings is not None:
+        embeddings.flush()
+        del embeddings
+    faiss.write_index(index, os.path.join(output_index_path, "index"))
+    # rows are in the same order, so are the docids FaissSearcher maps them to.
+    shutil.copyfile(os.path.join(flat_index_path, "docid"), os.path.join(output_index_path, "docid"))
+
+
+def make_hnsw_command(flat_index_path: str, output_index_path: str) -> str:
+    return f"python -m pyserini.index.faiss --input {flat_index_path} --output {output_index_path} --hnsw"
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="Make faster versions of DPR indices.")
@@ -19,28 +94,45 @@ def main():
         )
     )
     parser.add_argument("--num-shards", help="number of total shards", type=int, required=True)
+    parser.add_argument("--index-type", help="type of index to make", type=str, default="hnsw",
+                        choices=("hnsw", "ivf_flat", "ivf_pq", "sq8"))
+    parser.add_argument("--nlist", help="number of ivf clusters (ivf_flat, ivf_pq)", type=int, default=4096)
+    parser.add_argument("--pq-m", help="number of pq sub-vectors (ivf_pq)", type=int, default=64)
+    parser.add_argument("--pq-nbits", help="bits per pq sub-vector code (ivf_pq)", type=int, default=8)
+    parser.add_argument("--train-sample-size", help="number of vectors to train the quantizers on (ivf_*, sq8)",
+                        type=int, default=262144)
+    parser.add_argument("--save-embeddings", help="also save the vectors in this dtype (ivf_*, sq8)",
+                        type=str, default=None, choices=("float16", "float32"))
     parser.add_argument("--force", help='force delete output directory, if it exits.',
                         action="store_true", default=False)
     args = parser.parse_args()
 
     flat_index_path = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-flat-index", "part_full")
-    hnsw_index_path = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-hnsw-index")
+    output_index_path = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-{args.index_type}-index")
 
     if not os.path.exists(flat_index_path):
         exit(f"The flat_index_path (input) {flat_index_path} not available.")
 
     if args.force:
-        shutil.rmtree(hnsw_index_path, ignore_errors=True)
+        shutil.rmtree(output_index_path, ignore_errors=True)
 
-    if os.path.exists(hnsw_index_path) and os.listdir(hnsw_index_path):
-        exit(f"The non-empty hnsw_index_path (output) {hnsw_index_path} already exists.")
+    if os.path.exists(output_index_path) and os.listdir(output_index_path):
+        exit(f"The non-empty {args.index_type}_index_path (output) {output_index_path} already exists.")
+
+    if args.index_type != "hnsw":
+        build_quantized_index(
+            flat_index_path, output_index_path, args.index_type,
+            nlist=args.nlist, pq_m=args.pq_m, pq_nbits=args.pq_nbits,
+            train_sample_size=args.train_sample_size, embeddings_dtype=args.save_embeddings,
+        )
+        return
 
-    command = f"python -m pyserini.index.faiss --input {flat_index_path} --output {hnsw_index_path} --hnsw"
+    command = make_hnsw_command(flat_index_path, output_index_path)
     print("Running command:")
     print(command)
 
     command = [e for e in command.split()]
-    subprocess.run(command) 
+    subprocess.run(command)
 
 
 if __name__ == "__main__":
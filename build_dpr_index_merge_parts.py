@@ -1,3 +1,4 @@
+from typing import List
 import subprocess
 import argparse
 import shutil
@@ -9,6 +10,33 @@ import _jsonnet
 WIKIPEDIA_CORPUSES_PATH = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))["WIKIPEDIA_CORPUSES_PATH"]
 
 
+def merge_flat_index_parts(part_paths: List[str], output_path: str, add_batch_size: int = 100000) -> int:
+    """
+    Merges the flat (pyserini --to-faiss) indices of part_paths, in order, into output_path.
+    Parts are read one at a time and added in chunks, so the peak memory is the merged index
+    plus one part (instead of all parts at once). Returns the number of merged vectors.
+    """
+    import faiss
+
+    merged_index = None
+    os.makedirs(output_path, exist_ok=True)
+    with open(os.path.join(output_path, "docid"), "w") as docid_file:
+        for part_path in part_paths:
+            part_index = faiss.read_index(os.path.join(part_path, "index"))
+            if merged_index is None:
+                merged_index = faiss.IndexFlatIP(part_index.d)
+            assert part_index.d == merged_index.d, f"Mismatching dimension of {part_path}."
+            for start in range(0, part_index.ntotal, add_batch_size):
+                count = min(add_batch_size, part_index.ntotal - start)
+                merged_index.add(part_index.reconstruct_n(start, count))
+            del part_index
+            with open(os.path.join(part_path, "docid"), "r") as part_docid_file:
+                shutil.copyfileobj(part_docid_file, docid_file)
+            print(f"Merged {part_path} ({merged_index.ntotal} vectors so far).")
+    faiss.write_index(merged_index, os.path.join(output_path, "index"))
+    return merged_index.ntotal
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="Combine DPR sub-indices.")
@@ -19,6 +47,8 @@ def main():
         )
     )
     parser.add_argument("--num-shards", help="number of total shards", type=int, required=True)
+    parser.add_argument("--streaming", help="merge one part at a time (less memory) instead of with pyserini",
+                        action="store_true", default=False)
     args = parser.parse_args()
 
     flat_index_path = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-flat-index", "part_")
@@ -26,6 +56,11 @@ def main():
         if not os.path.exists(flat_index_path + f"{index}"):
             exit(f"The flat_index_path (input/output) {flat_index_path + f'{index}'} not available.")
 
+    if args.streaming:
+        part_paths = [flat_index_path + f"{index}" for index in range(args.num_shards)]
+        merge_flat_index_parts(part_paths, flat_index_path + "full")
+        return
+
     command = f"python -m pyserini.index.merge_faiss_indexes --prefix {flat_index_path} --shard-num {args.num_shards}"
     print("Running command:")
     print(command)
@@ -0,0 +1,303 @@
+"""
+Build a DPR index end-to-end on the local machine, in one command:
+
+    preprocess: the dpr corpus (paragraphs.jsonl) of the dataset (build_dpr_index_preprocess_corpus.py).
+    encode: num_shards shards of the corpus, encoded concurrently in a local pool of pyserini
+        processes (threads_per_shard threads each), by default on cpu (build_dpr_index_generate_parts.py).
+    merge: the shards into the flat index, one shard at a time (build_dpr_index_merge_parts.py).
+    make_fast: the --index-type index from the flat one, if given (build_dpr_index_make_fast.py).
+    docstore: the paragraph store DprRetriever reads the hit texts from, and its title index
+        for allowed_titles (build_dpr_index_docstore.py).
+
+The docstore replaces the sparse counterpart (Lucene) index, so that stage isn't part of it.
+
+Each stage records the fingerprint (content hashes of its inputs and its settings) it was run
+with in the {dataset}-wikpedia-dpr-pipeline-manifest.json, and is skipped when rerun with the same
+fingerprint and its outputs still exist. So, e.g., a failed or interrupted build resumes from
+the shards that aren't encoded yet (and, with --native-encoding, from the last completed chunk
+of the others), and changing only --index-type rebuilds only make_fast.
+"""
+
+from typing import List, Dict, Callable
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import argparse
+import threading
+import hashlib
+import inspect
+import shutil
+import os
+import json
+import _jsonnet
+
+import build_dpr_index_preprocess_corpus
+import paragraph_store
+from build_dpr_index_generate_parts import make_encode_command, DPR_CONTEXT_ENCODER
+from build_dpr_index_merge_parts import merge_flat_index_parts
+from build_dpr_index_make_fast import build_quantized_index, make_hnsw_command
+import build_dpr_index_docstore
+from build_dpr_index_docstore import read_dpr_corpus_paragraphs, build_title_index
+from startup_cache import hash_file
+
+
+WIKIPEDIA_CORPUSES_PATH = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))["WIKIPEDIA_CORPUSES_PATH"]
+
+
+def hash_strings(*strings) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    for string in strings:
+        hasher.update(str(string).encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def hash_source(module) -> str:
+    # the code of a stage is part of its fingerprint, so changing it reruns the stage.
+    return hash_strings(inspect.getsource(module))
+
+
+class PipelineManifest:
+    """
+    JSON file of stage name -> {"fingerprint": ..., "outputs": {...}} of the completed stages.
+    It's rewritten (atomically) after every stage, so it's always consistent with the outputs.
+    """
+
+    def __init__(self, filepath: str):
+        self._filepath = filepath
+        self._lock = threading.Lock() # encode stages finish concurrently.
+        self._stages = {}
+        if os.path.exists(filepath):
+            with open(filepath, "r") as file:
+                self._stages = json.load(file)
+
+    def is_done(self, stage: str, fingerprint: str, output_paths: List[str]) -> bool:
+        return (
+            self._stages.get(stage, {}).get("fingerprint") == fingerprint
+            and all(os.path.exists(output_path) for output_path in output_paths)
+        )
+
+    def get_outputs(self, stage: str) -> Dict:
+        return self._stages[stage]["outputs"]
+
+    def mark_done(self, stage: str, fingerprint: str, outputs: Dict = None) -> None:
+        with self._lock:
+            self._stages[stage] = {"fingerprint": fingerprint, "outputs": outputs or {}}
+            temporary_filepath = self._filepath + ".tmp"
+            with open(temporary_filepath, "w") as file:
+                json.dump(self._stages, file, indent=4)
+            os.replace(temporary_filepath, self._filepath)
+
+
+def run_stage(
+        manifest: PipelineManifest,
+        stage: str,
+        fingerprint: str,
+        output_paths: List[str],
+        run_function: Callable[[], Dict],
+        resumable: bool = False,
+    ) -> Dict:
+    """
+    Runs run_function (which returns the outputs to record, e.g., their content hashes),
+    unless the stage is already done with the same fingerprint. Returns the stage outputs.
+    The (partial or stale) outputs are cleared first, unless the stage is resumable, i.e., its
+    run_function resumes from them and itself discards what doesn't match its settings.
+    """
+    if manifest.is_done(stage, fingerprint, output_paths):
+        print(f"Skipping {stage} (inputs unchanged).")
+        return manifest.get_outputs(stage)
+    print(f"Running {stage} ...")
+    if resumable:
+        output_paths = []
+    for output_path in output_paths:
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path)
+        elif os.path.exists(output_path):
+            os.remove(output_path)
+    outputs = run_function()
+    manifest.mark_done(stage, fingerprint, outputs)
+    return outputs
+
+
+def make_native_encode_command(
+        dataset_name: str,
+        part_path: str,
+        shard_index: int,
+        num_shards: int,
+        batch_size: int,
+        device: str,
+        chunk_size: int,
+    ) -> str:
+    return (
+        f"python build_dpr_index_generate_parts.py {dataset_name} --native --output-path {part_path} "
+        f"--shard-index {shard_index} --num-shards {num_shards} --batch-size {batch_size} "
+        f"--device {device} --chunk-size {chunk_size}"
+    )
+
+
+def encode_shard(
+        dataset_name: str,
+        corpus_path: str,
+        part_path: str,
+        shard_index: int,
+        num_shards: int,
+        batch_size: int,
+        device: str,
+        threads_per_shard: int,
+        native: bool = False,
+        chunk_size: int = 10000,
+    ) -> Dict:
+    if native:
+        command = make_native_encode_command(
+            dataset_name, part_path, shard_index, num_shards, batch_size, device, chunk_size
+        )
+    else:
+        command = make_encode_command(
+            corpus_path, part_path, shard_index=shard_index, num_shards=num_shards,
+            batch_size=batch_size, device=device,
+        )
+    print("Running command:")
+    print(command)
+    # each shard process only gets its share of the cores, so the shards don't oversubscribe them.
+    thread_count = str(threads_per_shard)
+    environment = {
+        **os.environ, "OMP_NUM_THREADS": thread_count, "MKL_NUM_THREADS": thread_count,
+        "TOKENIZERS_PARALLELISM": "false",
+    }
+    subprocess.run(command.split(), env=environment, check=True)
+    return {
+        "index_hash": hash_file(os.path.join(part_path, "index")),
+        "docid_hash": hash_file(os.path.join(part_path, "docid")),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Build DPR index (all stages) locally.")
+    parser.add_argument(
+        "dataset_name", help='name of the dataset', type=str,
+        choices=(
+            "hotpotqa", "strategyqa", "iirc", "2wikimultihopqa", "musique"
+        )
+    )
+    parser.add_argument("--num-shards", help="number of shards to encode", type=int, default=None)
+    parser.add_argument("--threads-per-shard", help="cpu threads per shard process", type=int, default=4)
+    parser.add_argument("--num-workers", help="number of shards encoded at once (default: cores / threads-per-shard)",
+                        type=int, default=None)
+    parser.add_argument("--batch-size", help="batch size", type=int, default=32)
+    parser.add_argument("--device", help="device to encode on, e.g., cpu or cuda:0", type=str, default="cpu")
+    parser.add_argument("--native-encoding", help="encode shards in resumable chunks instead of with pyserini",
+                        action="store_true", default=False)
+    parser.add_argument("--chunk-size", help="rows per chunk (native encoding)", type=int, default=10000)
+    parser.add_argument("--index-type", help="type of fast index to make, if any", type=str, default=None,
+                        choices=("hnsw", "ivf_flat", "ivf_pq", "sq8"))
+    parser.add_argument("--nlist", help="number of ivf clusters (ivf_flat, ivf_pq)", type=int, default=4096)
+    parser.add_argument("--pq-m", help="number of pq sub-vectors (ivf_pq)", type=int, default=64)
+    parser.add_argument("--pq-nbits", help="bits per pq sub-vector code (ivf_pq)", type=int, default=8)
+    parser.add_argument("--train-sample-size", help="number of vectors to train the quantizers on (ivf_*, sq8)",
+                        type=int, default=262144)
+    parser.add_argument("--force", help='rerun all stages, even if their inputs are unchanged.',
+                        action="store_true", default=False)
+    args = parser.parse_args()
+
+    cpu_count = os.cpu_count() or 1
+    num_workers = args.num_workers or max(1, cpu_count // args.threads_per_shard)
+    num_shards = args.num_shards or num_workers
+    assert num_shards > 0 and num_workers > 0
+
+    prefix = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr")
+    corpus_path = prefix + "-corpus"
+    corpus_filepath = os.path.join(corpus_path, "paragraphs.jsonl")
+    flat_index_path = prefix + "-flat-index"
+    full_index_path = os.path.join(flat_index_path, "part_full")
+    docstore_path = prefix + "-docstore"
+
+    manifest_filepath = prefix + "-pipeline-manifest.json"
+    if args.force and os.path.exists(manifest_filepath):
+        os.remove(manifest_filepath)
+    manifest = PipelineManifest(manifest_filepath)
+
+    def preprocess() -> Dict:
+        build_dpr_index_preprocess_corpus.preprocess_corpus(args.dataset_name, corpus_filepath)
+        return {"paragraphs_hash": hash_file(corpus_filepath)}
+
+    # preprocess: its input is the raw dataset, which the preprocess code points to.
+    preprocess_outputs = run_stage(
+        manifest, "preprocess",
+        hash_strings(args.dataset_name, hash_source(build_dpr_index_preprocess_corpus)),
+        [corpus_filepath], preprocess,
+    )
+    paragraphs_hash = preprocess_outputs["paragraphs_hash"]
+
+    # encode: pyserini only reads the corpus directory, so it must hold just paragraphs.jsonl.
+    def encode(shard_index: int) -> Dict:
+        part_path = os.path.join(flat_index_path, f"part_{shard_index}")
+        return run_stage(
+            manifest, f"encode_part_{shard_index}",
+            hash_strings(
+                paragraphs_hash, DPR_CONTEXT_ENCODER, shard_index, num_shards, args.device, args.native_encoding
+            ),
+            [part_path],
+            lambda: encode_shard(
+                args.dataset_name, corpus_path, part_path, shard_index, num_shards,
+                args.batch_size, args.device, args.threads_per_shard,
+                native=args.native_encoding, chunk_size=args.chunk_size,
+            ),
+            resumable=args.native_encoding,
+        )
+
+    # the pool only waits on the (cpu bound) subprocesses, so threads are enough for it.
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        encode_outputs = list(executor.map(encode, range(num_shards)))
+
+    def merge() -> Dict:
+        part_paths = [os.path.join(flat_index_path, f"part_{index}") for index in range(num_shards)]
+        merge_flat_index_parts(part_paths, full_index_path)
+        return {"index_hash": hash_file(os.path.join(full_index_path, "index"))}
+
+    merge_outputs = run_stage(
+        manifest, "merge",
+        hash_strings(*[outputs["index_hash"] + outputs["docid_hash"] for outputs in encode_outputs]),
+        [full_index_path], merge,
+    )
+
+    if args.index_type is not None:
+        output_index_path = prefix + f"-{args.index_type}-index"
+
+        def make_fast() -> Dict:
+            if args.index_type == "hnsw":
+                subprocess.run(make_hnsw_command(full_index_path, output_index_path).split(), check=True)
+            else:
+                build_quantized_index(
+                    full_index_path, output_index_path, args.index_type,
+                    nlist=args.nlist, pq_m=args.pq_m, pq_nbits=args.pq_nbits,
+                    train_sample_size=args.train_sample_size,
+                )
+            return {}
+
+        run_stage(
+            manifest, f"make_fast_{args.index_type}",
+            hash_strings(
+                merge_outputs["index_hash"], args.index_type, args.nlist,
+                args.pq_m, args.pq_nbits, args.train_sample_size,
+            ),
+            [output_index_path], make_fast,
+        )
+
+    def make_docstore() -> Dict:
+        num_paragraphs = paragraph_store.build_paragraph_store(
+            read_dpr_corpus_paragraphs(corpus_filepath), docstore_path
+        )
+        build_title_index(docstore_path)
+        return {"num_paragraphs": num_paragraphs}
+
+    run_stage(
+        manifest, "docstore",
+        hash_strings(paragraphs_hash, hash_source(paragraph_store), hash_source(build_dpr_index_docstore)),
+        [docstore_path], make_docstore,
+    )
+
+    print(f"Built the DPR index of {args.dataset_name} ({num_shards} shards).")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ import bz2
 import base58
 import _jsonnet
 from bs4 import BeautifulSoup
+import shutil
 import os
 
 
@@ -209,6 +210,28 @@ def write_jsonl(instances: List[Dict], filepath: str) -> None:
     print(f"Written {count} lines.")
 
 
+def get_make_documents(dataset_name: str):
+    if dataset_name == "hotpotqa":
+        make_documents = make_hotpotqa_documents
+    elif dataset_name == "strategyqa":
+        make_documents = make_strategyqa_documents
+    elif dataset_name == "iirc":
+        make_documents = make_iirc_documents
+    elif dataset_name == "2wikimultihopqa":
+        make_documents = make_2wikimultihopqa_documents
+    elif dataset_name == "musique":
+        make_documents = make_musique_documents
+    else:
+        raise Exception(f"Unknown dataset_name {dataset_name}")
+    return make_documents
+
+
+def preprocess_corpus(dataset_name: str, output_filepath: str) -> None:
+    os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
+    documents = get_make_documents(dataset_name)()
+    write_jsonl(documents, output_filepath)
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="Generate input for DPR index generation.")
@@ -222,19 +245,6 @@ def main():
                         action="store_true", default=False)
     args = parser.parse_args()
 
-    if args.dataset_name == "hotpotqa":
-        make_documents = make_hotpotqa_documents
-    elif args.dataset_name == "strategyqa":
-        make_documents = make_strategyqa_documents
-    elif args.dataset_name == "iirc":
-        make_documents = make_iirc_documents
-    elif args.dataset_name == "2wikimultihopqa":
-        make_documents = make_2wikimultihopqa_documents
-    elif args.dataset_name == "musique":
-        make_documents = make_musique_documents
-    else:
-        raise Exception(f"Unknown dataset_name {args.dataset_name}")
-
     output_directory = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{args.dataset_name}-wikpedia-dpr-corpus")
 
     if os.path.exists(output_directory):
@@ -247,9 +257,7 @@ def main():
     os.makedirs(output_directory, exist_ok=True)
 
     output_filepath = os.path.join(output_directory, "paragraphs.jsonl")
-
-    documents = make_documents()
-    write_jsonl(documents, output_filepath)
+    preprocess_corpus(args.dataset_name, output_filepath)
 
 
 if __name__ == "__main__":
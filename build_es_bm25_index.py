@@ -2,7 +2,8 @@
 Build ES (Elasticsearch) BM25 Index.
 """
 
-from typing import Dict, Set
+from typing import Dict, Set, Iterable
+from collections import defaultdict
 import argparse, json
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
@@ -618,6 +619,39 @@ def make_natq_chunked_docs_documents(elasticsearch_index: str, metadata: Dict =
                     yield document
 
 
+def use_paragraph_id_as_document_id(documents: Iterable[Dict]) -> Iterable[Dict]:
+    """
+    Sets the ES document _id to the paragraph id, so that paragraphs can be fetched by id
+    with (real-time) GET/mget instead of a search. Ids can repeat (e.g., the content hash ids
+    of IIRC paragraphs repeated within a page), and all the repeated paragraphs are still
+    indexed ("create", as before): the first one of an id gets it as _id, the others a unique
+    "{id}#{n}". So a GET of the id finds the first one, as the (size 1) search by id did.
+    """
+    id_counts = defaultdict(int)
+    for document in documents:
+        id_ = document["_source"]["id"]
+        document["_id"] = f"{id_}#{id_counts[id_]}" if id_counts[id_] else id_
+        id_counts[id_] += 1
+        yield document
+    repeated_ids_count = sum(count > 1 for count in id_counts.values())
+    if repeated_ids_count:
+        print(f"NOTE: {repeated_ids_count} paragraph ids are repeated, their repetitions have unique _ids.")
+
+
+def add_paragraph_text_hash(documents: Iterable[Dict]) -> Iterable[Dict]:
+    """
+    Adds a compact hash of the normalized (stripped, lowercased) paragraph_text, so that the
+    retriever can have ES collapse duplicate paragraphs instead of dedup-ing them in python.
+    """
+    for document in documents:
+        paragraph_text = document["_source"].get("paragraph_text")
+        if paragraph_text is not None:
+            document["_source"]["paragraph_text_hash"] = hashlib.blake2b(
+                paragraph_text.strip().lower().encode("utf-8"), digest_size=16
+            ).hexdigest()
+        yield document
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Index paragraphs in Elasticsearch")
@@ -661,25 +695,45 @@ if __name__ == "__main__":
     # INDEX settings:
     # Index name: {args.dataset_name}-wikipedia (database-name)
     # Type Name: paragraphs (table-name)
+    # Document _id: paragraph id
     # Properties (Field Names [type = datatype]) :
-    # field1: title
+    # field0: id [keyword]
+    # field1: title (+ title.keyword)
     # field2: paragraph_index
-    # field3: paragraph_text
+    # field3: paragraph_text (+ paragraph_text_hash)
     # field4: url
     # field4: is_abstract
 
+    # title.keyword holds the whole title lowercased and trimmed, so that allowed_titles can be
+    # applied as a (cached, unscored) terms filter instead of title match clauses.
+    title_keyword_field = {
+        "keyword": {"type": "keyword", "normalizer": "lowercase_normalizer"}
+    }
+
     paragraphs_index_settings = {
+        "settings": {
+            "analysis": {
+                "normalizer": {
+                    "lowercase_normalizer": {"type": "custom", "filter": ["lowercase", "trim"]}
+                }
+            }
+        },
         "mappings": {
+            # tells the retriever that the ES _id is the paragraph id (see use_paragraph_id_as_document_id)
+            "_meta": {"id_is_document_id": True},
             "properties": {
+                "id": {"type": "keyword"},
                 "title": {
                     "type": "text",
                     "analyzer": "english",
+                    "fields": title_keyword_field,
                 },
                 "paragraph_index": {"type": "integer"},
                 "paragraph_text": {
                     "type": "text",
                     "analyzer": "english",
                 },
+                "paragraph_text_hash": {"type": "keyword"},
                 "url": {
                     "type": "text",
                     "analyzer": "english",
@@ -693,6 +747,13 @@ if __name__ == "__main__":
         paragraphs_index_settings["mappings"]["properties"] = {
             "metadata": {"type": "object", "index": False}
         }
+        paragraphs_index_settings["mappings"]["properties"]["id"] = {"type": "keyword"}
+        paragraphs_index_settings["mappings"]["properties"]["paragraph_text_hash"] = {"type": "keyword"}
+        # title was dynamically mapped (standard analyzer) for these, so only the subfield is new.
+        paragraphs_index_settings["mappings"]["properties"]["title"] = {
+            "type": "text",
+            "fields": title_keyword_field,
+        }
         paragraphs_index_settings["mappings"]["properties"]["section_path"] = {
             "type": "text",
             "analyzer": "english",
@@ -757,7 +818,7 @@ if __name__ == "__main__":
     print("Inserting Paragraphs ...")
     result = bulk(
         es,
-        make_documents(elasticsearch_index),
+        add_paragraph_text_hash(use_paragraph_id_as_document_id(make_documents(elasticsearch_index))),
         raise_on_error=True, # set to true o/w it'll fail silently and only show less docs.
         raise_on_exception=True, # set to true o/w it'll fail silently and only show less docs.
         max_retries=2, # it's exp backoff starting 2, more than 2 retries will be too much.
@@ -1,6 +1,5 @@
-from typing import List, Dict
+from typing import List, Dict, Iterable
 from dataclasses import dataclass
-from collections import defaultdict
 import numpy as np
 import argparse
 import glob
@@ -8,9 +7,15 @@ import os
 import sys
 import json
 import time
+import threading
+import pickle
+import csv
+import re
 
 from tqdm import tqdm
 import _jsonnet
+import torch
+import faiss
 
 CONTRIEVER_DATA_PATH = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))["CONTRIEVER_DATA_PATH"]
 
@@ -20,9 +25,67 @@ import src.contriever
 import src.index
 from passage_retrieval import embed_queries, index_encoded_data
 
+import src.normalize_text
+from query_embedding_cache import QueryEmbeddingCache
+from query_encoders import ENCODER_BACKENDS, PARITY_CHECK_QUERIES, load_backend_model, check_parity
+from faiss_utils import (
+    EXACT_SEARCH_MAX_ROWS, read_index, write_index, search, get_flat_vectors, search_allowed_rows
+)
+from paragraph_store import ParagraphStore, TitleRowIndex, build_paragraph_store, normalize_title
+from startup_cache import StartupCache
+from incremental_updates import (
+    DEFAULT_COMPACTION_TOMBSTONE_RATIO, UpdateLog, IndexState, BackgroundCompactor,
+    make_position_to_row, merge_retrievals, sync_state, get_update_log_directory,
+)
 
-def normalize_title(title):
-    return title.strip().lower().replace(" ", "")
+
+MIN_PARAGRAPH_WORDS_COUNT = 5
+
+
+def read_passages(paragraphs_path: str) -> Iterable[Dict]:
+    # Same parsing as contriever's src.data.load_passages, but streamed.
+    with open(paragraphs_path, "r") as file:
+        reader = csv.reader(file, delimiter="\t")
+        for row in reader:
+            if row[0] == "id":
+                continue
+            yield {"id": row[0], "text": row[1], "title": row[2]}
+
+
+def clean_tsv_field(text: str) -> str:
+    # Same as build_contriever_wiki_corpuses.py does to the fields of paragraphs.tsv.
+    return re.sub(r' +', " ", text.replace("\n", " ").replace("\t", " "))
+
+
+def embed_texts(
+        model,
+        tokenizer,
+        texts: List[str],
+        max_length: int,
+        batch_size: int = 64,
+        device: str = "cpu",
+        lowercase: bool = False,
+        normalize_text: bool = False,
+    ) -> np.ndarray:
+    # Same as contriever's embed_queries/embed_passages, but for any device, with inference_mode
+    # (no autograd bookkeeping at all) where torch has it (>= 1.9, no_grad on the pinned 1.7.1)
+    # and with each batch tokenized in one (fast tokenizer) call.
+    if lowercase:
+        texts = [text.lower() for text in texts]
+    if normalize_text:
+        texts = [src.normalize_text.normalize(text) for text in texts]
+    embeddings = []
+    with getattr(torch, "inference_mode", torch.no_grad)():
+        for start in range(0, len(texts), batch_size):
+            encoded_batch = tokenizer(
+                texts[start:start + batch_size],
+                return_tensors="pt",
+                max_length=max_length,
+                padding=True,
+                truncation=True,
+            ).to(device)
+            embeddings.append(model(**encoded_batch).float().cpu().numpy())
+    return np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
 
 
 @dataclass
@@ -42,8 +105,36 @@ class ContrieverConfig:
 
 class ContrieverRetriever:
 
-    def __init__(self, corpus_name: str):
+    def __init__(
+            self,
+            corpus_name: str,
+            encoder_backend: str = "torch", # "torch", "int8" or "onnx" (cpu only), see query_encoders.py
+            device: str = None, # default: cuda for the torch encoder_backend, cpu for the others.
+            num_threads: int = None, # cpu threads of the query encoder (default: torch/onnxruntime's).
+            query_batch_size: int = 64, # queries encoded per forward pass on cpu.
+            exact_search_max_rows: int = EXACT_SEARCH_MAX_ROWS, # allowed_titles rows scored w/o faiss.
+            mmap_index: bool = False, # memory-map the faiss index instead of reading it in.
+            query_embedding_cache_size_mb: float = 64, # 0 to turn off.
+            query_embedding_cache_dtype: str = "float32",
+            compaction_tombstone_ratio: float = DEFAULT_COMPACTION_TOMBSTONE_RATIO, # see incremental_updates.py
+        ):
+        assert encoder_backend in ENCODER_BACKENDS, f"Unknown encoder_backend {encoder_backend}."
+        device = device or ("cuda" if encoder_backend == "torch" else "cpu")
+        assert encoder_backend == "torch" or device == "cpu", \
+            f"The {encoder_backend} encoder_backend is only for cpu."
         self._corpus_name = corpus_name
+        self._encoder_backend = encoder_backend
+        self._device = device
+        self._query_batch_size = query_batch_size
+        self._exact_search_max_rows = exact_search_max_rows
+        self._mmap_index = mmap_index
+        self._passage_model = None
+        # searches read self._state (an IndexState) once and don't wait for any lock, updates
+        # publish a new one. _update_lock serializes the updates of this process (including the
+        # whole background compaction), the update log's lock() those of all processes.
+        self._update_lock = threading.Lock()
+        if device == "cpu" and num_threads is not None:
+            torch.set_num_threads(num_threads) # NOTE: it's for the whole process.
 
         contriever_data_path = os.path.join(CONTRIEVER_DATA_PATH, corpus_name)
         config = ContrieverConfig(
@@ -52,8 +143,20 @@ class ContrieverRetriever:
         )
         model, tokenizer, _ = src.contriever.load_retriever(config.model_name_or_path)
         model.eval()
-        model = model.cuda()
         self.config = config
+        self.tokenizer = tokenizer
+        if encoder_backend == "torch":
+            model = model.to(device)
+        else:
+            print(f"Loading {encoder_backend} contriever query encoder...")
+            self.model = model
+            reference_embeddings = self._embed_queries(PARITY_CHECK_QUERIES)
+            model = load_backend_model(
+                model, tokenizer, encoder_backend, config.model_name_or_path, num_threads=num_threads
+            )
+            self.model = model
+            cosine_similarity = check_parity(reference_embeddings, self._embed_queries(PARITY_CHECK_QUERIES))
+            print(f"Min cosine similarity to the fp32 query embeddings: {cosine_similarity:.4f}")
 
         if not os.path.exists(self.config.paragraphs_embeddings.replace("*", "")):
             raise Exception(f"Embeddings path ({self.config.paragraphs_embeddings}) not found.")
@@ -62,20 +165,31 @@ class ContrieverRetriever:
             raise Exception(f"Data path ({self.config.paragraphs_path}) not found.")
 
         self.model = model
-        self.tokenizer = tokenizer
+        self._query_embedding_cache = None
+        if query_embedding_cache_size_mb:
+            self._query_embedding_cache = QueryEmbeddingCache(
+                f"{config.model_name_or_path}:{encoder_backend}",
+                query_embedding_cache_size_mb, query_embedding_cache_dtype
+            )
 
         self.index = src.index.Indexer(
             self.config.projection_size, self.config.n_subquantizers, self.config.n_bits
         )
 
+        # the paragraphs added and deleted since the last compaction (see incremental_updates.py).
+        # Opened first, as it finishes an interrupted compaction (of the files loaded below).
+        self._update_log = UpdateLog(get_update_log_directory("contriever", corpus_name))
+
         # index all paragraphs
         print("(Maybe) indexing all paragraphs.")
         input_paths = glob.glob(self.config.paragraphs_embeddings)
         input_paths = sorted(input_paths)
         embeddings_dir = os.path.dirname(input_paths[0])
         index_path = os.path.join(embeddings_dir, "index.faiss")
+        self._embeddings_dir = embeddings_dir
+        self._index_path = index_path
         if os.path.exists(index_path):
-            self.index.deserialize_from(embeddings_dir)
+            self._deserialize_index(embeddings_dir, mmap_index)
         else:
             print(f"Indexing paragraphs from files {input_paths}")
             start_time_indexing = time.time()
@@ -83,21 +197,114 @@ class ContrieverRetriever:
             print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
             self.index.serialize(embeddings_dir)
 
-        # load paragraphs
-        print("Loading contriever paragraphs...")
-        paragraphs = src.data.load_passages(self.config.paragraphs_path)
-        self.paragraph_id_map = {x["id"]: x for x in tqdm(paragraphs)}
-        self.paragraph_title_to_index_ids = defaultdict(list)
-        db_id_to_index_id = {db_id: index_id for index_id, db_id in tqdm(enumerate(self.index.index_id_to_db_id))}
-        for paragraph in tqdm(paragraphs):
-            title = normalize_title(paragraph["title"])
-            index_id = db_id_to_index_id[paragraph["id"]]
-            self.paragraph_title_to_index_ids[title].append(index_id)
-        del db_id_to_index_id
-        del paragraphs
+        # The paragraph store and the maps derived from it and the index are built once and
+        # then memory-mapped, until paragraphs.tsv or the index change (not in embeddings_dir,
+        # all files of which are taken as embeddings).
+        startup_cache = StartupCache(
+            os.path.join(contriever_data_path, "startup_cache"),
+            {
+                "paragraphs": self.config.paragraphs_path,
+                "index": index_path,
+                "index_meta": os.path.join(embeddings_dir, "index_meta.faiss"),
+            },
+        )
+        if not startup_cache.is_valid():
+            startup_cache.rebuild(self._build_startup_cache)
+        self._startup_cache = startup_cache
+        with self._update_log.lock():
+            self._state = sync_state(self._load_state(), self._update_log, self._reload_state)
+        self._compactor = BackgroundCompactor(self.compact, compaction_tombstone_ratio)
         print("...Done.")
 
 
+    def _load_state(self) -> IndexState:
+        # the state of the index, startup cache and (a view of the flat) index vectors, without updates.
+        print("Loading contriever paragraph store...")
+        paragraph_store = ParagraphStore(os.path.join(self._startup_cache.directory, "paragraph_store"))
+        row_to_position = None
+        if not self._startup_cache.get("row_to_position_is_identity"):
+            row_to_position = np.load(
+                os.path.join(self._startup_cache.directory, "row_to_position.npy"), mmap_mode="r"
+            )
+        return IndexState(
+            index=self.index.index,
+            vectors=get_flat_vectors(self.index.index),
+            paragraph_store=paragraph_store,
+            row_to_position=row_to_position,
+            position_to_row=make_position_to_row(row_to_position, self.index.index.ntotal, len(paragraph_store)),
+            title_index=TitleRowIndex.load(self._startup_cache.directory, mmap=True),
+            log_generation=self._update_log.generation,
+        )
+
+
+    def _reload_state(self) -> IndexState:
+        # _load_state of the index files of a new generation of the update log (see sync_state).
+        self._deserialize_index(self._embeddings_dir, self._mmap_index)
+        self._startup_cache.rebuild(self._build_startup_cache)
+        return self._load_state()
+
+
+    def _get_state(self) -> IndexState:
+        # The state to search, synced first if the update log was changed by another process
+        # (e.g., the CLI). Left to a later search while an update or compaction holds the locks,
+        # so that searches never wait for one.
+        if self._update_log.is_stale() and self._update_lock.acquire(blocking=False):
+            try:
+                with self._update_log.lock(blocking=False) as is_locked:
+                    if is_locked:
+                        self._state = sync_state(self._state, self._update_log, self._reload_state)
+            finally:
+                self._update_lock.release()
+        return self._state
+
+
+    def _build_startup_cache(self, directory: str) -> Dict:
+        # builds the startup cache structures in (an empty) directory, see StartupCache.rebuild.
+        print("Building contriever paragraph store...")
+        paragraph_store_path = os.path.join(directory, "paragraph_store")
+        build_paragraph_store(
+            (
+                {"id": passage["id"], "title": passage["title"],
+                 "paragraph_text": passage["text"], "paragraph_index": -1}
+                for passage in tqdm(read_passages(self.config.paragraphs_path))
+            ),
+            paragraph_store_path,
+        )
+        paragraph_store = ParagraphStore(paragraph_store_path)
+        print("Building contriever row maps...")
+        row_to_position = paragraph_store.positions_of(
+            [str(db_id) for db_id in self._get_index_id_to_db_id()]
+        )
+        row_to_position_is_identity = bool(np.array_equal(row_to_position, np.arange(len(row_to_position))))
+        np.save(os.path.join(directory, "row_to_position.npy"), row_to_position)
+        TitleRowIndex.build(
+            normalize_title(paragraph_store.get_title(position)) for position in tqdm(row_to_position)
+        ).save(directory)
+        paragraph_store.close()
+        return {"row_to_position_is_identity": row_to_position_is_identity}
+
+
+    def _deserialize_index(self, dir_path: str, mmap: bool) -> None:
+        # Same as src.index.Indexer.deserialize_from, but can memory-map the index.
+        index_file = os.path.join(dir_path, "index.faiss")
+        meta_file = os.path.join(dir_path, "index_meta.faiss")
+        print(f"Loading index from {index_file}")
+        self.index.index = read_index(index_file, mmap=mmap)
+        # the meta data (a list of all db ids) is only needed to (re)build the startup cache.
+        self.index.index_id_to_db_id = None
+
+
+    def _get_index_id_to_db_id(self) -> List:
+        if self.index.index_id_to_db_id is None:
+            meta_file = os.path.join(self._embeddings_dir, "index_meta.faiss")
+            print(f"Loading meta data from {meta_file}")
+            with open(meta_file, "rb") as reader:
+                self.index.index_id_to_db_id = pickle.load(reader)
+            assert len(self.index.index_id_to_db_id) == self.index.index.ntotal, \
+                "Deserialized index_id_to_db_id should match faiss index size"
+        return self.index.index_id_to_db_id
+
+
     def retrieve_paragraphs(
         self,
         query_text: str,
@@ -105,50 +312,269 @@ class ContrieverRetriever:
         max_hits_count: int,
         allowed_titles: List[str] = None,
     ) -> List[Dict]:
+        return self.retrieve_paragraphs_batch(
+            [query_text], corpus_name, [max_hits_count], [allowed_titles]
+        )[0]
 
-        query_embeddings = embed_queries(self.config, [query_text], self.model, self.tokenizer)
 
-        if allowed_titles is None:
-            paragraph_ids, scores = self.index.search_knn(query_embeddings, max_hits_count)[0]
+    def retrieve_paragraphs_batch(
+        self,
+        query_texts: List[str],
+        corpus_name: str,
+        max_hits_counts: List[int],
+        allowed_titles_list: List[List[str]] = None,
+    ) -> List[List[Dict]]:
+
+        assert corpus_name == self._corpus_name, \
+            f"Mismatching corpus_names ({corpus_name} != {self._corpus_name})"
+
+        allowed_titles_list = allowed_titles_list or [None] * len(query_texts)
+        assert len(query_texts) == len(max_hits_counts) == len(allowed_titles_list)
+
+        if self._query_embedding_cache is not None:
+            query_embeddings = self._query_embedding_cache.encode(query_texts, self._embed_queries)
         else:
+            query_embeddings = self._embed_queries(query_texts)
+
+        return self._search_and_make_retrievals(
+            self._get_state(), query_embeddings, max_hits_counts, allowed_titles_list
+        )
+
+
+    def _search_and_make_retrievals(
+        self,
+        state: IndexState,
+        query_embeddings: np.ndarray,
+        max_hits_counts: List[int],
+        allowed_titles_list: List[List[str]],
+    ) -> List[List[Dict]]:
+
+        retrievals = [None] * len(query_embeddings)
+        query_embeddings = query_embeddings.astype(np.float32)
+
+        # Queries without allowed_titles go through the index in a single search.
+        unfiltered_indices = [
+            index for index, allowed_titles in enumerate(allowed_titles_list) if allowed_titles is None
+        ]
+        if unfiltered_indices:
+            max_hits_count = max(max_hits_counts[index] for index in unfiltered_indices)
+            scores, rows = search(
+                state.index, query_embeddings[unfiltered_indices], max_hits_count,
+                excluded_rows=state.excluded_rows,
+            )
+            delta_hits = state.delta.search(query_embeddings[unfiltered_indices], max_hits_count)
+            for index, query_rows, query_scores, query_delta_hits in zip(unfiltered_indices, rows, scores, delta_hits):
+                max_hits_count = max_hits_counts[index]
+                retrievals[index] = merge_retrievals([
+                    self._make_retrieval(state, query_rows[:max_hits_count], query_scores[:max_hits_count]),
+                    self._make_delta_retrieval(query_delta_hits),
+                ], max_hits_count)
+
+        for index, allowed_titles in enumerate(allowed_titles_list):
+            if allowed_titles is None:
+                continue
             # NOTE: faiss > 1.7.3 is needed for this.
-            allowed_titles = [normalize_title(title) for title in allowed_titles]
-            allowed_index_ids = [
-                id_ for title in allowed_titles for id_ in self.paragraph_title_to_index_ids[title]
-            ]
-            allowed_index_ids = np.array(allowed_index_ids, dtype=np.int64)
-            paragraph_ids, scores = self.index.search_knn(
-                query_embeddings, max_hits_count, allowed_index_ids=allowed_index_ids
-            )[0]
-            paragraph_ids_scores = [
-                (paragraph_id, score) for paragraph_id, score in zip(paragraph_ids, scores)
-                if normalize_title(self.paragraph_id_map[paragraph_id]["title"]) in allowed_titles
+            allowed_titles = {normalize_title(title) for title in allowed_titles}
+            allowed_index_ids = state.title_index.get_rows_of_titles(allowed_titles)
+            scores, rows = search_allowed_rows(
+                state.index, query_embeddings[index:index+1],
+                max_hits_counts[index], allowed_index_ids,
+                vectors=state.vectors, exact_search_max_rows=self._exact_search_max_rows,
+                excluded_rows=state.excluded_rows,
+            )
+            delta_hits = state.delta.search(query_embeddings[index:index+1], max_hits_counts[index], allowed_titles)
+            retrievals[index] = merge_retrievals([
+                [
+                    result for result in self._make_retrieval(state, rows[0], scores[0])
+                    if normalize_title(result["title"]) in allowed_titles
+                ],
+                self._make_delta_retrieval(delta_hits[0]),
+            ], max_hits_counts[index])
+
+        return retrievals
+
+
+    def add_paragraphs(self, paragraphs: List[Dict]) -> int:
+        """
+        Encodes paragraphs (dicts with id, title and paragraph_text) and adds them to the update
+        log, from which they are searched next to the index until the next compaction (see
+        incremental_updates.py). Returns the number of added paragraphs.
+        """
+        if not paragraphs:
+            return 0
+        with self._update_lock, self._update_log.lock():
+            self._state = sync_state(self._state, self._update_log, self._reload_state)
+            paragraphs = [
+                {"id": str(paragraph["id"]), "title": clean_tsv_field(paragraph["title"]),
+                 "paragraph_text": clean_tsv_field(paragraph["paragraph_text"]), "paragraph_index": -1}
+                for paragraph in paragraphs
             ]
-            paragraph_ids = [paragraph_id for paragraph_id, _ in paragraph_ids_scores]
-            scores = [score for _, score in paragraph_ids_scores]
+            ids = [paragraph["id"] for paragraph in paragraphs]
+            assert len(set(ids)) == len(ids), "The ids of the added paragraphs aren't unique."
+            existing = self._state.is_live(ids)
+            if existing.any():
+                raise Exception(f"Paragraph ids already in the corpus: {np.array(ids)[existing][:5]}")
 
-        paragraphs = [self.paragraph_id_map[paragraph_id] for paragraph_id in paragraph_ids]
+            embeddings = self._embed_passages(
+                [paragraph["title"] + " " + paragraph["paragraph_text"] for paragraph in paragraphs]
+            ).astype(np.float32)
 
-        assert corpus_name == self._corpus_name, \
-            f"Mismatching corpus_names ({corpus_name} != {self._corpus_name})"
+            self._update_log.append_added(paragraphs, embeddings)
+            self._state = sync_state(self._state, self._update_log, self._reload_state)
+            tombstone_ratio = self._state.get_num_pending_rows() / max(self._state.index.ntotal, 1)
+        self._compactor.maybe_start(tombstone_ratio)
+        return len(paragraphs)
+
+
+    def delete_paragraphs(self, ids: List[str]) -> int:
+        """
+        Adds the ids to the update log, so that their paragraphs aren't retrieved anymore, and
+        starts a background compaction if there are too many of them. Unknown (or already deleted)
+        ids are ignored. Returns the number of deleted paragraphs.
+        """
+        with self._update_lock, self._update_log.lock():
+            self._state = sync_state(self._state, self._update_log, self._reload_state)
+            ids = [str(id_) for id_ in ids]
+            _, deleted_count = self._state.with_deleted(ids)
+            if deleted_count:
+                self._update_log.append_deleted(ids)
+                self._state = sync_state(self._state, self._update_log, self._reload_state)
+            tombstone_ratio = self._state.get_num_pending_rows() / max(self._state.index.ntotal, 1)
+        self._compactor.maybe_start(tombstone_ratio)
+        return deleted_count
+
+
+    def compact(self) -> None:
+        """
+        Folds the update log into the index, its meta data and paragraphs.tsv (and so the startup
+        cache). Searches go on (on the current state) while it runs, updates wait for it.
+        """
+        with self._update_lock, self._update_log.lock():
+            self._state = state = sync_state(self._state, self._update_log, self._reload_state)
+            if not state.get_num_pending_rows():
+                return
+            num_rows = state.index.ntotal
+            excluded_rows = state.excluded_rows if state.excluded_rows is not None else np.zeros(0, dtype=np.int64)
+            print(f"Compacting {len(excluded_rows)} deleted and {len(state.delta)} added rows into {num_rows}...")
+            live_rows = np.setdiff1d(np.arange(num_rows), excluded_rows)
+            delta_rows = state.delta.get_live_rows()
+            delta_paragraphs = [state.delta.paragraphs[row] for row in delta_rows]
+            index_id_to_db_id = self._get_index_id_to_db_id()
+            # the deleted ones, and all added ones (the live ones are written after the others).
+            dropped_ids = {str(index_id_to_db_id[row]) for row in excluded_rows}
+            dropped_ids.update(paragraph["id"] for paragraph in state.delta.paragraphs)
+
+            # the live rows, in the same order, and then the live added ones.
+            index = faiss.IndexFlatIP(state.index.d)
+            for start in range(0, len(live_rows), self.config.indexing_batch_size):
+                index.add(np.ascontiguousarray(
+                    state.vectors[live_rows[start:start + self.config.indexing_batch_size]]
+                ))
+            if len(delta_rows):
+                index.add(np.ascontiguousarray(state.delta.embeddings[delta_rows]))
+            live_index_id_to_db_id = [index_id_to_db_id[row] for row in live_rows]
+            live_index_id_to_db_id += [paragraph["id"] for paragraph in delta_paragraphs]
+
+            # Same files as src.index.Indexer.serialize, and paragraphs.tsv (raw lines, so the kept
+            # ones are unchanged), staged and then moved into place (see UpdateLog).
+            update_log = self._update_log
+            os.makedirs(update_log.get_staged_path(), exist_ok=True)
+            staged_index_path = update_log.get_staged_path("index.faiss")
+            staged_meta_path = update_log.get_staged_path("index_meta.faiss")
+            staged_paragraphs_path = update_log.get_staged_path("paragraphs.tsv")
+            write_index(index, staged_index_path)
+            with open(staged_meta_path, "wb") as writer:
+                pickle.dump(live_index_id_to_db_id, writer)
+            with open(self.config.paragraphs_path, "r") as input_file, \
+                    open(staged_paragraphs_path, "w") as output_file:
+                for line in input_file:
+                    if line.split("\t", 1)[0] not in dropped_ids:
+                        output_file.write(line)
+                for paragraph in delta_paragraphs:
+                    output_file.write(f"{paragraph['id']}\t{paragraph['paragraph_text']}\t{paragraph['title']}\n")
+            update_log.begin_compaction([
+                (staged_paragraphs_path, self.config.paragraphs_path),
+                (staged_index_path, self._index_path),
+                (staged_meta_path, os.path.join(self._embeddings_dir, "index_meta.faiss")),
+            ])
+            update_log.finish_compaction()
+
+            # the replaced state isn't closed, as searches may still be on it.
+            self._state = sync_state(state, update_log, self._reload_state)
+            print("...Compacted.")
+
+
+    def wait_for_compaction(self) -> None:
+        self._compactor.wait()
+
+
+    def _embed_passages(self, texts: List[str]) -> np.ndarray:
+        # The index has fp32 passage embeddings, so the int8/onnx query encoders aren't used for them.
+        if self._encoder_backend == "torch":
+            model, device = self.model, self._device
+        else:
+            if self._passage_model is None:
+                self._passage_model, _, _ = src.contriever.load_retriever(self.config.model_name_or_path)
+                self._passage_model.eval()
+            model, device = self._passage_model, "cpu"
+        return embed_texts(
+            model, self.tokenizer, texts, 512, batch_size=self._query_batch_size, device=device,
+            lowercase=self.config.lowercase, normalize_text=self.config.normalize_text,
+        )
+
+
+    def _embed_queries(self, query_texts: List[str]) -> np.ndarray:
+        if self._encoder_backend == "torch" and self._device != "cpu":
+            return embed_queries(self.config, query_texts, self.model, self.tokenizer)
+        return self._embed_queries_on_cpu(query_texts)
+
+
+    def _embed_queries_on_cpu(self, query_texts: List[str]) -> np.ndarray:
+        # contriever's embed_queries moves the inputs to cuda.
+        return embed_texts(
+            self.model, self.tokenizer, query_texts, self.config.question_maxlength,
+            batch_size=self._query_batch_size, device="cpu",
+            lowercase=self.config.lowercase, normalize_text=self.config.normalize_text,
+        )
+
+
+    def _make_retrieval(self, state: IndexState, rows: np.ndarray, scores: np.ndarray) -> List[Dict]:
+
+        rows, scores = np.asarray(rows, dtype=np.int64), np.asarray(scores)
+        found = rows >= 0 # faiss pads with -1 when there are fewer hits than asked for.
+        rows, scores = rows[found], scores[found]
+        positions = rows if state.row_to_position is None else state.row_to_position[rows]
+        # the min-words filter only needs the precomputed word counts, not the texts.
+        has_min_words = state.paragraph_store.get_word_counts(positions) >= MIN_PARAGRAPH_WORDS_COUNT
+        paragraphs = state.paragraph_store.get_many(positions[has_min_words])
 
         retrieval = [
-            {
-                "id": paragraph_id,
-                "title": paragraph["title"].strip(),
-                "paragraph_text": paragraph["text"].strip(),
-                "score": float(score),
-                "is_abstract": False,
-                "url": None,
-                "corpus_name": self._corpus_name,
-            }
-            for paragraph_id, paragraph, score in zip(paragraph_ids, paragraphs, scores)
-            if len(paragraph["text"].strip().split()) >= 5
+            self._format_paragraph(paragraph, score)
+            for paragraph, score in zip(paragraphs, scores[has_min_words])
         ]
 
         return retrieval
 
 
+    def _make_delta_retrieval(self, hits: List) -> List[Dict]:
+        # hits: (score, paragraph) of the added paragraphs (see incremental_updates.Delta.search).
+        return [
+            self._format_paragraph(paragraph, score) for score, paragraph in hits
+            if len(paragraph["paragraph_text"].split()) >= MIN_PARAGRAPH_WORDS_COUNT
+        ]
+
+
+    def _format_paragraph(self, paragraph: Dict, score: float) -> Dict:
+        return {
+            "id": paragraph["id"],
+            "title": paragraph["title"].strip(),
+            "paragraph_text": paragraph["paragraph_text"].strip(),
+            "score": float(score),
+            "is_abstract": False,
+            "url": None,
+            "corpus_name": self._corpus_name,
+        }
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='retrieve paragraphs')
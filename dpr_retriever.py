@@ -1,15 +1,44 @@
 import json
 import _jsonnet
-from typing import List, Dict
+from typing import List, Dict, Iterable
+import threading
+from types import SimpleNamespace
 import argparse
 import os
 
+import numpy as np
+import torch
+import faiss
 from pyserini.search import FaissSearcher, DprQueryEncoder
-from pyserini.search.lucene import LuceneSearcher
+
+from paragraph_store import ParagraphStore, TitleRowIndex, build_paragraph_store, normalize_title
+from query_embedding_cache import QueryEmbeddingCache
+from query_encoders import ENCODER_BACKENDS, PARITY_CHECK_QUERIES, load_backend_model, check_parity
+from faiss_utils import (
+    DPR_INDEX_FACTORY_STRINGS, EXACT_SEARCH_MAX_ROWS, read_index, set_default_search_parameters,
+    search, load_vectors, search_allowed_rows, write_index,
+)
+from incremental_updates import (
+    DEFAULT_COMPACTION_TOMBSTONE_RATIO, UpdateLog, IndexState, BackgroundCompactor,
+    make_position_to_row, merge_retrievals, sync_state, get_update_log_directory,
+)
+from build_dpr_index_generate_parts import DPR_CONTEXT_ENCODER, DPR_CONTEXT_MAX_LENGTH
+from build_dpr_index_docstore import build_title_index
 
 
 WIKIPEDIA_CORPUSES_PATH = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))["WIKIPEDIA_CORPUSES_PATH"]
 
+DPR_INDEX_TYPES = ("flat", "hnsw", *DPR_INDEX_FACTORY_STRINGS)
+
+
+class MmapFaissSearcher(FaissSearcher):
+    # FaissSearcher that memory-maps the index (see faiss_utils.read_index) instead of reading it in.
+
+    def load_index(self, index_dir: str):
+        index = read_index(os.path.join(index_dir, "index"), mmap=True)
+        docids = self.load_docids(os.path.join(index_dir, "docid"))
+        return index, docids
+
 
 class DprRetriever:
     def __init__(
@@ -18,9 +47,20 @@ class DprRetriever:
             index_type: str,
             hf_query_model_name_or_path: str = "facebook/dpr-question_encoder-multiset-base",
             device: str = "cpu",
+            nprobe: int = None, # default for ivf_* index types, can be overridden per request.
+            ef_search: int = None, # default for hnsw index type, can be overridden per request.
+            mmap_index: bool = False, # memory-map the faiss index instead of reading it in.
+            encoder_backend: str = "torch", # "torch", "int8" or "onnx", see query_encoders.py
+            query_embedding_cache_size_mb: float = 64, # 0 to turn off.
+            query_embedding_cache_dtype: str = "float32",
+            exact_search_max_rows: int = EXACT_SEARCH_MAX_ROWS, # allowed_titles rows scored w/o faiss.
+            compaction_tombstone_ratio: float = DEFAULT_COMPACTION_TOMBSTONE_RATIO, # see incremental_updates.py
         ):
-        assert index_type in ("flat", "hsnw")
+        assert index_type in DPR_INDEX_TYPES, f"Unknown DPR index_type {index_type}."
         assert corpus_name != "auto", f"corpus_name auto is not valid for dpr_retriever."
+        assert encoder_backend in ENCODER_BACKENDS, f"Unknown encoder_backend {encoder_backend}."
+        assert encoder_backend == "torch" or device == "cpu", \
+            f"The {encoder_backend} encoder_backend is only for cpu."
 
         print("Loading DprQueryEncoder...")
         query_encoder = DprQueryEncoder(
@@ -28,55 +68,422 @@ class DprRetriever:
             tokenizer_name=hf_query_model_name_or_path,
             device=device
         )
-
-        print("Loading FaissSearcher...")
+        self._query_encoder = query_encoder
+        if encoder_backend != "torch":
+            print(f"Loading {encoder_backend} DprQueryEncoder...")
+            reference_embeddings = self._encode_queries(PARITY_CHECK_QUERIES)
+            query_encoder.model = load_backend_model(
+                query_encoder.model, query_encoder.tokenizer, encoder_backend, hf_query_model_name_or_path,
+                get_output=lambda output: output.pooler_output,
+                make_output=lambda embeddings: SimpleNamespace(pooler_output=embeddings),
+            )
+            cosine_similarity = check_parity(reference_embeddings, self._encode_queries(PARITY_CHECK_QUERIES))
+            print(f"Min cosine similarity to the fp32 query embeddings: {cosine_similarity:.4f}")
 
         if index_type == "flat":
             dpr_index_path = os.path.join(
                 WIKIPEDIA_CORPUSES_PATH,
                 f"{corpus_name}-wikpedia-dpr-{index_type}-index/part_full"
             )
-        else: # hnsw
+        else: # hnsw, ivf_flat, ivf_pq, sq8 (see build_dpr_index_make_fast.py)
             dpr_index_path = os.path.join(
                 WIKIPEDIA_CORPUSES_PATH,
                 f"{corpus_name}-wikpedia-dpr-{index_type}-index"
             )
-        self._dense_searcher = FaissSearcher(dpr_index_path, query_encoder)
+        docstore_path = os.path.join(WIKIPEDIA_CORPUSES_PATH, f"{corpus_name}-wikpedia-dpr-docstore")
+        self._query_embedding_cache = None
+        if query_embedding_cache_size_mb:
+            self._query_embedding_cache = QueryEmbeddingCache(
+                f"{hf_query_model_name_or_path}:{encoder_backend}",
+                query_embedding_cache_size_mb, query_embedding_cache_dtype
+            )
+
+        # Incremental updates (see incremental_updates.py), of the flat index (with the docstore)
+        # only: searches read self._state (an IndexState) once and don't wait for any lock, updates
+        # publish a new one. _update_lock serializes the updates of this process (including the
+        # whole background compaction), the update log's lock() those of all processes.
+        self._index_type = index_type
+        self._device = device
+        self._dpr_index_path = dpr_index_path
+        self._docstore_path = docstore_path
+        self._corpus_filepath = os.path.join(
+            WIKIPEDIA_CORPUSES_PATH, f"{corpus_name}-wikpedia-dpr-corpus", "paragraphs.jsonl"
+        )
+        self._document_encoder = None
+        self._update_lock = threading.Lock()
+        self._update_log = None
+        if index_type == "flat" and ParagraphStore.exists(docstore_path):
+            # opened first, as it finishes an interrupted compaction (of the files loaded below).
+            self._update_log = UpdateLog(get_update_log_directory("dpr", corpus_name))
+        self._compactor = BackgroundCompactor(self.compact, compaction_tombstone_ratio)
+
+        print("Loading FaissSearcher...")
+        searcher_class = MmapFaissSearcher if mmap_index else FaissSearcher
+        self._dense_searcher = searcher_class(dpr_index_path, query_encoder)
+        set_default_search_parameters(self._dense_searcher.index, nprobe=nprobe, ef_search=ef_search)
+        self._exact_search_max_rows = exact_search_max_rows
+
+        # Dense index doesn't store the original text documents, so we need to recover them
+        # from the docstore (see build_dpr_index_docstore.py) or, if it's not built, from
+        # the corresponding sparse index.
+        self._sparse_searcher = None
+        if not ParagraphStore.exists(docstore_path):
+            print("Loading SparseSearcher...")
+            from pyserini.search.lucene import LuceneSearcher
+            sparse_index_path = os.path.join(
+                WIKIPEDIA_CORPUSES_PATH, f"{corpus_name}-wikpedia-dpr-sparse-index"
+            )
+            self._sparse_searcher = LuceneSearcher(sparse_index_path)
+        self._state = self._load_state()
+        if self._update_log is not None:
+            with self._update_log.lock():
+                self._state = sync_state(self._state, self._update_log, self._reload_state)
 
-        print("Loading SparseSearcher...")
-        # Dense index doesn't store the original text documents, so we need to
-        # generate+load the corresponding sparse index too.
-        sparse_index_path = os.path.join(
-            WIKIPEDIA_CORPUSES_PATH, f"{corpus_name}-wikpedia-dpr-sparse-index"
+    def _load_state(self) -> IndexState:
+        # the state of the searcher's index and the docstore, without updates.
+        index = self._dense_searcher.index
+        paragraph_store = row_to_position = position_to_row = title_position_index = None
+        if self._sparse_searcher is None:
+            print("Loading ParagraphStore...")
+            paragraph_store = ParagraphStore(self._docstore_path)
+            # faiss rows are in corpus order, unless the index was built from a different
+            # ordering of paragraphs.jsonl, in which case map them to the store positions once.
+            row_to_position = paragraph_store.positions_of(self._dense_searcher.docids)
+            if np.array_equal(row_to_position, np.arange(len(row_to_position))):
+                row_to_position = None
+            position_to_row = make_position_to_row(row_to_position, index.ntotal, len(paragraph_store))
+            # title -> store positions (not rows), for allowed_titles (built with the docstore).
+            if TitleRowIndex.exists(self._docstore_path):
+                title_position_index = TitleRowIndex.load(self._docstore_path, mmap=True)
+        return IndexState(
+            index=index,
+            # to score few allowed_titles rows directly: the flat index vectors, or the saved ones of the others.
+            vectors=load_vectors(index, self._dpr_index_path),
+            paragraph_store=paragraph_store,
+            row_to_position=row_to_position,
+            position_to_row=position_to_row,
+            title_index=title_position_index,
+            docids=self._dense_searcher.docids,
+            log_generation=0 if self._update_log is None else self._update_log.generation,
         )
-        self._sparse_searcher = LuceneSearcher(sparse_index_path)
+
+    def _reload_state(self) -> IndexState:
+        # _load_state of the index files of a new generation of the update log (see sync_state).
+        self._dense_searcher.index, self._dense_searcher.docids = \
+            self._dense_searcher.load_index(self._dpr_index_path)
+        return self._load_state()
+
+    def _get_state(self) -> IndexState:
+        # The state to search, synced first if the update log was changed by another process
+        # (e.g., the CLI). Left to a later search while an update or compaction holds the locks,
+        # so that searches never wait for one.
+        update_log = self._update_log
+        if update_log is not None and update_log.is_stale() and self._update_lock.acquire(blocking=False):
+            try:
+                with update_log.lock(blocking=False) as is_locked:
+                    if is_locked:
+                        self._state = sync_state(self._state, update_log, self._reload_state)
+            finally:
+                self._update_lock.release()
+        return self._state
 
 
     def retrieve_paragraphs(
         self,
         query_text: str = None,
-        max_hits_count: int = 10
+        max_hits_count: int = 10,
+        nprobe: int = None,
+        ef_search: int = None,
+        allowed_titles: List[str] = None,
     ) -> List[Dict]:
 
-        hits = self._dense_searcher.search(query=query_text, k=max_hits_count)
+        return self.retrieve_paragraphs_batch(
+            [query_text], max_hits_count, nprobe, ef_search, [allowed_titles]
+        )[0]
+
+    def retrieve_paragraphs_batch(
+        self,
+        query_texts: List[str],
+        max_hits_count: int = 10,
+        nprobe: int = None,
+        ef_search: int = None,
+        allowed_titles_list: List[List[str]] = None,
+    ) -> List[List[Dict]]:
+        """
+        Encodes all the queries as one padded batch and searches the faiss index once for all
+        (the ones without allowed_titles). nprobe (ivf_* index types) and ef_search (hnsw) trade
+        recall for latency for this search.
+        """
+        if not query_texts:
+            return []
+        allowed_titles_list = allowed_titles_list or [None] * len(query_texts)
+        assert len(query_texts) == len(allowed_titles_list)
+        if self._query_embedding_cache is not None:
+            query_embeddings = self._query_embedding_cache.encode(query_texts, self._encode_queries)
+        else:
+            query_embeddings = self._encode_queries(query_texts)
+
+        return self._search_and_make_retrieval_results(
+            self._get_state(), query_embeddings, max_hits_count, nprobe, ef_search, allowed_titles_list
+        )
+
+    def _search_and_make_retrieval_results(
+        self,
+        state: IndexState,
+        query_embeddings: np.ndarray,
+        max_hits_count: int,
+        nprobe: int,
+        ef_search: int,
+        allowed_titles_list: List[List[str]],
+    ) -> List[List[Dict]]:
+
+        retrieval_results_list = [None] * len(query_embeddings)
+        unfiltered_indices = [
+            index for index, allowed_titles in enumerate(allowed_titles_list) if allowed_titles is None
+        ]
+        if unfiltered_indices:
+            scores, rows = search(
+                state.index, query_embeddings[unfiltered_indices], max_hits_count,
+                nprobe=nprobe, ef_search=ef_search, excluded_rows=state.excluded_rows,
+            )
+            delta_hits = state.delta.search(query_embeddings[unfiltered_indices], max_hits_count)
+            for index, scores_, rows_, delta_hits_ in zip(unfiltered_indices, scores, rows, delta_hits):
+                retrieval_results_list[index] = merge_retrievals([
+                    self._rows_to_retrieval_results(state, scores_, rows_, max_hits_count),
+                    self._delta_hits_to_retrieval_results(delta_hits_),
+                ], max_hits_count)
+
+        for index, allowed_titles in enumerate(allowed_titles_list):
+            if allowed_titles is None:
+                continue
+            allowed_titles = {normalize_title(title) for title in allowed_titles}
+            allowed_rows = self._get_allowed_rows(state, allowed_titles)
+            scores, rows = search_allowed_rows(
+                state.index, query_embeddings[index:index+1], max_hits_count, allowed_rows,
+                vectors=state.vectors, exact_search_max_rows=self._exact_search_max_rows,
+                nprobe=nprobe, ef_search=ef_search, excluded_rows=state.excluded_rows,
+            )
+            delta_hits = state.delta.search(query_embeddings[index:index+1], max_hits_count, allowed_titles)
+            retrieval_results_list[index] = merge_retrievals([
+                [
+                    retrieval_result
+                    for retrieval_result in self._rows_to_retrieval_results(state, scores[0], rows[0], max_hits_count)
+                    if normalize_title(retrieval_result["title"]) in allowed_titles
+                ],
+                self._delta_hits_to_retrieval_results(delta_hits[0]),
+            ], max_hits_count)
+        return retrieval_results_list
+
+    def add_paragraphs(self, paragraphs: List[Dict]) -> int:
+        """
+        Encodes paragraphs (dicts with id, title, paragraph_text and paragraph_index) and adds
+        them to the update log, from which they are searched next to the index until the next
+        compaction (see incremental_updates.py). Returns the number of added paragraphs.
+        """
+        self._check_updatable()
+        if not paragraphs:
+            return 0
+        with self._update_lock, self._update_log.lock():
+            self._state = sync_state(self._state, self._update_log, self._reload_state)
+            # contents is \n delimited (see build_dpr_index_preprocess_corpus.py).
+            paragraphs = [
+                {"id": str(paragraph["id"]), "title": paragraph["title"].replace("\n", " ").strip(),
+                 "paragraph_text": paragraph["paragraph_text"].replace("\n", " ").strip(),
+                 "paragraph_index": int(paragraph["paragraph_index"])}
+                for paragraph in paragraphs
+            ]
+            ids = [paragraph["id"] for paragraph in paragraphs]
+            assert len(set(ids)) == len(ids), "The ids of the added paragraphs aren't unique."
+            existing = self._state.is_live(ids)
+            if existing.any():
+                raise Exception(f"Paragraph ids already in the corpus: {np.array(ids)[existing][:5]}")
+
+            embeddings = self._encode_documents([paragraph["paragraph_text"] for paragraph in paragraphs])
+
+            self._update_log.append_added(paragraphs, embeddings)
+            self._state = sync_state(self._state, self._update_log, self._reload_state)
+            tombstone_ratio = self._state.get_num_pending_rows() / max(self._state.index.ntotal, 1)
+        self._compactor.maybe_start(tombstone_ratio)
+        return len(paragraphs)
+
+    def delete_paragraphs(self, ids: List[str]) -> int:
+        """
+        Adds the ids to the update log, so that their paragraphs aren't retrieved anymore, and
+        starts a background compaction if there are too many of them. Unknown (or already deleted)
+        ids are ignored. Returns the number of deleted paragraphs.
+        """
+        self._check_updatable()
+        with self._update_lock, self._update_log.lock():
+            self._state = sync_state(self._state, self._update_log, self._reload_state)
+            ids = [str(id_) for id_ in ids]
+            _, deleted_count = self._state.with_deleted(ids)
+            if deleted_count:
+                self._update_log.append_deleted(ids)
+                self._state = sync_state(self._state, self._update_log, self._reload_state)
+            tombstone_ratio = self._state.get_num_pending_rows() / max(self._state.index.ntotal, 1)
+        self._compactor.maybe_start(tombstone_ratio)
+        return deleted_count
+
+    def compact(self) -> None:
+        """
+        Folds the update log into the flat index, its docid file, the docstore and the corpus.
+        Searches go on (on the current state) while it runs, updates wait for it.
+        """
+        self._check_updatable()
+        with self._update_lock, self._update_log.lock():
+            self._state = state = sync_state(self._state, self._update_log, self._reload_state)
+            if not state.get_num_pending_rows():
+                return
+            num_rows = state.index.ntotal
+            excluded_rows = state.excluded_rows if state.excluded_rows is not None else np.zeros(0, dtype=np.int64)
+            print(f"Compacting {len(excluded_rows)} deleted and {len(state.delta)} added rows into {num_rows}...")
+            live_rows = np.setdiff1d(np.arange(num_rows), excluded_rows)
+            delta_rows = state.delta.get_live_rows()
+            delta_paragraphs = [state.delta.paragraphs[row] for row in delta_rows]
+            # the deleted ones, and all added ones (the live ones are written after the others).
+            dropped_ids = {state.docids[row] for row in excluded_rows}
+            dropped_ids.update(paragraph["id"] for paragraph in state.delta.paragraphs)
+
+            # the live rows, in the same order, and then the live added ones.
+            index = faiss.IndexFlatIP(state.index.d)
+            for start in range(0, len(live_rows), 100000):
+                index.add(np.ascontiguousarray(state.vectors[live_rows[start:start + 100000]]))
+            if len(delta_rows):
+                index.add(np.ascontiguousarray(state.delta.embeddings[delta_rows]))
+            live_docids = [state.docids[row] for row in live_rows] + [paragraph["id"] for paragraph in delta_paragraphs]
+
+            # The new index directory, docstore (in row order) and corpus, staged and then moved
+            # into place (see UpdateLog).
+            update_log = self._update_log
+            staged_index_path = update_log.get_staged_path("index")
+            staged_docstore_path = update_log.get_staged_path("docstore")
+            staged_corpus_filepath = update_log.get_staged_path("paragraphs.jsonl")
+            os.makedirs(staged_index_path, exist_ok=True)
+            self._write_index_files(staged_index_path, index, live_docids)
+            live_positions = live_rows if state.row_to_position is None else state.row_to_position[live_rows]
+            build_paragraph_store(
+                [state.paragraph_store.get(position) for position in live_positions] + delta_paragraphs,
+                staged_docstore_path,
+            )
+            build_title_index(staged_docstore_path)
+            # the corpus (raw lines, so the kept ones are unchanged) without the deleted ones.
+            with open(self._corpus_filepath, "r") as input_file, \
+                    open(staged_corpus_filepath, "w") as output_file:
+                for line in input_file:
+                    if line.strip() and json.loads(line)["id"] not in dropped_ids:
+                        output_file.write(line)
+                for paragraph in delta_paragraphs:
+                    document_text = "\n".join(
+                        [paragraph["title"], paragraph["paragraph_text"], str(paragraph["paragraph_index"])]
+                    )
+                    output_file.write(json.dumps({"id": paragraph["id"], "contents": document_text}) + "\n")
+            update_log.begin_compaction([
+                (staged_index_path, self._dpr_index_path),
+                (staged_docstore_path, self._docstore_path),
+                (staged_corpus_filepath, self._corpus_filepath),
+            ])
+            update_log.finish_compaction()
+
+            # the replaced state isn't closed, as searches may still be on it.
+            self._state = sync_state(state, update_log, self._reload_state)
+            print("...Compacted.")
+
+    def wait_for_compaction(self) -> None:
+        self._compactor.wait()
+
+    def _check_updatable(self) -> None:
+        if self._index_type != "flat":
+            raise Exception(
+                f"Only the flat DPR index is updated incrementally, rebuild the {self._index_type} "
+                f"one from it (see build_dpr_index_make_fast.py)."
+            )
+        if self._update_log is None:
+            raise Exception("Updates need the docstore (see build_dpr_index_docstore.py).")
+
+    def _write_index_files(self, index_path: str, index: faiss.Index, docids: List[str]) -> None:
+        # Same index and docid files as pyserini.encode --to-faiss.
+        with open(os.path.join(index_path, "docid"), "w") as file:
+            for docid in docids:
+                file.write(docid + "\n")
+        write_index(index, os.path.join(index_path, "index"))
+
+    def _encode_documents(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        # Same encoder and settings as the index was built with (see build_dpr_index_generate_parts.py).
+        if self._document_encoder is None:
+            from pyserini.encode import DprDocumentEncoder
+            self._document_encoder = DprDocumentEncoder(DPR_CONTEXT_ENCODER, device=self._device)
+        embeddings = []
+        with torch.no_grad():
+            for start in range(0, len(texts), batch_size):
+                embeddings.append(self._document_encoder.encode(
+                    texts[start:start + batch_size], max_length=DPR_CONTEXT_MAX_LENGTH
+                ))
+        return np.concatenate(embeddings).astype(np.float32)
+
+    def _get_allowed_rows(self, state: IndexState, allowed_titles: Iterable[str]) -> np.ndarray:
+        if state.title_index is None:
+            raise Exception(
+                "allowed_titles for DPR needs the docstore with its title index (see build_dpr_index_docstore.py)."
+            )
+        positions = state.title_index.get_rows_of_titles(allowed_titles)
+        if state.position_to_row is None:
+            return positions
+        rows = state.position_to_row[positions]
+        return rows[rows >= 0]
+
+    def _encode_queries(self, query_texts: List[str]) -> np.ndarray:
+        # Same as DprQueryEncoder.encode, but for many queries in one forward pass.
+        tokenizer, model = self._query_encoder.tokenizer, self._query_encoder.model
+        inputs = tokenizer(
+            query_texts, padding=True, truncation=True, max_length=512, return_tensors="pt"
+        ).to(self._query_encoder.device)
+        with torch.no_grad():
+            embeddings = model(
+                input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"]
+            ).pooler_output
+        return embeddings.cpu().numpy().astype(np.float32)
+
+    def _get_paragraph(self, state: IndexState, row: int) -> Dict:
+        if state.paragraph_store is not None:
+            position = row if state.row_to_position is None else state.row_to_position[row]
+            return state.paragraph_store.get(position)
+
+        doc = self._sparse_searcher.doc(state.docids[row])
+        document = json.loads(doc.raw())
+        contents = document["contents"]
+        title, paragraph_text, paragraph_index = contents.split("\n")
+        paragraph_index = int(paragraph_index.strip())
+        return {"title": title, "paragraph_text": paragraph_text, "paragraph_index": paragraph_index}
+
+    def _rows_to_retrieval_results(
+        self,
+        state: IndexState,
+        scores: np.ndarray,
+        rows: np.ndarray,
+        max_hits_count: int,
+    ) -> List[Dict]:
 
         retrieval_results = []
-        for hit in hits:
-            doc = self._sparse_searcher.doc(hit.docid)
-            document = json.loads(doc.raw())
-            contents = document["contents"]
-            title, paragraph_text, paragraph_index = contents.split("\n")
-            paragraph_index = int(paragraph_index.strip())
-            retrieval_result = {
-                "title": title, "paragraph_text": paragraph_text,
-                "paragraph_index": paragraph_index, "score": float(hit.score)
-            }
-            retrieval_results.append(retrieval_result)
+        for score, row in zip(scores, rows):
+            if row < 0: # faiss pads with -1 if it finds fewer than k.
+                continue
+            paragraph = self._get_paragraph(state, row)
+            retrieval_results.append(self._make_retrieval_result(paragraph, score))
 
         retrieval_results = sorted(retrieval_results, key=lambda e: e["score"], reverse=True)
         retrieval_results = retrieval_results[:max_hits_count]
         return retrieval_results
 
+    def _delta_hits_to_retrieval_results(self, hits: List) -> List[Dict]:
+        # hits: (score, paragraph) of the added paragraphs (see incremental_updates.Delta.search).
+        return [self._make_retrieval_result(paragraph, score) for score, paragraph in hits]
+
+    def _make_retrieval_result(self, paragraph: Dict, score: float) -> Dict:
+        return {
+            "title": paragraph["title"], "paragraph_text": paragraph["paragraph_text"],
+            "paragraph_index": paragraph["paragraph_index"], "score": float(score)
+        }
+
 
 if __name__ == "__main__":
 
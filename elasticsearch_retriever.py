@@ -1,10 +1,110 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple, Callable
 import argparse
+import inspect
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from elasticsearch import Elasticsearch
 
 
+# what records are needed in the result of id lookups.
+BY_ID_SOURCE_FIELDS = ["id", "title", "paragraph_text", "url", "is_abstract", "paragraph_index", "data"]
+
+# Only the parts of the ES responses that are read, so that the took/_shards/total stats, _index,
+# _id etc. of every hit aren't sent and deserialized.
+SEARCH_FILTER_PATH = ["hits.hits._source", "hits.hits._score"]
+# responses.status is always there: filter_path drops the (then empty) responses of no hits otherwise,
+# which would misalign the responses with the searches.
+MSEARCH_FILTER_PATH = [
+    "responses.status", "responses.hits.hits._source", "responses.hits.hits._score", "responses.error"
+]
+# error is kept, so that a missing index isn't taken for a missing document (found: false).
+GET_FILTER_PATH = ["found", "_source", "error"]
+MGET_FILTER_PATH = ["docs.found", "docs._source", "docs.error"]
+
+
+def get_source_fields(
+        fields: List[str],
+        default_fields: List[str],
+        required_fields: List[str] = (),
+    ) -> List[str]:
+    """
+    The _source fields to fetch for a request-level fields projection: the requested fields
+    plus the ones needed to post-process the hits. Without a projection, it's the default ones.
+    """
+    if fields is None:
+        return default_fields
+    return list(OrderedDict.fromkeys([*fields, *required_fields]))
+
+
+def project_fields(retrieval: List[Dict], fields: List[str]) -> List[Dict]:
+    # score is always kept as it's not a _source field but set from the hit _score.
+    if fields is None:
+        return retrieval
+    fields = set(fields) | {"score"}
+    return [
+        {key: value for key, value in retrieval_.items() if key in fields}
+        for retrieval_ in retrieval
+    ]
+
+
+# The (elasticsearch, aiohttp) versions whose AIOHttpConnection session make_keep_alive_connection_class mirrors.
+KEEP_ALIVE_ELASTICSEARCH_VERSION = (7, 9)
+KEEP_ALIVE_AIOHTTP_MAJOR_VERSION = 3
+
+
+def make_keep_alive_connection_class(keep_alive_timeout: float):
+    """
+    Returns an AIOHttpConnection (the AsyncElasticsearch default connection class) whose
+    pooled connections are kept alive for keep_alive_timeout seconds after use.
+
+    AIOHttpConnection takes no connector (or keepalive) argument, so this overrides its private
+    session factory. That's only done for the pinned versions it's written against, other ones
+    get the stock AIOHttpConnection (and aiohttp's default keepalive of 15s).
+    """
+    # these need elasticsearch[async], i.e., aiohttp.
+    import asyncio
+    import aiohttp
+    import elasticsearch
+    from elasticsearch import AIOHttpConnection
+
+    aiohttp_major_version = int(aiohttp.__version__.split(".")[0])
+    if (
+        tuple(elasticsearch.VERSION[:2]) != KEEP_ALIVE_ELASTICSEARCH_VERSION
+        or aiohttp_major_version != KEEP_ALIVE_AIOHTTP_MAJOR_VERSION
+    ):
+        print(
+            f"Warning: elasticsearch_keep_alive_timeout is only supported with elasticsearch "
+            f"{'.'.join(map(str, KEEP_ALIVE_ELASTICSEARCH_VERSION))}.* and aiohttp "
+            f"{KEEP_ALIVE_AIOHTTP_MAJOR_VERSION}.* (see requirements.txt). Using the default keepalive."
+        )
+        return AIOHttpConnection
+
+    from elasticsearch._async.http_aiohttp import ESClientResponse
+
+    class KeepAliveAIOHttpConnection(AIOHttpConnection):
+
+        async def _create_aiohttp_session(self):
+            # Same session as AIOHttpConnection makes, but with keepalive_timeout given to the
+            # connector it's built with (aiohttp has no public setter for it afterwards).
+            # self.loop is still set as AIOHttpConnection times requests with it, but the session and
+            # connector pick up the running loop themselves (loop= is deprecated in aiohttp 3).
+            if self.loop is None:
+                self.loop = asyncio.get_running_loop()
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                skip_auto_headers=("accept", "accept-encoding"),
+                auto_decompress=True,
+                cookie_jar=aiohttp.DummyCookieJar(),
+                response_class=ESClientResponse,
+                connector=aiohttp.TCPConnector(
+                    limit=self._limit, use_dns_cache=True, ssl=self._ssl_context,
+                    keepalive_timeout=keep_alive_timeout,
+                ),
+            )
+
+    return KeepAliveAIOHttpConnection
+
+
 class ElasticsearchRetriever:
 
     """
@@ -15,6 +115,13 @@ class ElasticsearchRetriever:
     # bool/must acts as AND
     # bool/should acts as OR
     # bool/filter acts as binary filter w/o score (unlike must and should).
+
+    Each retrieve_* method is split into a _prepare_* method, which builds the index name,
+    the ES query and a function to post-process the raw ES result, so that many retrievals
+    can also be sent together in one _msearch round trip (see multi_retrieve).
+
+    With use_async=True, there are also async_* versions of the retrieve methods backed by an
+    AsyncElasticsearch client, which can be awaited in the server without using up threads.
     """
 
     def __init__(
@@ -22,11 +129,290 @@ class ElasticsearchRetriever:
             corpus_name: str,
             elasticsearch_host: str = "localhost",
             elasticsearch_port: int = 9200,
+            connections_per_node: int = 10,
+            request_timeout: float = 30,
+            keep_alive_timeout: float = 15,
+            use_async: bool = False,
         ):
-        self._es = Elasticsearch([elasticsearch_host], scheme="http", port=elasticsearch_port, timeout=30)
+        self._es = Elasticsearch(
+            [elasticsearch_host], scheme="http", port=elasticsearch_port,
+            timeout=request_timeout, maxsize=connections_per_node
+        )
+        self._async_es = None
+        if use_async:
+            from elasticsearch import AsyncElasticsearch
+            self._async_es = AsyncElasticsearch(
+                [elasticsearch_host], scheme="http", port=elasticsearch_port,
+                timeout=request_timeout, maxsize=connections_per_node,
+                connection_class=make_keep_alive_connection_class(keep_alive_timeout),
+            )
         self._corpus_name = corpus_name
+        self._index_name_to_mappings = {}
+
+    @property
+    def is_async(self) -> bool:
+        return self._async_es is not None
+
+    def _get_index_name(self, corpus_name: str = None) -> str:
+
+        if self._corpus_name == "auto":
+            assert corpus_name != None, \
+            "The corpus_name is initialized as auto. So you need to pass it at runtime."
+        else:
+            assert corpus_name in (None, self._corpus_name), \
+            "The corpus_name is not initialized as auto. So you can't pass it at runtime."
 
-    def retrieve_paragraphs(
+        return f"{corpus_name or self._corpus_name}-wikipedia"
+
+    def _get_index_mappings(self, index_name: str) -> Dict:
+        # The mapping is fetched once per index to see which fields/layout (newer) indices have.
+        if index_name not in self._index_name_to_mappings:
+            mappings = self._es.indices.get_mapping(index=index_name)
+            self._index_name_to_mappings[index_name] = next(iter(mappings.values()))["mappings"]
+        return self._index_name_to_mappings[index_name]
+
+    async def _async_load_index_mappings(self, *index_names: str) -> None:
+        # The async_* methods fetch the mappings with the async client first, so that the
+        # (sync) _prepare_* methods only read the cached ones and don't block the event loop.
+        for index_name in set(index_names):
+            if index_name not in self._index_name_to_mappings:
+                mappings = await self._get_async_es().indices.get_mapping(index=index_name)
+                self._index_name_to_mappings[index_name] = next(iter(mappings.values()))["mappings"]
+
+    def _get_call_index_name(self, method_name: str, args: Tuple = (), kwargs: Dict = None) -> str:
+        # the index name of a retrieve_* call, w/o preparing it.
+        arguments = inspect.signature(getattr(self, "_prepare_" + method_name)).bind(*args, **(kwargs or {})).arguments
+        return self._get_index_name(arguments.get("corpus_name"))
+
+    def _has_title_keyword_field(self, index_name: str) -> bool:
+        # Dynamically mapped titles have a title.keyword too, but it's not lowercased/trimmed.
+        properties = self._get_index_mappings(index_name).get("properties", {})
+        title_keyword = properties.get("title", {}).get("fields", {}).get("keyword", {})
+        return title_keyword.get("normalizer") == "lowercase_normalizer"
+
+    def _has_paragraph_text_hash_field(self, index_name: str) -> bool:
+        # Newer indices have a hash of the normalized paragraph_text to collapse duplicates on.
+        return "paragraph_text_hash" in self._get_index_mappings(index_name).get("properties", {})
+
+    def _has_id_as_document_id(self, index_name: str) -> bool:
+        # Newer indices use the paragraph id as the ES document _id, so ids can be looked up by GET.
+        return bool(self._get_index_mappings(index_name).get("_meta", {}).get("id_is_document_id"))
+
+    def retrieve_paragraphs(self, *args, **kwargs) -> List[Dict]:
+        index_name, query, process_result = self._prepare_retrieve_paragraphs(*args, **kwargs)
+        result = self._es.search(index=index_name, body=query, filter_path=SEARCH_FILTER_PATH)
+        return process_result(result)
+
+    def retrieve_titles(self, *args, **kwargs) -> List[Dict]:
+        index_name, query, process_result = self._prepare_retrieve_titles(*args, **kwargs)
+        result = self._es.search(index=index_name, body=query, filter_path=SEARCH_FILTER_PATH)
+        return process_result(result)
+
+    def retrieve_titles_batch(
+        self,
+        query_texts: List[str],
+        max_buffer_count: int = 100,
+        max_hits_count: int = 10,
+        corpus_name: str = None,
+    ) -> List[List[Dict]]:
+        """
+        retrieve_titles for many query_texts in a single _msearch round trip.
+        """
+        return self.multi_retrieve([
+            ("retrieve_titles", {
+                "query_text": query_text, "max_buffer_count": max_buffer_count,
+                "max_hits_count": max_hits_count, "corpus_name": corpus_name
+            })
+            for query_text in query_texts
+        ])
+
+    def retrieve_by_id(self, query_id: str, corpus_name: str = None, fields: List[str] = None) -> List[Dict]:
+        index_name = self._get_index_name(corpus_name)
+        if self._has_id_as_document_id(index_name):
+            result = self._es.get(
+                index=index_name, id=query_id, _source_includes=fields or BY_ID_SOURCE_FIELDS,
+                filter_path=GET_FILTER_PATH, ignore=404
+            )
+            return self._process_get_result(result, corpus_name)
+        index_name, query, process_result = self._prepare_retrieve_by_id(query_id, corpus_name, fields)
+        result = self._es.search(index=index_name, body=query, filter_path=SEARCH_FILTER_PATH)
+        return process_result(result)
+
+    def retrieve_by_ids(self, query_ids: List[str], corpus_name: str = None) -> List[List[Dict]]:
+        """
+        retrieve_by_id for many ids: a single mget (or _msearch for older indices) round trip.
+        """
+        return self.multi_retrieve([
+            ("retrieve_by_id", {"query_id": query_id, "corpus_name": corpus_name})
+            for query_id in query_ids
+        ])
+
+    def multi_retrieve(self, calls: List[Tuple[str, Dict]]) -> List[List[Dict]]:
+        """
+        Runs many retrievals in a single _msearch round trip. Each call is a tuple of
+        the retrieve_* method name (retrieve_paragraphs, retrieve_titles or retrieve_by_id)
+        and its keyword arguments. Returns the retrievals in the same order as the calls.
+        The retrieve_by_id calls on indices keyed by paragraph id go in one mget per index instead.
+        """
+        if not calls:
+            return []
+        retrievals = [None] * len(calls)
+        search_positions, search_calls, mget_groups = self._split_multi_retrieve_calls(calls)
+
+        if search_calls:
+            body, process_results = self._prepare_multi_retrieve(search_calls)
+            responses = self._es.msearch(body=body, filter_path=MSEARCH_FILTER_PATH)["responses"]
+            for position, retrieval in zip(
+                search_positions, self._process_multi_retrieve(responses, process_results)
+            ):
+                retrievals[position] = retrieval
+
+        for (index_name, corpus_name, fields), positions_and_ids in mget_groups.items():
+            result = self._es.mget(
+                index=index_name, body={"ids": [query_id for _, query_id in positions_and_ids]},
+                _source_includes=list(fields or BY_ID_SOURCE_FIELDS), filter_path=MGET_FILTER_PATH
+            )
+            for (position, _), document in zip(positions_and_ids, result["docs"]):
+                retrievals[position] = self._process_get_result(document, corpus_name)
+
+        return retrievals
+
+    def _split_multi_retrieve_calls(
+        self,
+        calls: List[Tuple[str, Dict]],
+    ) -> Tuple[List[int], List[Tuple[str, Dict]], Dict[Tuple[str, str, Tuple], List[Tuple[int, str]]]]:
+        """
+        Separates the calls that need a search (positions and calls) from the retrieve_by_id
+        calls that can be served by mget, grouped by (index_name, corpus_name, fields).
+        """
+        search_positions, search_calls = [], []
+        mget_groups = defaultdict(list)
+        for position, (method_name, kwargs) in enumerate(calls):
+            if method_name == "retrieve_by_id":
+                corpus_name = kwargs.get("corpus_name")
+                index_name = self._get_index_name(corpus_name)
+                if self._has_id_as_document_id(index_name):
+                    fields = kwargs.get("fields")
+                    fields = tuple(fields) if fields is not None else None
+                    mget_groups[(index_name, corpus_name, fields)].append((position, kwargs["query_id"]))
+                    continue
+            search_positions.append(position)
+            search_calls.append((method_name, kwargs))
+        return search_positions, search_calls, mget_groups
+
+    def _process_get_result(self, document: Dict, corpus_name: str) -> List[Dict]:
+        # GETs ignore 404s, which are also the errors of missing indices (e.g., index_not_found_exception).
+        if "error" in document:
+            raise Exception(f"Elasticsearch get failed: {document['error']}")
+        if not document.get("found"):
+            return []
+        retrieval_ = document["_source"]
+        retrieval_["corpus_name"] = corpus_name
+        return [retrieval_]
+
+    def _prepare_multi_retrieve(
+        self,
+        calls: List[Tuple[str, Dict]],
+    ) -> Tuple[List[Dict], List[Callable[[Dict], List[Dict]]]]:
+
+        body = []
+        process_results = []
+        for method_name, kwargs in calls:
+            assert method_name in ("retrieve_paragraphs", "retrieve_titles", "retrieve_by_id"), \
+                f"Unknown elasticsearch retrieval method {method_name}."
+            index_name, query, process_result = getattr(self, "_prepare_" + method_name)(**kwargs)
+            body += [{"index": index_name}, query]
+            process_results.append(process_result)
+
+        return body, process_results
+
+    def _process_multi_retrieve(
+        self,
+        responses: List[Dict],
+        process_results: List[Callable[[Dict], List[Dict]]],
+    ) -> List[List[Dict]]:
+
+        assert len(responses) == len(process_results), \
+            f"Got {len(responses)} multi-search responses for {len(process_results)} searches."
+        retrievals = []
+        for response, process_result in zip(responses, process_results):
+            if "error" in response:
+                raise Exception(f"Elasticsearch multi-search failed: {response['error']}")
+            retrievals.append(process_result(response))
+        return retrievals
+
+    async def async_retrieve_paragraphs(self, *args, **kwargs) -> List[Dict]:
+        await self._async_load_index_mappings(self._get_call_index_name("retrieve_paragraphs", args, kwargs))
+        index_name, query, process_result = self._prepare_retrieve_paragraphs(*args, **kwargs)
+        result = await self._get_async_es().search(
+            index=index_name, body=query, filter_path=SEARCH_FILTER_PATH
+        )
+        return process_result(result)
+
+    async def async_retrieve_titles(self, *args, **kwargs) -> List[Dict]:
+        await self._async_load_index_mappings(self._get_call_index_name("retrieve_titles", args, kwargs))
+        index_name, query, process_result = self._prepare_retrieve_titles(*args, **kwargs)
+        result = await self._get_async_es().search(
+            index=index_name, body=query, filter_path=SEARCH_FILTER_PATH
+        )
+        return process_result(result)
+
+    async def async_retrieve_by_id(
+        self, query_id: str, corpus_name: str = None, fields: List[str] = None
+    ) -> List[Dict]:
+        index_name = self._get_index_name(corpus_name)
+        await self._async_load_index_mappings(index_name)
+        if self._has_id_as_document_id(index_name):
+            result = await self._get_async_es().get(
+                index=index_name, id=query_id, _source_includes=fields or BY_ID_SOURCE_FIELDS,
+                filter_path=GET_FILTER_PATH, ignore=404
+            )
+            return self._process_get_result(result, corpus_name)
+        index_name, query, process_result = self._prepare_retrieve_by_id(query_id, corpus_name, fields)
+        result = await self._get_async_es().search(
+            index=index_name, body=query, filter_path=SEARCH_FILTER_PATH
+        )
+        return process_result(result)
+
+    async def async_multi_retrieve(self, calls: List[Tuple[str, Dict]]) -> List[List[Dict]]:
+        if not calls:
+            return []
+        await self._async_load_index_mappings(*[
+            self._get_call_index_name(method_name, kwargs=kwargs) for method_name, kwargs in calls
+        ])
+        retrievals = [None] * len(calls)
+        search_positions, search_calls, mget_groups = self._split_multi_retrieve_calls(calls)
+
+        if search_calls:
+            body, process_results = self._prepare_multi_retrieve(search_calls)
+            responses = (await self._get_async_es().msearch(
+                body=body, filter_path=MSEARCH_FILTER_PATH
+            ))["responses"]
+            for position, retrieval in zip(
+                search_positions, self._process_multi_retrieve(responses, process_results)
+            ):
+                retrievals[position] = retrieval
+
+        for (index_name, corpus_name, fields), positions_and_ids in mget_groups.items():
+            result = await self._get_async_es().mget(
+                index=index_name, body={"ids": [query_id for _, query_id in positions_and_ids]},
+                _source_includes=list(fields or BY_ID_SOURCE_FIELDS), filter_path=MGET_FILTER_PATH
+            )
+            for (position, _), document in zip(positions_and_ids, result["docs"]):
+                retrievals[position] = self._process_get_result(document, corpus_name)
+
+        return retrievals
+
+    async def async_close(self) -> None:
+        if self._async_es is not None:
+            await self._async_es.close()
+
+    def _get_async_es(self):
+        if self._async_es is None:
+            raise Exception("The async methods need the ElasticsearchRetriever to be initialized with use_async=True.")
+        return self._async_es
+
+    def _prepare_retrieve_paragraphs(
         self,
         query_text: str = None,
         is_abstract: bool = None,
@@ -38,16 +424,10 @@ class ElasticsearchRetriever:
         max_buffer_count: int = 100,
         max_hits_count: int = 10,
         corpus_name: str = None,
-    ) -> List[Dict]:
-
-        if self._corpus_name == "auto":
-            assert corpus_name != None, \
-            "The corpus_name is initialized as auto. So you need to pass it at runtime."
-        else:
-            assert corpus_name in (None, self._corpus_name), \
-            "The corpus_name is not initialized as auto. So you can't pass it at runtime."
+        fields: List[str] = None,
+    ) -> Tuple[str, Dict, Callable[[Dict], List[Dict]]]:
 
-        index_name = f"{corpus_name or self._corpus_name}-wikipedia"
+        index_name = self._get_index_name(corpus_name)
 
         query = {
             "size": max_buffer_count,
@@ -81,7 +461,14 @@ class ElasticsearchRetriever:
         if is_abstract is not None:
             query["query"]["bool"]["filter"] = [{"match": {"is_abstract": is_abstract}}]
 
-        if allowed_titles is not None:
+        filter_titles_in_es = allowed_titles is not None and self._has_title_keyword_field(index_name)
+        if filter_titles_in_es:
+            # title.keyword is lowercased/trimmed by the index normalizer, so this matches the
+            # same titles as the post-filter below, but ES does it (w/o scoring) before ranking.
+            query["query"]["bool"].setdefault("filter", []).append(
+                {"terms": {"title.keyword": sorted({e.lower().strip() for e in allowed_titles})}}
+            )
+        elif allowed_titles is not None:
             if len(allowed_titles) == 1:
                 query["query"]["bool"]["must"] += [
                     {"match": {"title": _title}} for _title in allowed_titles
@@ -104,7 +491,7 @@ class ElasticsearchRetriever:
         if paragraph_index is not None:
             query["query"]["bool"]["should"].append({"match": {"paragraph_index": paragraph_index}})
 
-        assert query["query"]["bool"]["should"] or query["query"]["bool"]["must"]
+        assert query["query"]["bool"]["should"] or query["query"]["bool"]["must"] or filter_titles_in_es
 
         if not query["query"]["bool"]["must"]:
             query["query"]["bool"].pop("must")
@@ -112,56 +499,73 @@ class ElasticsearchRetriever:
         if not query["query"]["bool"]["should"]:
             query["query"]["bool"].pop("should")
 
-        result = self._es.search(index=index_name, body=query)
-
-        retrieval = []
-        if result.get('hits') is not None and result['hits'].get('hits') is not None:
-            retrieval = result['hits']['hits']
-            text2retrieval = OrderedDict()
-            for item in retrieval:
-                text = item["_source"]["paragraph_text"].strip().lower()
-                text2retrieval[text] = item
-            retrieval = list(text2retrieval.values())
-
-        retrieval = sorted(retrieval, key=lambda e: e["_score"], reverse=True)
-        retrieval = retrieval[:max_hits_count]
-        for retrieval_ in retrieval:
-            retrieval_["_source"]["score"] = retrieval_["_score"]
-        retrieval = [e["_source"] for e in retrieval]
-
-        if allowed_titles is not None:
-            lower_allowed_titles = [e.lower().strip() for e in allowed_titles]
-            retrieval = [
-                item for item in retrieval
-                if item["title"].lower().strip() in lower_allowed_titles
-            ]
-
-        for retrieval_ in retrieval:
-            retrieval_["corpus_name"] = corpus_name
+        # If ES can drop the duplicate texts (collapse) and the disallowed titles (filter) itself,
+        # the top max_hits_count hits are the final ones, so there's no need to overfetch.
+        collapse_in_es = self._has_paragraph_text_hash_field(index_name)
+        if collapse_in_es:
+            query["collapse"] = {"field": "paragraph_text_hash"}
+            if allowed_titles is None or filter_titles_in_es:
+                query["size"] = min(max_hits_count, max_buffer_count)
+
+        # only the fields the post-filtering and dedup below (if they aren't done by ES) need.
+        required_fields = []
+        if allowed_titles is not None and not filter_titles_in_es:
+            required_fields.append("title")
+        if not collapse_in_es:
+            required_fields.append("paragraph_text")
+        query["_source"] = get_source_fields(fields, query["_source"], required_fields=required_fields)
+
+        def process_result(result: Dict) -> List[Dict]:
+            retrieval = []
+            if result.get('hits') is not None and result['hits'].get('hits') is not None:
+                retrieval = result['hits']['hits']
+                if not collapse_in_es:
+                    text2retrieval = OrderedDict()
+                    for item in retrieval:
+                        text = item["_source"]["paragraph_text"].strip().lower()
+                        text2retrieval[text] = item
+                    retrieval = list(text2retrieval.values())
+
+            retrieval = sorted(retrieval, key=lambda e: e["_score"], reverse=True)
+            retrieval = retrieval[:max_hits_count]
+            for retrieval_ in retrieval:
+                retrieval_["_source"]["score"] = retrieval_["_score"]
+            retrieval = [e["_source"] for e in retrieval]
+
+            if allowed_titles is not None and not filter_titles_in_es:
+                lower_allowed_titles = {e.lower().strip() for e in allowed_titles}
+                retrieval = [
+                    item for item in retrieval
+                    if item["title"].lower().strip() in lower_allowed_titles
+                ]
 
-        return retrieval
+            retrieval = project_fields(retrieval, fields)
+
+            for retrieval_ in retrieval:
+                retrieval_["corpus_name"] = corpus_name
 
-    def retrieve_titles(
+            return retrieval
+
+        return index_name, query, process_result
+
+    def _prepare_retrieve_titles(
         self,
         query_text: str,
         max_buffer_count: int = 100,
         max_hits_count: int = 10,
         corpus_name: str = None,
-    ) -> List[Dict]:
+        fields: List[str] = None,
+    ) -> Tuple[str, Dict, Callable[[Dict], List[Dict]]]:
 
-        if self._corpus_name == "auto":
-            assert corpus_name != None, \
-            "The corpus_name is initialized as auto. So you need to pass it at runtime."
-        else:
-            assert corpus_name in (None, self._corpus_name), \
-            "The corpus_name is not initialized as auto. So you can't pass it at runtime."
-
-        index_name = f"{corpus_name or self._corpus_name}-wikipedia"
+        index_name = self._get_index_name(corpus_name)
 
         query = {
             "size": max_buffer_count,
             # what records are needed in the result.
-            "_source": ["id", "title", "paragraph_text", "url", "is_abstract", "paragraph_index"],
+            "_source": get_source_fields(
+                fields, ["id", "title", "paragraph_text", "url", "is_abstract", "paragraph_index"],
+                required_fields=["title"]
+            ),
             "query": {
                 "bool": {
                     "must": [
@@ -177,39 +581,47 @@ class ElasticsearchRetriever:
         if index_name == f"natcq_pages-wikipedia":
             query["query"]["bool"].pop("filter")
 
-        result = self._es.search(index=index_name, body=query)
+        # title.keyword is the same lowercased/trimmed title that's used for dedup below.
+        collapse_in_es = self._has_title_keyword_field(index_name)
+        if collapse_in_es:
+            query["collapse"] = {"field": "title.keyword"}
+            query["size"] = min(max_hits_count, max_buffer_count)
 
-        retrieval = []
-        if result.get('hits') is not None and result['hits'].get('hits') is not None:
-            retrieval = result['hits']['hits']
-            text2retrieval = OrderedDict()
-            for item in retrieval:
-                text = item["_source"]["title"].strip().lower()
-                text2retrieval[text] = item
-            retrieval = list(text2retrieval.values())[:max_hits_count]
+        def process_result(result: Dict) -> List[Dict]:
+            retrieval = []
+            if result.get('hits') is not None and result['hits'].get('hits') is not None:
+                retrieval = result['hits']['hits']
+                if not collapse_in_es:
+                    text2retrieval = OrderedDict()
+                    for item in retrieval:
+                        text = item["_source"]["title"].strip().lower()
+                        text2retrieval[text] = item
+                    retrieval = list(text2retrieval.values())
+                retrieval = retrieval[:max_hits_count]
 
-        retrieval = [e["_source"] for e in retrieval]
+            retrieval = [e["_source"] for e in retrieval]
+            retrieval = project_fields(retrieval, fields)
 
-        for retrieval_ in retrieval:
-            retrieval_["corpus_name"] = corpus_name
+            for retrieval_ in retrieval:
+                retrieval_["corpus_name"] = corpus_name
 
-        return retrieval
+            return retrieval
 
-    def retrieve_by_id(self, query_id: str, corpus_name: str = None) -> List[Dict]:
+        return index_name, query, process_result
 
-        if self._corpus_name == "auto":
-            assert corpus_name != None, \
-            "The corpus_name is initialized as auto. So you need to pass it at runtime."
-        else:
-            assert corpus_name in (None, self._corpus_name), \
-            "The corpus_name is not initialized as auto. So you can't pass it at runtime."
+    def _prepare_retrieve_by_id(
+        self,
+        query_id: str,
+        corpus_name: str = None,
+        fields: List[str] = None,
+    ) -> Tuple[str, Dict, Callable[[Dict], List[Dict]]]:
 
-        index_name = f"{corpus_name or self._corpus_name}-wikipedia"
+        index_name = self._get_index_name(corpus_name)
 
+        # This is only used for older indices, where the ES _id isn't the paragraph id.
         query = {
             "size": 1,
-            # what records are needed in the result.
-            "_source": ["id", "title", "paragraph_text", "url", "is_abstract", "paragraph_index", "data"],
+            "_source": get_source_fields(fields, BY_ID_SOURCE_FIELDS),
             "query": {
                 "bool": {
                     "must": [
@@ -219,17 +631,18 @@ class ElasticsearchRetriever:
             }
         }
 
-        result = self._es.search(index=index_name, body=query)
+        def process_result(result: Dict) -> List[Dict]:
+            retrieval = []
+            if result.get('hits') is not None and result['hits'].get('hits') is not None:
+                retrieval = result['hits']['hits']
+            retrieval = [e["_source"] for e in retrieval]
 
-        retrieval = []
-        if result.get('hits') is not None and result['hits'].get('hits') is not None:
-            retrieval = result['hits']['hits']
-        retrieval = [e["_source"] for e in retrieval]
+            for retrieval_ in retrieval:
+                retrieval_["corpus_name"] = corpus_name
 
-        for retrieval_ in retrieval:
-            retrieval_["corpus_name"] = corpus_name
+            return retrieval
 
-        return retrieval
+        return index_name, query, process_result
 
 
 if __name__ == "__main__":
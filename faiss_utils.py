@@ -0,0 +1,187 @@
+"""
+Helpers for the faiss indices of the dense retrievers: memory-mapped loading, the
+recall/latency knobs (nprobe, efSearch) of the approximate (IVF, HNSW) ones per search,
+and searches restricted to some rows (e.g., of allowed_titles).
+"""
+
+from typing import Tuple, Optional
+import os
+
+import numpy as np
+import faiss
+
+
+# faiss index_factory strings of the DPR index types built from the flat index
+# (see build_dpr_index_make_fast.py). hnsw is built by pyserini.
+DPR_INDEX_FACTORY_STRINGS = {
+    "ivf_flat": "IVF{nlist},Flat",
+    "ivf_pq": "IVF{nlist},PQ{pq_m}x{pq_nbits}",
+    "sq8": "SQ8",
+}
+
+# Searches restricted to at most this many rows score them exactly (one matmul over their
+# vectors) instead of going through a filtered faiss search, if the vectors are available.
+EXACT_SEARCH_MAX_ROWS = 4096
+
+# Optional (float16 or float32) vectors of a non-flat index, saved next to it (see build_dpr_index_make_fast.py).
+EMBEDDINGS_FILE_NAME = "embeddings.npy"
+
+
+def read_index(index_path: str, mmap: bool = False) -> faiss.Index:
+    """
+    With mmap, the index file is memory-mapped (read-only) instead of read into the process
+    memory: loading is instant, pages are read lazily on first use, and the OS page cache is
+    shared by all the processes (e.g., uvicorn workers) mapping the same file. IVF inverted lists
+    are mapped with IO_FLAG_MMAP; the codes of flat/hnsw/sq8 indices need a faiss version with
+    IO_FLAG_MMAP_IFC, otherwise they're still read in.
+    """
+    if not mmap:
+        return faiss.read_index(index_path)
+    io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    return faiss.read_index(index_path, io_flags)
+
+
+def write_index(index: faiss.Index, index_path: str) -> None:
+    # replaced (not overwritten in place), as the old file may be memory-mapped by a reader.
+    faiss.write_index(index, index_path + ".tmp")
+    os.replace(index_path + ".tmp", index_path)
+
+
+def get_ivf_index(index: faiss.Index) -> Optional[faiss.IndexIVF]:
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError: # not an IVF index.
+        return None
+
+
+def get_hnsw_index(index: faiss.Index) -> Optional[faiss.IndexHNSW]:
+    index = faiss.downcast_index(index)
+    return index if isinstance(index, faiss.IndexHNSW) else None
+
+
+def set_default_search_parameters(index: faiss.Index, nprobe: int = None, ef_search: int = None) -> None:
+    """
+    Sets the nprobe (for IVF indices) and/or efSearch (for HNSW indices) used by the searches
+    that don't pass their own.
+    """
+    if nprobe is not None:
+        ivf_index = get_ivf_index(index)
+        assert ivf_index is not None, "nprobe is only valid for IVF indices."
+        ivf_index.nprobe = nprobe
+    if ef_search is not None:
+        hnsw_index = get_hnsw_index(index)
+        assert hnsw_index is not None, "ef_search is only valid for HNSW indices."
+        hnsw_index.hnsw.efSearch = ef_search
+
+
+def make_search_parameters(
+        index: faiss.Index,
+        nprobe: int = None,
+        ef_search: int = None,
+        selector: faiss.IDSelector = None,
+    ) -> Optional[faiss.SearchParameters]:
+    # NOTE: faiss >= 1.7.3 is needed for per-search parameters.
+    if nprobe is not None:
+        assert get_ivf_index(index) is not None, "nprobe is only valid for IVF indices."
+        return faiss.SearchParametersIVF(nprobe=nprobe, sel=selector)
+    if ef_search is not None:
+        assert get_hnsw_index(index) is not None, "ef_search is only valid for HNSW indices."
+        return faiss.SearchParametersHNSW(efSearch=ef_search, sel=selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+
+def search(
+        index: faiss.Index,
+        query_embeddings: np.ndarray,
+        k: int,
+        nprobe: int = None,
+        ef_search: int = None,
+        allowed_rows: np.ndarray = None,
+        excluded_rows: np.ndarray = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    index.search with nprobe/ef_search for just this search (w/o changing the index defaults,
+    so concurrent searches with different settings don't interfere), and, if given, only over
+    the allowed_rows of the index and/or not over its excluded_rows (e.g., deleted ones).
+    """
+    if allowed_rows is not None and excluded_rows is not None and len(excluded_rows):
+        allowed_rows = allowed_rows[~np.isin(allowed_rows, excluded_rows)]
+        excluded_rows = None
+    # the selectors point into the row arrays, so all of them have to outlive the search.
+    selector = excluded_selector = None
+    if allowed_rows is not None:
+        allowed_rows = np.ascontiguousarray(allowed_rows, dtype=np.int64)
+        selector = faiss.IDSelectorBatch(len(allowed_rows), faiss.swig_ptr(allowed_rows))
+    elif excluded_rows is not None and len(excluded_rows):
+        excluded_rows = np.ascontiguousarray(excluded_rows, dtype=np.int64)
+        excluded_selector = faiss.IDSelectorBatch(len(excluded_rows), faiss.swig_ptr(excluded_rows))
+        selector = faiss.IDSelectorNot(excluded_selector)
+    params = make_search_parameters(index, nprobe=nprobe, ef_search=ef_search, selector=selector)
+    if params is None:
+        return index.search(query_embeddings, k)
+    return index.search(query_embeddings, k, params=params)
+
+
+def get_flat_vectors(index: faiss.Index) -> Optional[np.ndarray]:
+    """
+    The (ntotal, d) float32 vectors of an inner product flat index, as a view of its memory
+    (no copy, so the index must outlive it), or None for other indices.
+    """
+    index = faiss.downcast_index(index)
+    if not isinstance(index, faiss.IndexFlat) or index.metric_type != faiss.METRIC_INNER_PRODUCT:
+        return None
+    return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+
+
+def load_vectors(index: faiss.Index, index_directory: str) -> Optional[np.ndarray]:
+    # The vectors of the index for exact searches: its own if it's flat, else the saved ones (memory-mapped).
+    vectors = get_flat_vectors(index)
+    embeddings_path = os.path.join(index_directory, EMBEDDINGS_FILE_NAME)
+    if vectors is None and os.path.exists(embeddings_path):
+        vectors = np.load(embeddings_path, mmap_mode="r")
+        assert vectors.shape == (index.ntotal, index.d), f"Mismatching shape of {embeddings_path}."
+    return vectors
+
+
+def search_rows_exactly(
+        vectors: np.ndarray,
+        query_embeddings: np.ndarray,
+        k: int,
+        rows: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top k inner products of the query (1, d) with the vectors of rows, as (1, <= k) scores and
+    rows, best first, like index.search.
+    """
+    rows = np.sort(np.asarray(rows, dtype=np.int64)) # ascending rows read the (mmap'd) vectors in order.
+    scores = np.asarray(vectors[rows], dtype=np.float32) @ query_embeddings[0].astype(np.float32)
+    if k < len(scores):
+        top_indices = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top_indices = np.arange(len(scores))
+    top_indices = top_indices[np.argsort(-scores[top_indices], kind="stable")]
+    return scores[top_indices][None], rows[top_indices][None]
+
+
+def search_allowed_rows(
+        index: faiss.Index,
+        query_embeddings: np.ndarray,
+        k: int,
+        allowed_rows: np.ndarray,
+        vectors: np.ndarray = None,
+        exact_search_max_rows: int = EXACT_SEARCH_MAX_ROWS,
+        nprobe: int = None,
+        ef_search: int = None,
+        excluded_rows: np.ndarray = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Search of one query (1, d) only over allowed_rows (minus excluded_rows): scored exactly if
+    there are few of them (and the vectors are given), otherwise with a filtered faiss search.
+    """
+    if excluded_rows is not None and len(excluded_rows):
+        allowed_rows = allowed_rows[~np.isin(allowed_rows, excluded_rows)]
+    if vectors is not None and len(allowed_rows) <= exact_search_max_rows:
+        return search_rows_exactly(vectors, query_embeddings, k, allowed_rows)
+    return search(index, query_embeddings, k, nprobe=nprobe, ef_search=ef_search, allowed_rows=allowed_rows)
@@ -0,0 +1,128 @@
+"""
+Generate the contriever passage embeddings (embeddings/passages_*) of a corpus, which
+ContrieverRetriever indexes on first load, on cpu (or gpu) without the contriever repo's
+(cuda only) generate_passage_embeddings.py.
+
+paragraphs.tsv is streamed in batches, and every shard_size passages are written to their own
+embeddings file, in the same (pickled ids, embeddings) format. Shards that are already written
+are skipped, so an interrupted run only encodes the remaining shards.
+"""
+
+from typing import List, Dict
+import argparse
+import itertools
+import pickle
+import os
+import json
+
+import _jsonnet
+import numpy as np
+import torch
+
+from contriever_retriever import ContrieverConfig, embed_texts, read_passages
+import src.contriever # contriever_retriever puts the contriever repository on the path.
+
+
+CONTRIEVER_DATA_PATH = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))["CONTRIEVER_DATA_PATH"]
+
+
+def get_shard_path(embeddings_directory: str, shard_index: int) -> str:
+    return os.path.join(embeddings_directory, f"passages_{shard_index:02d}")
+
+
+def generate_passage_embeddings(
+        paragraphs_path: str,
+        embeddings_directory: str,
+        model_name_or_path: str = "facebook/contriever",
+        device: str = "cpu",
+        batch_size: int = 64,
+        shard_size: int = 100000,
+        passage_maxlength: int = 512,
+        lowercase: bool = False,
+        normalize_text: bool = False,
+    ) -> int:
+    """
+    Writes the embeddings of the passages of paragraphs_path (title + " " + text, as contriever
+    embeds them) to shards of embeddings_directory. Returns the number of shards.
+    """
+    os.makedirs(embeddings_directory, exist_ok=True)
+    passages = read_passages(paragraphs_path)
+
+    model = tokenizer = None
+    shard_index = 0
+    while True:
+        shard_passages: List[Dict] = list(itertools.islice(passages, shard_size))
+        if not shard_passages:
+            return shard_index
+        shard_path = get_shard_path(embeddings_directory, shard_index)
+        if os.path.exists(shard_path):
+            print(f"Skipping the existing {shard_path}")
+            shard_index += 1
+            continue
+
+        if model is None:
+            model, tokenizer, _ = src.contriever.load_retriever(model_name_or_path)
+            model = model.to(device).eval()
+
+        texts = [passage["title"] + " " + passage["text"] for passage in shard_passages]
+        embeddings = embed_texts(
+            model, tokenizer, texts, passage_maxlength, batch_size=batch_size, device=device,
+            lowercase=lowercase, normalize_text=normalize_text,
+        ).astype(np.float32)
+        ids = [passage["id"] for passage in shard_passages]
+
+        # written outside of embeddings_directory first, as ContrieverRetriever globs all of its files.
+        temporary_shard_path = os.path.join(os.path.dirname(embeddings_directory), os.path.basename(shard_path) + ".tmp")
+        with open(temporary_shard_path, "wb") as file:
+            pickle.dump((ids, embeddings), file)
+        os.replace(temporary_shard_path, shard_path)
+        print(f"Written {len(ids)} passage embeddings to {shard_path}")
+        shard_index += 1
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="generate contriever passage embeddings")
+    parser.add_argument(
+        "dataset_name", type=str, help="dataset_name",
+        choices={"original", "musique_ans", "hotpotqa", "2wikimultihopqa", "iirc"}
+    )
+    parser.add_argument(
+        '--chunk_by_type', type=str, default=None, help="chunk_by_type", choices={None, "words", "sentences"}
+    )
+    parser.add_argument("--device", type=str, default="cpu", help="device to encode on, e.g., cpu or cuda")
+    parser.add_argument("--num_threads", type=int, default=None, help="cpu threads (default: all cores)")
+    parser.add_argument("--batch_size", type=int, default=64, help="passages per forward pass")
+    parser.add_argument("--shard_size", type=int, default=100000, help="passages per embeddings file")
+    args = parser.parse_args()
+
+    if args.dataset_name != "original":
+        assert args.chunk_by_type != None
+        corpus_name = "musique" if args.dataset_name == "musique_ans" else args.dataset_name
+        if args.chunk_by_type == "words":
+            corpus_name = "word_chunked_" + corpus_name
+        if args.chunk_by_type == "sentences":
+            corpus_name = "sentence_chunked_" + corpus_name
+    else:
+        assert args.chunk_by_type == None
+        corpus_name = "original"
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    contriever_data_path = os.path.join(CONTRIEVER_DATA_PATH, corpus_name)
+    config = ContrieverConfig(
+        os.path.join(contriever_data_path, "paragraphs.tsv"),
+        os.path.join(contriever_data_path, "embeddings/*")
+    )
+    num_shards = generate_passage_embeddings(
+        config.paragraphs_path,
+        os.path.dirname(config.paragraphs_embeddings),
+        model_name_or_path=config.model_name_or_path,
+        device=args.device,
+        batch_size=args.batch_size,
+        shard_size=args.shard_size,
+        lowercase=config.lowercase,
+        normalize_text=config.normalize_text,
+    )
+    print(f"Generated {num_shards} passage embedding shards.")
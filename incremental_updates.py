@@ -0,0 +1,494 @@
+"""
+Incremental updates of the dense retriever (Contriever, DPR) indices, so that a corpus refresh
+costs (mostly) its delta instead of a full rebuild:
+
+    add: only the new paragraphs are encoded. They (and their embeddings) are appended to the
+        UpdateLog as a segment, and searched exactly next to the (unchanged) base index.
+    delete: the ids are appended to the UpdateLog. The base index rows of the paragraphs are
+        excluded from searches (tombstones), the added ones are dropped from the delta.
+    compact: the log is folded into the base files (corpus, flat index, id maps, paragraph store),
+        which is a rewrite of everything, so it's only done (in the background) once the deleted
+        and added rows are more than a tombstone_ratio of the index.
+
+Adds and deletes only write to the log, so they cost the delta (and never invalidate the
+startup caches derived from the base files). The log is by paragraph id and is replayed on
+top of the base index on load, so the updates survive restarts and cache rebuilds. A compaction
+stages the new base files first, and, once they are complete, records them in the log before
+moving them into place, so an interrupted compaction is rolled forward on the next load.
+
+Searches read one immutable IndexState (base index, its maps, tombstones and delta), which
+updates replace by reference, so searches don't wait for any lock.
+
+The log (and the base files) are shared by all the processes that load the index (uvicorn
+workers, pool processes, the CLI): updates and compactions hold its (file) lock, and the other
+processes sync their state with it on their next search (see sync_state).
+
+The update API is the add_paragraphs, delete_paragraphs and compact methods of the retrievers.
+CLI:
+
+    python incremental_updates.py contriever hotpotqa --add new_paragraphs.jsonl --delete deleted_ids.txt
+    python incremental_updates.py dpr hotpotqa --compact
+
+where the added paragraphs are jsonl of id, title and paragraph_text (and paragraph_index for dpr),
+and the deleted ids are one per line.
+"""
+
+from typing import List, Dict, Tuple, Callable, Iterable, Optional, Any
+from collections import defaultdict
+from dataclasses import dataclass, field, replace
+from contextlib import contextmanager
+import argparse
+import threading
+import pickle
+import shutil
+import json
+import os
+
+import numpy as np
+import _jsonnet
+
+from paragraph_store import ParagraphStore, TitleRowIndex, normalize_title
+from startup_cache import file_lock, replace_directory
+
+
+# compact once this fraction of the index rows are deleted or (not yet compacted) added ones.
+DEFAULT_COMPACTION_TOMBSTONE_RATIO = 0.1
+
+
+def make_position_to_row(row_to_position: Optional[np.ndarray], num_rows: int, num_positions: int) -> Optional[np.ndarray]:
+    # inverse of row_to_position (None for identity), with -1 for positions that aren't in the
+    # index. None if it's the identity too, i.e., the store has just the index paragraphs.
+    if row_to_position is None and num_positions == num_rows:
+        return None
+    position_to_row = np.full(num_positions, -1, dtype=np.int64)
+    position_to_row[np.arange(num_rows) if row_to_position is None else np.asarray(row_to_position)] = \
+        np.arange(num_rows)
+    return position_to_row
+
+
+def get_update_log_directory(retriever_name: str, corpus_name: str) -> str:
+    # of the contriever or (flat) dpr index of the corpus.
+    global_config = json.loads(_jsonnet.evaluate_file(".global_config.jsonnet"))
+    if retriever_name == "contriever":
+        return os.path.join(global_config["CONTRIEVER_DATA_PATH"], corpus_name, "updates")
+    return os.path.join(global_config["WIKIPEDIA_CORPUSES_PATH"], f"{corpus_name}-wikpedia-dpr-updates")
+
+
+def get_update_log_version(directory: str) -> Optional[Tuple[int, int, int]]:
+    # changes with every append to and compaction of the UpdateLog in directory (just a stat of
+    # its journal), e.g., for caches of retrievals. None if there's none.
+    try:
+        stat = os.stat(os.path.join(directory, UpdateLog.JOURNAL_FILE_NAME))
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class UpdateLog:
+    """
+    The paragraphs added and deleted since the last compaction, by id, in directory:
+    journal.jsonl of {"add": segment file name} and {"delete": [ids]} entries, in order, and a
+    segment file (pickled paragraphs and embeddings) for each add. Entries are appended (and
+    fsynced) one line at a time, and a partial last line of an interrupted append is dropped.
+    The first line of the journal is the {"generation": n} of the base files, i.e., the number
+    of compactions so far.
+
+    The log is shared by all the processes (uvicorn workers, pool processes, the CLI) that load
+    the index: whatever changes the log or the base files (appends, compactions and their
+    recovery) holds lock(), and the others reload() it when it is_stale().
+    """
+
+    JOURNAL_FILE_NAME = "journal.jsonl"
+    COMPACTION_FILE_NAME = "compaction.json"
+    STAGED_DIRECTORY_NAME = "staged"
+    LOCK_FILE_NAME = ".lock"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # the file lock is per open file, so it's only taken by the outermost lock() of a process.
+        self._thread_lock = threading.RLock()
+        self._is_locked = False
+        self.generation = 0
+        self._entries = []
+        self._journal_stat = None
+        with self.lock():
+            if os.path.exists(os.path.join(directory, self.COMPACTION_FILE_NAME)):
+                print(f"Finishing the interrupted compaction of {directory}")
+                self.finish_compaction()
+            # staged files of a compaction that didn't get to begin_compaction.
+            shutil.rmtree(self.get_staged_path(), ignore_errors=True)
+            self.reload()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @contextmanager
+    def lock(self, blocking: bool = True):
+        # Yields whether it's taken (see startup_cache.file_lock), reentrant within a thread.
+        if not self._thread_lock.acquire(blocking=blocking):
+            yield False
+            return
+        try:
+            if self._is_locked:
+                yield True
+                return
+            with file_lock(os.path.join(self.directory, self.LOCK_FILE_NAME), blocking=blocking) as is_locked:
+                self._is_locked = is_locked
+                try:
+                    yield is_locked
+                finally:
+                    self._is_locked = False
+        finally:
+            self._thread_lock.release()
+
+    def _get_journal_path(self) -> str:
+        return os.path.join(self.directory, self.JOURNAL_FILE_NAME)
+
+    def is_stale(self) -> bool:
+        # whether the journal changed (by another process) since it was read, a stat, without lock.
+        return get_update_log_version(self.directory) != self._journal_stat
+
+    def get_version(self) -> Tuple[int, int]:
+        return self.generation, len(self._entries)
+
+    def reload(self) -> None:
+        # re-reads the journal, under lock().
+        with self.lock():
+            journal_path = self._get_journal_path()
+            lines = []
+            if os.path.exists(journal_path):
+                with open(journal_path, "rb") as file:
+                    data = file.read()
+                complete_data = data[:data.rfind(b"\n") + 1]
+                if len(complete_data) != len(data):
+                    with open(journal_path, "r+b") as file:
+                        file.truncate(len(complete_data))
+                lines = [json.loads(line) for line in complete_data.decode("utf-8").splitlines() if line.strip()]
+            self.generation = lines[0]["generation"] if lines else 0
+            self._entries = lines[1:]
+            self._journal_stat = get_update_log_version(self.directory)
+
+    def _append_entry(self, entry: Dict) -> None:
+        # under lock() and after reload(), so that the entry goes after the others' ones.
+        journal_path = self._get_journal_path()
+        if not os.path.exists(journal_path):
+            self._write_journal_header(self.generation)
+        with open(journal_path, "a") as file:
+            file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self._entries.append(entry)
+        self._journal_stat = get_update_log_version(self.directory)
+
+    def _write_journal_header(self, generation: int) -> None:
+        # a new (empty) journal, replaced atomically.
+        journal_path = self._get_journal_path()
+        with open(journal_path + ".tmp", "w") as file:
+            file.write(json.dumps({"generation": generation}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(journal_path + ".tmp", journal_path)
+
+    def append_added(self, paragraphs: List[Dict], embeddings: np.ndarray) -> None:
+        with self.lock():
+            self.reload()
+            # the segment is complete before the entry that refers to it is written.
+            segment_file_name = f"segment_{self.generation:06d}_{len(self._entries):06d}.pkl"
+            segment_path = os.path.join(self.directory, segment_file_name)
+            with open(segment_path + ".tmp", "wb") as file:
+                pickle.dump({"paragraphs": paragraphs, "embeddings": embeddings}, file)
+            os.replace(segment_path + ".tmp", segment_path)
+            self._append_entry({"add": segment_file_name})
+
+    def append_deleted(self, ids: List[str]) -> None:
+        with self.lock():
+            self.reload()
+            self._append_entry({"delete": list(ids)})
+
+    def read(self, start: int = 0) -> Iterable[Tuple[str, Any]]:
+        # ("add", (paragraphs, embeddings)) and ("delete", ids) of the entries from start, in order.
+        for entry in self._entries[start:]:
+            if "add" in entry:
+                with open(os.path.join(self.directory, entry["add"]), "rb") as file:
+                    segment = pickle.load(file)
+                yield "add", (segment["paragraphs"], segment["embeddings"])
+            else:
+                yield "delete", entry["delete"]
+
+    def get_staged_path(self, *names: str) -> str:
+        # where a compaction writes the new base files (see begin_compaction).
+        return os.path.join(self.directory, self.STAGED_DIRECTORY_NAME, *names)
+
+    def begin_compaction(self, renames: List[Tuple[str, str]]) -> None:
+        # renames: the (complete) staged files/directories -> the base paths they replace. From
+        # here on, the compaction is rolled forward (by finish_compaction), even after a crash.
+        # The whole compaction (from the reload() its staged files are made from) holds lock().
+        with self.lock():
+            compaction_path = os.path.join(self.directory, self.COMPACTION_FILE_NAME)
+            with open(compaction_path + ".tmp", "w") as file:
+                json.dump({"renames": renames, "generation": self.generation + 1}, file, indent=4)
+            os.replace(compaction_path + ".tmp", compaction_path)
+
+    def finish_compaction(self) -> None:
+        # idempotent: the staged paths that are already moved into place are skipped.
+        with self.lock():
+            compaction_path = os.path.join(self.directory, self.COMPACTION_FILE_NAME)
+            with open(compaction_path, "r") as file:
+                compaction = json.load(file)
+            for staged_path, path in compaction["renames"]:
+                if os.path.isdir(staged_path):
+                    replace_directory(staged_path, path)
+                elif os.path.exists(staged_path):
+                    os.replace(staged_path, path)
+            # the log is folded into the base files now.
+            self._write_journal_header(compaction["generation"])
+            for file_name in os.listdir(self.directory):
+                if file_name.startswith("segment_"):
+                    os.remove(os.path.join(self.directory, file_name))
+            shutil.rmtree(self.get_staged_path(), ignore_errors=True)
+            os.remove(compaction_path)
+            self.reload()
+
+
+class Delta:
+    """
+    The added paragraphs (and their embeddings) of the UpdateLog, which are scored exactly (they
+    are few) next to the base index, and which of them are still live. Immutable: updates return
+    a new one.
+    """
+
+    def __init__(self, paragraphs: List[Dict] = (), embeddings: np.ndarray = None, is_live: np.ndarray = None):
+        self.paragraphs = list(paragraphs)
+        self.embeddings = embeddings
+        self.is_live = np.ones(len(self.paragraphs), dtype=bool) if is_live is None else is_live
+        self._id_to_row = {paragraph["id"]: row for row, paragraph in enumerate(self.paragraphs)}
+        self._title_to_rows = defaultdict(list)
+        for row, paragraph in enumerate(self.paragraphs):
+            self._title_to_rows[normalize_title(paragraph["title"])].append(row)
+
+    def __len__(self) -> int:
+        return len(self.paragraphs)
+
+    def get_live_rows(self) -> np.ndarray:
+        return np.flatnonzero(self.is_live)
+
+    def contains(self, id_: str) -> bool:
+        # among the live ones.
+        row = self._id_to_row.get(id_)
+        return row is not None and bool(self.is_live[row])
+
+    def with_added(self, paragraphs: List[Dict], embeddings: np.ndarray) -> "Delta":
+        # a re-added id replaces its deleted row (ids are only added if they aren't live).
+        is_live = self.is_live.copy()
+        for paragraph in paragraphs:
+            if paragraph["id"] in self._id_to_row:
+                is_live[self._id_to_row[paragraph["id"]]] = False
+        return Delta(
+            self.paragraphs + list(paragraphs),
+            embeddings if self.embeddings is None else np.concatenate([self.embeddings, embeddings]),
+            np.concatenate([is_live, np.ones(len(paragraphs), dtype=bool)]),
+        )
+
+    def with_deleted(self, ids: Iterable[str]) -> Tuple["Delta", int]:
+        rows = [self._id_to_row[id_] for id_ in ids if self.contains(id_)]
+        if not rows:
+            return self, 0
+        is_live = self.is_live.copy()
+        is_live[rows] = False
+        return Delta(self.paragraphs, self.embeddings, is_live), len(rows)
+
+    def search(
+            self,
+            query_embeddings: np.ndarray,
+            k: int,
+            allowed_titles: Iterable[str] = None,
+        ) -> List[List[Tuple[float, Dict]]]:
+        """
+        Top k (score, paragraph) of the live paragraphs (of the normalized allowed_titles, if
+        given) for each of the queries, best first.
+        """
+        rows = self.get_live_rows()
+        if allowed_titles is not None:
+            title_rows = [row for title in allowed_titles for row in self._title_to_rows.get(title, [])]
+            rows = rows[np.isin(rows, title_rows)]
+        if not len(rows):
+            return [[] for _ in range(len(query_embeddings))]
+        scores = np.asarray(query_embeddings, dtype=np.float32) @ self.embeddings[rows].T
+        results = []
+        for query_scores in scores:
+            top_indices = np.argsort(-query_scores, kind="stable")[:k]
+            results.append([(float(query_scores[index]), self.paragraphs[rows[index]]) for index in top_indices])
+        return results
+
+
+@dataclass(frozen=True)
+class IndexState:
+    """
+    Everything a search reads: the base index, its maps and vectors, the deleted (excluded)
+    base rows and the delta. Updates publish a new one by reference, never change one in place.
+    """
+    index: Any # faiss.Index
+    vectors: Optional[np.ndarray]
+    paragraph_store: Optional[ParagraphStore]
+    row_to_position: Optional[np.ndarray] # None for identity.
+    position_to_row: Optional[np.ndarray] # None for identity.
+    title_index: Optional[TitleRowIndex]
+    docids: Optional[List[str]] = None
+    excluded_rows: Optional[np.ndarray] = None # sorted.
+    delta: Delta = field(default_factory=Delta)
+    # the UpdateLog generation of the base index, and how many of its entries are applied.
+    log_generation: int = 0
+    log_length: int = 0
+
+    def get_num_pending_rows(self) -> int:
+        # what the next compaction folds into the base index.
+        excluded_count = 0 if self.excluded_rows is None else len(self.excluded_rows)
+        return excluded_count + len(self.delta)
+
+    def get_base_rows(self, ids: List[str]) -> np.ndarray:
+        # base index rows of the ids (-1 if they aren't in it).
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        if not len(ids):
+            return rows
+        in_store = self.paragraph_store.contains(ids)
+        if in_store.any():
+            positions = self.paragraph_store.positions_of(np.asarray(ids)[in_store])
+            rows[in_store] = positions if self.position_to_row is None else self.position_to_row[positions]
+        return rows
+
+    def is_live(self, ids: List[str]) -> np.ndarray:
+        rows = self.get_base_rows(ids)
+        is_live = rows >= 0
+        if self.excluded_rows is not None:
+            is_live &= ~np.isin(rows, self.excluded_rows)
+        return is_live | np.array([self.delta.contains(id_) for id_ in ids], dtype=bool)
+
+    def with_added(self, paragraphs: List[Dict], embeddings: np.ndarray) -> "IndexState":
+        return replace(self, delta=self.delta.with_added(paragraphs, embeddings))
+
+    def with_deleted(self, ids: List[str]) -> Tuple["IndexState", int]:
+        # the live added ones are dropped from the delta, the others' base rows are excluded.
+        ids = list(dict.fromkeys(ids))
+        delta, delta_count = self.delta.with_deleted(ids)
+        base_ids = [id_ for id_ in ids if not self.delta.contains(id_)]
+        rows = self.get_base_rows(base_ids)
+        rows = rows[rows >= 0]
+        excluded_rows = self.excluded_rows
+        if excluded_rows is not None:
+            rows = rows[~np.isin(rows, excluded_rows)]
+        rows = np.unique(rows)
+        if len(rows):
+            excluded_rows = rows if excluded_rows is None else np.union1d(excluded_rows, rows)
+        return replace(self, delta=delta, excluded_rows=excluded_rows), delta_count + len(rows)
+
+    def with_update_log(self, update_log: UpdateLog) -> "IndexState":
+        # with the entries of the (same generation) log that aren't applied yet.
+        assert update_log.generation == self.log_generation, "The base index is of another generation of the log."
+        state = self
+        for operation, value in update_log.read(self.log_length):
+            if operation == "add":
+                state = state.with_added(*value)
+            else:
+                state, _ = state.with_deleted(value)
+        return replace(state, log_length=len(update_log))
+
+
+def sync_state(state: IndexState, update_log: UpdateLog, load_state: Callable[[], IndexState]) -> IndexState:
+    """
+    state brought up to date with the update log, which any process may have appended to or
+    compacted (then load_state reloads the base index of the new generation). Under update_log.lock().
+    """
+    update_log.reload()
+    if update_log.generation != state.log_generation:
+        state = load_state()
+    return state.with_update_log(update_log)
+
+
+class BackgroundCompactor:
+    """
+    Runs compact in a background thread (one at a time) when asked to with a tombstone ratio
+    over the threshold.
+    """
+
+    def __init__(self, compact: Callable[[], None], tombstone_ratio: float = DEFAULT_COMPACTION_TOMBSTONE_RATIO):
+        self._compact = compact
+        self._tombstone_ratio = tombstone_ratio
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def maybe_start(self, tombstone_ratio: float) -> bool:
+        if tombstone_ratio <= self._tombstone_ratio:
+            return False
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            print(f"Tombstone ratio {tombstone_ratio:.3f} > {self._tombstone_ratio}, compacting in the background.")
+            self._thread = threading.Thread(target=self._compact, daemon=True)
+            self._thread.start()
+        return True
+
+    def wait(self) -> None:
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
+def merge_retrievals(retrievals: List[List[Dict]], max_hits_count: int) -> List[Dict]:
+    # the top max_hits_count by score of the base and delta retrievals of a query.
+    merged = [retrieval_ for retrieval in retrievals for retrieval_ in retrieval]
+    return sorted(merged, key=lambda retrieval_: retrieval_["score"], reverse=True)[:max_hits_count]
+
+
+def read_update_paragraphs(filepath: str) -> List[Dict]:
+    with open(filepath, "r") as file:
+        paragraphs = [json.loads(line) for line in file if line.strip()]
+    for paragraph in paragraphs:
+        assert "id" in paragraph and "title" in paragraph and "paragraph_text" in paragraph, \
+            "Added paragraphs need an id, title and paragraph_text."
+        paragraph["id"] = str(paragraph["id"])
+    return paragraphs
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Incrementally update a dense retriever index.")
+    parser.add_argument("retriever", help="retriever of the index", type=str, choices=("contriever", "dpr"))
+    parser.add_argument("corpus_name", help="corpus name", type=str)
+    parser.add_argument("--add", help="jsonl file of the paragraphs to add", type=str, default=None)
+    parser.add_argument("--delete", help="file of the paragraph ids to delete, one per line", type=str, default=None)
+    parser.add_argument("--compact", help="compact now, regardless of the tombstone ratio",
+                        action="store_true", default=False)
+    parser.add_argument("--tombstone-ratio", help="compact once this fraction of the rows are deleted or added",
+                        type=float, default=DEFAULT_COMPACTION_TOMBSTONE_RATIO)
+    parser.add_argument("--device", help="device to encode the added paragraphs on", type=str, default="cpu")
+    args = parser.parse_args()
+
+    if args.retriever == "contriever":
+        from contriever_retriever import ContrieverRetriever
+        retriever = ContrieverRetriever(
+            corpus_name=args.corpus_name, device=args.device, compaction_tombstone_ratio=args.tombstone_ratio
+        )
+    else:
+        from dpr_retriever import DprRetriever
+        retriever = DprRetriever(
+            corpus_name=args.corpus_name, index_type="flat", device=args.device,
+            compaction_tombstone_ratio=args.tombstone_ratio,
+        )
+
+    if args.add:
+        paragraphs = read_update_paragraphs(args.add)
+        print(f"Added {retriever.add_paragraphs(paragraphs)} paragraphs.")
+
+    if args.delete:
+        with open(args.delete, "r") as file:
+            ids = [line.strip() for line in file if line.strip()]
+        print(f"Deleted {retriever.delete_paragraphs(ids)} paragraphs.")
+
+    if args.compact:
+        retriever.compact()
+    retriever.wait_for_compaction() # the background compaction, if it was started by the updates.
+
+
+if __name__ == "__main__":
+    main()
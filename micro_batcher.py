@@ -0,0 +1,81 @@
+"""
+Coalesces the individual requests that arrive close together into batches.
+
+Retrievers like DPR are much faster per query when many queries are encoded and searched
+together, but /retrieve/ requests come one at a time. The MicroBatcher holds each submitted
+request for at most max_wait_seconds (or until max_batch_size requests are waiting), then
+runs all of them with one call of process_batch and hands each request its own result.
+"""
+
+from typing import List, Any, Callable, Awaitable, Tuple
+import asyncio
+
+
+class MicroBatcher:
+
+    def __init__(
+            self,
+            process_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+            max_batch_size: int = 64,
+            max_wait_seconds: float = 0.005,
+        ):
+        assert max_batch_size > 0, "max_batch_size of the micro batcher must be positive."
+        assert max_wait_seconds >= 0, "max_wait_seconds of the micro batcher can't be negative."
+        self._process_batch = process_batch
+        self._max_batch_size = max_batch_size
+        self._max_wait_seconds = max_wait_seconds
+        # Only touched from the event loop, so there's no need of a lock.
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._flush_handle = None
+        # the running batches, as the event loop only keeps weak references to tasks.
+        self._tasks = set()
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._max_wait_seconds, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if pending:
+            task = asyncio.ensure_future(self._run(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pending: List[Tuple[Any, asyncio.Future]]) -> None:
+        try:
+            results = await self._process_batch([item for item, _ in pending])
+        except Exception as exception:
+            if len(pending) == 1:
+                self._set_exception(pending[0][1], exception)
+                return
+            # One bad request shouldn't fail the others batched with it, so they are run one
+            # by one, and only the failing ones get their exception.
+            for item, future in pending:
+                try:
+                    result = (await self._process_batch([item]))[0]
+                except Exception as item_exception:
+                    self._set_exception(future, item_exception)
+                else:
+                    self._set_result(future, result)
+            return
+        for (_, future), result in zip(pending, results):
+            self._set_result(future, result)
+
+    @staticmethod
+    def _set_result(future: asyncio.Future, result: Any) -> None:
+        if not future.done(): # e.g., the request was cancelled by a disconnect.
+            future.set_result(result)
+
+    @staticmethod
+    def _set_exception(future: asyncio.Future, exception: Exception) -> None:
+        if not future.done():
+            future.set_exception(exception)
@@ -0,0 +1,267 @@
+"""
+Compact, memory-mapped store of the paragraphs of a corpus, for recovering the texts of the
+dense retrieval hits without a Lucene index (and the JVM) in the query path.
+
+A store directory has:
+    texts.bin: utf-8 title and paragraph_text of all paragraphs, back to back.
+    offsets.npy: (num_paragraphs, 3) int64 of [title start, title end/paragraph_text start, paragraph_text end] in texts.bin.
+    paragraph_indices.npy: (num_paragraphs,) int32.
+    word_counts.npy: (num_paragraphs,) int32 of the (whitespace) words in paragraph_text, for min-words filters.
+    ids.npy: (num_paragraphs,) fixed width bytes of the paragraph (doc) ids.
+    sorted_ids.npy, sorted_id_positions.npy: ids.npy sorted and their positions, for lookups by id.
+
+Everything is memory-mapped, so loading is instant, and the pages are shared between processes.
+
+TitleRowIndex is the (CSR) map from titles to the index rows of their paragraphs, for title
+restricted searches.
+"""
+
+from typing import List, Dict, Iterable, Union
+import hashlib
+import mmap
+import os
+
+import numpy as np
+
+
+TEXTS_FILE_NAME = "texts.bin"
+OFFSETS_FILE_NAME = "offsets.npy"
+PARAGRAPH_INDICES_FILE_NAME = "paragraph_indices.npy"
+IDS_FILE_NAME = "ids.npy"
+SORTED_IDS_FILE_NAME = "sorted_ids.npy"
+SORTED_ID_POSITIONS_FILE_NAME = "sorted_id_positions.npy"
+WORD_COUNTS_FILE_NAME = "word_counts.npy"
+
+TITLE_HASHES_FILE_NAME = "title_hashes.npy"
+TITLE_OFFSETS_FILE_NAME = "title_offsets.npy"
+TITLE_ROWS_FILE_NAME = "title_rows.npy"
+
+
+def build_paragraph_store(paragraphs: Iterable[Dict], output_directory: str) -> int:
+    """
+    Writes the store of paragraphs (dicts with id, title, paragraph_text and paragraph_index)
+    to output_directory, in the given order, i.e., position i is the i-th paragraph. Returns
+    the number of paragraphs written.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+
+    offsets, paragraph_indices, ids, word_counts = [], [], [], []
+    position = 0
+    with open(os.path.join(output_directory, TEXTS_FILE_NAME), "wb") as file:
+        for paragraph in paragraphs:
+            title = paragraph["title"].encode("utf-8")
+            paragraph_text = paragraph["paragraph_text"].encode("utf-8")
+            file.write(title)
+            file.write(paragraph_text)
+            offsets.append((position, position + len(title), position + len(title) + len(paragraph_text)))
+            position += len(title) + len(paragraph_text)
+            paragraph_indices.append(paragraph["paragraph_index"])
+            ids.append(paragraph["id"].encode("utf-8"))
+            word_counts.append(len(paragraph["paragraph_text"].split()))
+
+    ids = np.array(ids, dtype=bytes)
+    np.save(os.path.join(output_directory, OFFSETS_FILE_NAME), np.array(offsets, dtype=np.int64).reshape(-1, 3))
+    np.save(os.path.join(output_directory, PARAGRAPH_INDICES_FILE_NAME), np.array(paragraph_indices, dtype=np.int32))
+    np.save(os.path.join(output_directory, IDS_FILE_NAME), ids)
+    np.save(os.path.join(output_directory, WORD_COUNTS_FILE_NAME), np.array(word_counts, dtype=np.int32))
+    sorted_id_positions = np.argsort(ids, kind="stable")
+    np.save(os.path.join(output_directory, SORTED_IDS_FILE_NAME), ids[sorted_id_positions])
+    np.save(os.path.join(output_directory, SORTED_ID_POSITIONS_FILE_NAME), sorted_id_positions)
+    return len(ids)
+
+
+def _save_array(filepath: str, array: np.ndarray) -> None:
+    # replaced (not overwritten in place), as the old file may be memory-mapped by an open store.
+    with open(filepath + ".tmp", "wb") as file:
+        np.save(file, array)
+    os.replace(filepath + ".tmp", filepath)
+
+
+class ParagraphStore:
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        texts_path = os.path.join(directory, TEXTS_FILE_NAME)
+        self._texts_file = open(texts_path, "rb")
+        # mmap can't map empty files.
+        self._texts = (
+            mmap.mmap(self._texts_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if os.path.getsize(texts_path) else b""
+        )
+        self._offsets = np.load(os.path.join(directory, OFFSETS_FILE_NAME), mmap_mode="r")
+        self._paragraph_indices = np.load(os.path.join(directory, PARAGRAPH_INDICES_FILE_NAME), mmap_mode="r")
+        self._ids = np.load(os.path.join(directory, IDS_FILE_NAME), mmap_mode="r")
+        self._sorted_ids = np.load(os.path.join(directory, SORTED_IDS_FILE_NAME), mmap_mode="r")
+        self._sorted_id_positions = np.load(os.path.join(directory, SORTED_ID_POSITIONS_FILE_NAME), mmap_mode="r")
+        # stores built before word counts were added don't have them.
+        word_counts_path = os.path.join(directory, WORD_COUNTS_FILE_NAME)
+        self._word_counts = np.load(word_counts_path, mmap_mode="r") if os.path.exists(word_counts_path) else None
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return all(
+            os.path.exists(os.path.join(directory, file_name))
+            for file_name in (
+                TEXTS_FILE_NAME, OFFSETS_FILE_NAME, PARAGRAPH_INDICES_FILE_NAME,
+                IDS_FILE_NAME, SORTED_IDS_FILE_NAME, SORTED_ID_POSITIONS_FILE_NAME
+            )
+        )
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def get(self, position: int) -> Dict:
+        title_start, text_start, text_end = self._offsets[position]
+        return {
+            "id": self._ids[position].decode("utf-8"),
+            "title": self._texts[title_start:text_start].decode("utf-8"),
+            "paragraph_text": self._texts[text_start:text_end].decode("utf-8"),
+            "paragraph_index": int(self._paragraph_indices[position]),
+        }
+
+    def get_many(self, positions: Union[Iterable[int], np.ndarray]) -> List[Dict]:
+        # The offsets, ids and paragraph indices of all positions are gathered with one fancy index
+        # each (and converted to python values at once), so only the text slicing and decoding is per row.
+        if not isinstance(positions, np.ndarray):
+            positions = list(positions)
+        positions = np.asarray(positions, dtype=np.int64)
+        if not len(positions):
+            return []
+        offsets = self._offsets[positions].tolist()
+        ids = self._ids[positions].tolist()
+        paragraph_indices = self._paragraph_indices[positions].tolist()
+        texts = self._texts
+        return [
+            {
+                "id": id_.decode("utf-8"),
+                "title": texts[title_start:text_start].decode("utf-8"),
+                "paragraph_text": texts[text_start:text_end].decode("utf-8"),
+                "paragraph_index": paragraph_index,
+            }
+            for (title_start, text_start, text_end), id_, paragraph_index in zip(offsets, ids, paragraph_indices)
+        ]
+
+    def get_title(self, position: int) -> str:
+        title_start, text_start, _ = self._offsets[position]
+        return self._texts[title_start:text_start].decode("utf-8")
+
+    def get_word_counts(self, positions: Union[List[int], np.ndarray]) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.int64)
+        if self._word_counts is not None:
+            return np.asarray(self._word_counts[positions], dtype=np.int32)
+        return np.array(
+            [len(self.get(position)["paragraph_text"].split()) for position in positions], dtype=np.int32
+        )
+
+    def positions_of(self, ids: Union[List[str], np.ndarray]) -> np.ndarray:
+        """
+        Positions of the given paragraph ids in the store (binary search over the sorted ids).
+        Raises KeyError if any of them isn't in the store.
+        """
+        ids = np.asarray([id_.encode("utf-8") if isinstance(id_, str) else id_ for id_ in ids], dtype=bytes)
+        if not len(self._sorted_ids):
+            raise KeyError(f"The store {self._directory} is empty.")
+        indices = np.searchsorted(self._sorted_ids, ids)
+        indices = np.minimum(indices, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[indices] == ids
+        if not np.all(found):
+            missing_ids = ids[~found][:5]
+            raise KeyError(f"Paragraph ids not found in the store {self._directory}: {missing_ids}")
+        return np.asarray(self._sorted_id_positions[indices], dtype=np.int64)
+
+    def contains(self, ids: Union[List[str], np.ndarray]) -> np.ndarray:
+        # bool array of which of the ids are in the store.
+        ids = np.asarray([id_.encode("utf-8") if isinstance(id_, str) else id_ for id_ in ids], dtype=bytes)
+        if not len(self._sorted_ids) or not len(ids):
+            return np.zeros(len(ids), dtype=bool)
+        indices = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self._sorted_ids) - 1)
+        return self._sorted_ids[indices] == ids
+
+    def get_by_id(self, id_: str) -> Dict:
+        return self.get(int(self.positions_of([id_])[0]))
+
+    def close(self) -> None:
+        if isinstance(self._texts, mmap.mmap):
+            self._texts.close()
+        self._texts_file.close()
+
+
+def normalize_title(title: str) -> str:
+    return title.strip().lower().replace(" ", "")
+
+
+def hash_title(title: str) -> int:
+    return int.from_bytes(hashlib.blake2b(title.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class TitleRowIndex:
+    """
+    Title -> rows map in CSR form: the sorted (64-bit) hashes of the distinct titles, and, for the
+    i-th of them, its rows in rows[offsets[i]:offsets[i+1]] (ascending). Lookups are a binary
+    search and a slice (no copy), instead of a dict of python lists.
+
+    Titles are only kept as hashes, so (very unlikely) colliding titles share their rows:
+    results have to be checked against the actual titles anyway.
+    """
+
+    def __init__(self, title_hashes: np.ndarray, offsets: np.ndarray, rows: np.ndarray):
+        assert len(offsets) == len(title_hashes) + 1
+        self._title_hashes = title_hashes
+        self._offsets = offsets
+        self._rows = rows
+
+    @classmethod
+    def build(cls, row_titles: Iterable[str]) -> "TitleRowIndex":
+        # row_titles: the (already normalized) title of each row, in row order.
+        return cls.from_row_title_hashes(
+            np.fromiter((hash_title(title) for title in row_titles), dtype=np.uint64)
+        )
+
+    @classmethod
+    def from_row_title_hashes(cls, row_title_hashes: np.ndarray) -> "TitleRowIndex":
+        rows = np.argsort(row_title_hashes, kind="stable").astype(np.int64)
+        title_hashes, counts = np.unique(row_title_hashes[rows], return_counts=True)
+        offsets = np.zeros(len(title_hashes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(title_hashes, offsets, rows)
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return all(
+            os.path.exists(os.path.join(directory, file_name))
+            for file_name in (TITLE_HASHES_FILE_NAME, TITLE_OFFSETS_FILE_NAME, TITLE_ROWS_FILE_NAME)
+        )
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        _save_array(os.path.join(directory, TITLE_HASHES_FILE_NAME), np.asarray(self._title_hashes))
+        _save_array(os.path.join(directory, TITLE_OFFSETS_FILE_NAME), np.asarray(self._offsets))
+        _save_array(os.path.join(directory, TITLE_ROWS_FILE_NAME), np.asarray(self._rows))
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "TitleRowIndex":
+        mmap_mode = "r" if mmap else None
+        return cls(
+            np.load(os.path.join(directory, TITLE_HASHES_FILE_NAME), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, TITLE_OFFSETS_FILE_NAME), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, TITLE_ROWS_FILE_NAME), mmap_mode=mmap_mode),
+        )
+
+    def __len__(self) -> int:
+        return len(self._title_hashes)
+
+    def get_rows(self, title: str) -> np.ndarray:
+        if not len(self._title_hashes):
+            return self._rows[:0]
+        title_hash = np.uint64(hash_title(title))
+        index = int(np.searchsorted(self._title_hashes, title_hash))
+        if index == len(self._title_hashes) or self._title_hashes[index] != title_hash:
+            return self._rows[:0]
+        return self._rows[self._offsets[index]:self._offsets[index + 1]]
+
+    def get_rows_of_titles(self, titles: Iterable[str]) -> np.ndarray:
+        # a single title is just its slice, several are concatenated (duplicate titles only once).
+        rows_list = [self.get_rows(title) for title in dict.fromkeys(titles)]
+        if len(rows_list) == 1:
+            return rows_list[0]
+        return np.concatenate(rows_list) if rows_list else self._rows[:0]
@@ -0,0 +1,114 @@
+"""
+Caches query embeddings of the dense retrievers (DPR, Contriever), so that repeated query texts
+(retries, different max_hits_count or allowed_titles for the same question, etc.) only pay for
+the index search and not for the encoder forward pass.
+"""
+
+from typing import List, Dict, Callable, Optional, Tuple
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+
+def normalize_query_text(query_text: str) -> str:
+    # The (BERT) tokenizers split on whitespace anyway, so this doesn't change the embedding.
+    return " ".join(query_text.split())
+
+
+class QueryEmbeddingCache:
+    """
+    LRU cache of query embeddings keyed on (model_id, normalized query text). It's bounded by
+    the memory of the stored vectors (max_size_mb), which can be kept as float16 to fit twice
+    as many. Embeddings are always handed out as float32.
+    """
+
+    def __init__(self, model_id: str, max_size_mb: float = 64, dtype: str = "float32"):
+        assert max_size_mb > 0, "max_size_mb of the query embedding cache must be positive."
+        assert dtype in ("float32", "float16"), "dtype of the query embedding cache must be float32 or float16."
+        self._model_id = model_id
+        self._max_size_bytes = int(max_size_mb * 1024**2)
+        self._dtype = np.dtype(dtype)
+        self._entries: Dict[Tuple[str, str], np.ndarray] = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _make_key(self, query_text: str) -> Tuple[str, str]:
+        return (self._model_id, normalize_query_text(query_text))
+
+    def get(self, query_text: str) -> Optional[np.ndarray]:
+        key = self._make_key(query_text)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return embedding.astype(np.float32)
+
+    def put(self, query_text: str, embedding: np.ndarray) -> None:
+        key = self._make_key(query_text)
+        embedding = np.array(embedding, dtype=self._dtype) # copy, so the batch array can be freed.
+        with self._lock:
+            previous_embedding = self._entries.pop(key, None)
+            if previous_embedding is not None:
+                self._size_bytes -= previous_embedding.nbytes
+            self._entries[key] = embedding
+            self._size_bytes += embedding.nbytes
+            while self._size_bytes > self._max_size_bytes and self._entries:
+                _, evicted_embedding = self._entries.popitem(last=False)
+                self._size_bytes -= evicted_embedding.nbytes
+                self.evictions += 1
+
+    def encode(
+            self,
+            query_texts: List[str],
+            encode_function: Callable[[List[str]], np.ndarray],
+        ) -> np.ndarray:
+        """
+        Embeddings of all query_texts (as a float32 matrix), where only the ones missing from the
+        cache are encoded, together in one encode_function call, and then cached.
+        """
+        embeddings = [self.get(query_text) for query_text in query_texts]
+
+        # same (normalized) texts in a batch are encoded only once.
+        missing_text_to_indices = OrderedDict()
+        for index, (query_text, embedding) in enumerate(zip(query_texts, embeddings)):
+            if embedding is None:
+                missing_text_to_indices.setdefault(normalize_query_text(query_text), []).append(index)
+
+        if missing_text_to_indices:
+            missing_texts = [query_texts[indices[0]] for indices in missing_text_to_indices.values()]
+            missing_embeddings = np.asarray(encode_function(missing_texts), dtype=np.float32)
+            for query_text, indices, embedding in zip(
+                missing_texts, missing_text_to_indices.values(), missing_embeddings
+            ):
+                self.put(query_text, embedding)
+                for index in indices:
+                    embeddings[index] = embedding
+
+        return np.stack(embeddings).astype(np.float32, copy=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size_bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "model_id": self._model_id,
+                "size": len(self._entries),
+                "size_bytes": self._size_bytes,
+                "max_size_bytes": self._max_size_bytes,
+                "dtype": self._dtype.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
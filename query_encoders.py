@@ -0,0 +1,234 @@
+"""
+Faster CPU backends for the query encoders of the dense retrievers (DPR, Contriever):
+
+    torch: the original fp32 model.
+    int8: the model with its Linear layers dynamically quantized to int8.
+    onnx: the model exported to ONNX and run with onnxruntime, which is an optional dependency
+        (pip install onnxruntime), only imported when this backend is loaded.
+
+The backend models are called like the original torch models (same inputs, same outputs),
+so the retrievers keep their tokenizers and encoding code. As they are approximations,
+check_parity should be run against the fp32 embeddings when a backend is loaded.
+"""
+
+from typing import Callable, Optional
+import tempfile
+import hashlib
+import glob
+import os
+
+import numpy as np
+import torch
+
+from startup_cache import file_lock
+
+
+ENCODER_BACKENDS = ("torch", "int8", "onnx")
+
+ONNX_CACHE_PATH = os.path.expanduser("~/.cache/retriever_query_encoders")
+
+PARITY_CHECK_QUERIES = [
+    "who was the first president of the united states",
+    "In which year did the Berlin Wall fall?",
+    "Computer vision is an interdisciplinary field",
+    "what is the capital city of the country where the eiffel tower is located",
+]
+
+
+def quantize_int8(model: torch.nn.Module) -> torch.nn.Module:
+    # Only the Linear layers (nearly all the compute of a BERT encoder) are quantized.
+    model = model.to("cpu").eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class _ExportWrapper(torch.nn.Module):
+    # Makes the model take (input_ids, attention_mask) positionally and return a single tensor.
+
+    def __init__(self, model: torch.nn.Module, get_output: Callable):
+        super().__init__()
+        self.model = model
+        self._get_output = get_output
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self._get_output(self.model(input_ids=input_ids, attention_mask=attention_mask))
+
+
+def get_model_fingerprint(model_name_or_path: str, model: torch.nn.Module) -> str:
+    """
+    Fingerprint of the model weights, so that an export isn't reused after the model changes.
+    A local model (file or directory) is fingerprinted by the paths, sizes and mtimes of its
+    files, which is instant. A hub model name is resolved by transformers to files it caches
+    wherever its version keeps them, so its loaded weights are hashed instead.
+    """
+    hasher = hashlib.blake2b(digest_size=8)
+    if os.path.exists(model_name_or_path):
+        if os.path.isdir(model_name_or_path):
+            filepaths = sorted(
+                os.path.join(directory, file_name)
+                for directory, _, file_names in os.walk(model_name_or_path) for file_name in file_names
+            )
+        else:
+            filepaths = [model_name_or_path]
+        for filepath in filepaths:
+            stat = os.stat(filepath)
+            relative_path = os.path.relpath(filepath, model_name_or_path)
+            hasher.update(f"{relative_path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    else:
+        for name, tensor in sorted(model.state_dict().items()):
+            hasher.update(name.encode("utf-8"))
+            hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def _get_onnx_path_prefix(model_name_or_path: str) -> str:
+    return os.path.join(ONNX_CACHE_PATH, model_name_or_path.strip("/").replace("/", "--"))
+
+
+def get_onnx_path(model_name_or_path: str, fingerprint: str) -> str:
+    return _get_onnx_path_prefix(model_name_or_path) + f".{fingerprint}.onnx"
+
+
+def _remove_outdated_onnx_exports(model_name_or_path: str, onnx_path: str) -> None:
+    # the exports of the model with other fingerprints, i.e., prefix.{fingerprint}.onnx.
+    prefix = _get_onnx_path_prefix(model_name_or_path)
+    for outdated_onnx_path in glob.glob(glob.escape(prefix) + ".*.onnx"):
+        fingerprint = outdated_onnx_path[len(prefix) + 1:-len(".onnx")]
+        if outdated_onnx_path != onnx_path and "." not in fingerprint:
+            os.remove(outdated_onnx_path)
+
+
+def export_onnx(
+        model: torch.nn.Module,
+        tokenizer,
+        onnx_path: str,
+        get_output: Callable = lambda output: output,
+    ) -> None:
+    """
+    Exports the model (with get_output picking the embedding tensor from its output) to onnx_path,
+    with dynamic batch and sequence lengths.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    inputs = tokenizer(PARITY_CHECK_QUERIES[:2], padding=True, return_tensors="pt")
+    wrapper = _ExportWrapper(model.to("cpu").eval(), get_output)
+    dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}}
+    # write to a unique temporary path first, so that a failed (or concurrent) export isn't picked up.
+    file_descriptor, temporary_onnx_path = tempfile.mkstemp(
+        prefix=os.path.basename(onnx_path) + ".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(onnx_path))
+    )
+    os.close(file_descriptor)
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                wrapper,
+                (inputs["input_ids"], inputs["attention_mask"]),
+                temporary_onnx_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["embeddings"],
+                dynamic_axes={**dynamic_axes, "embeddings": {0: "batch"}},
+                opset_version=13,
+            )
+        os.replace(temporary_onnx_path, onnx_path)
+    finally:
+        if os.path.exists(temporary_onnx_path):
+            os.remove(temporary_onnx_path)
+
+
+class OnnxModel:
+    """
+    Runs an onnx export (see export_onnx) with onnxruntime. Called with the same tensors as
+    the torch model, and returns make_output(embeddings tensor).
+    """
+
+    def __init__(
+            self,
+            onnx_path: str,
+            make_output: Callable = lambda embeddings: embeddings,
+            num_threads: Optional[int] = None,
+        ):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise Exception("The onnx encoder backend needs onnxruntime (pip install onnxruntime).")
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+        self._session = onnxruntime.InferenceSession(
+            onnx_path, session_options, providers=["CPUExecutionProvider"]
+        )
+        self._make_output = make_output
+
+    def eval(self) -> "OnnxModel":
+        return self
+
+    def to(self, device) -> "OnnxModel":
+        assert str(device) == "cpu", "The onnx encoder backend only runs on cpu."
+        return self
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor = None, **inputs):
+        # other inputs (e.g., token_type_ids, which are all 0 for queries) aren't in the export.
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        feeds = {
+            "input_ids": input_ids.cpu().numpy().astype(np.int64),
+            "attention_mask": attention_mask.cpu().numpy().astype(np.int64),
+        }
+        embeddings = self._session.run(["embeddings"], feeds)[0]
+        return self._make_output(torch.from_numpy(embeddings))
+
+
+def load_backend_model(
+        model: torch.nn.Module,
+        tokenizer,
+        encoder_backend: str,
+        model_name_or_path: str,
+        get_output: Callable = lambda output: output,
+        make_output: Callable = lambda embeddings: embeddings,
+        num_threads: Optional[int] = None,
+    ):
+    """
+    Returns the encoder_backend version of the (fp32 torch) model. For onnx, the export is
+    cached (by model_name_or_path and get_model_fingerprint) in ONNX_CACHE_PATH, and the exports
+    of earlier versions of the model are removed. get_output/make_output are to take
+    the embeddings out of / put them back in the output of the torch model.
+    """
+    assert encoder_backend in ENCODER_BACKENDS, f"Unknown encoder_backend {encoder_backend}."
+    if encoder_backend == "torch":
+        return model
+    if encoder_backend == "int8":
+        return quantize_int8(model)
+    onnx_path = get_onnx_path(model_name_or_path, get_model_fingerprint(model_name_or_path, model))
+    if not os.path.exists(onnx_path):
+        # workers starting together export it once: the others wait, then find it exported.
+        # The lock is per model (not per fingerprint), as the outdated exports are removed under it.
+        with file_lock(_get_onnx_path_prefix(model_name_or_path) + ".lock"):
+            if not os.path.exists(onnx_path):
+                print(f"Exporting the query encoder to {onnx_path}")
+                export_onnx(model, tokenizer, onnx_path, get_output)
+                _remove_outdated_onnx_exports(model_name_or_path, onnx_path)
+    return OnnxModel(onnx_path, make_output, num_threads=num_threads)
+
+
+def check_parity(
+        reference_embeddings: np.ndarray,
+        embeddings: np.ndarray,
+        min_cosine_similarity: float = 0.99,
+    ) -> float:
+    """
+    Checks that the embeddings of a backend are close to the fp32 (reference) ones of the same
+    queries, and returns the smallest cosine similarity among them.
+    """
+    reference_embeddings = np.asarray(reference_embeddings, dtype=np.float32)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    assert reference_embeddings.shape == embeddings.shape, \
+        f"Mismatching embedding shapes ({reference_embeddings.shape} != {embeddings.shape})"
+    cosine_similarities = (reference_embeddings * embeddings).sum(axis=1) / (
+        np.linalg.norm(reference_embeddings, axis=1) * np.linalg.norm(embeddings, axis=1)
+    )
+    min_cosine_similarity_ = float(cosine_similarities.min())
+    if min_cosine_similarity_ < min_cosine_similarity:
+        raise Exception(
+            f"The query encoder backend doesn't match the fp32 encoder: cosine similarity "
+            f"{min_cosine_similarity_:.4f} < {min_cosine_similarity}."
+        )
+    return min_cosine_similarity_
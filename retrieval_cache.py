@@ -0,0 +1,281 @@
+"""
+Caches retrieval results in front of UnifiedRetriever methods.
+
+There are two tiers, configured with the result_cache and disk_cache entries of
+.retriever_config.jsonnet, e.g.:
+
+    "result_cache": {"max_size": 100000, "ttl_seconds": 86400},
+    "disk_cache": {"path": "~/.retriever_cache/retrievals.sqlite", "max_size_gb": 10, "index_version": "v1"},
+
+The in-memory tier is per process. The disk tier is an SQLite file (in WAL mode) and so
+it survives server restarts and is shared by all the uvicorn workers using the same path.
+"""
+
+from typing import List, Dict, Tuple, Any, Optional, Hashable
+from collections import OrderedDict
+from functools import lru_cache
+import threading
+import hashlib
+import sqlite3
+import inspect
+import json
+import time
+import copy
+import os
+
+from unified_retriever import UnifiedRetriever
+
+
+# Arguments whose order doesn't change the retrieval, so they are sorted in the cache key.
+UNORDERED_ARGUMENTS = ("allowed_titles", "allowed_paragraph_types", "skip_blink_titles", "fields")
+
+
+@lru_cache(maxsize=None)
+def _get_signature(retrieval_method: str) -> inspect.Signature:
+    return inspect.signature(getattr(UnifiedRetriever, retrieval_method))
+
+
+def _make_hashable(value: Any) -> Hashable:
+    if isinstance(value, dict):
+        return tuple(sorted((key, _make_hashable(value_)) for key, value_ in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_make_hashable(value_) for value_ in value)
+    return value
+
+
+def make_cache_key(retrieval_method: str, arguments: Dict) -> Tuple:
+    """
+    Canonical key of a retrieval: the method name followed by all of its arguments (defaults
+    filled in) in signature order, with unordered list arguments sorted. So, e.g., leaving out
+    max_hits_count and passing its default value give the same key.
+    """
+    bound_arguments = _get_signature(retrieval_method).bind(None, **arguments)
+    bound_arguments.apply_defaults()
+    key = [retrieval_method]
+    for name, value in list(bound_arguments.arguments.items())[1:]: # skip self
+        if name in UNORDERED_ARGUMENTS and value is not None:
+            value = sorted(value)
+        key.append((name, _make_hashable(value)))
+    return tuple(key)
+
+
+class RetrievalCache:
+    """
+    In-memory LRU cache of retrievals with an optional TTL. Holds at most max_size entries
+    and hands out deep copies, as callers (and the retrievers themselves) mutate the result dicts.
+    """
+
+    def __init__(self, max_size: int = 100000, ttl_seconds: float = None):
+        assert max_size > 0, "max_size of the cache must be positive."
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # key -> (insertion_time, retrieval)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Tuple) -> Optional[List[Dict]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._ttl_seconds is not None:
+                if time.monotonic() - entry[0] > self._ttl_seconds:
+                    del self._entries[key]
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            retrieval = entry[1]
+        return copy.deepcopy(retrieval)
+
+    def put(self, key: Tuple, retrieval: List[Dict]) -> None:
+        retrieval = copy.deepcopy(retrieval)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), retrieval)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self._max_size,
+                "ttl_seconds": self._ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class DiskRetrievalCache:
+    """
+    SQLite backed cache of retrievals with size-based (least recently used first) eviction.
+
+    The keys also include a namespace made from the retriever init args (corpus/dataset names,
+    index types, model paths) and a user given index_version, which should be bumped whenever
+    an index is rebuilt, so that stale retrievals are never served. Incremental updates don't
+    need it, the keys of the RetrievalExecutor have the version of their update log.
+    """
+
+    # The total size is checked (and maybe evicted) once every these many puts.
+    EVICTION_CHECK_INTERVAL = 100
+
+    # A hit only writes its last_access if the stored one is older than this, so that reads
+    # mostly don't take the (cross-process) SQLite write lock. LRU order is only this coarse.
+    LAST_ACCESS_UPDATE_INTERVAL_SECONDS = 60
+
+    def __init__(
+            self,
+            path: str,
+            retriever_init_args: Dict,
+            max_size_gb: float = 10,
+            index_version: str = "",
+        ):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._path = path
+        self._max_size_bytes = int(max_size_gb * 1024**3)
+        self._namespace = json.dumps(
+            {"retriever_init_args": retriever_init_args, "index_version": index_version},
+            sort_keys=True
+        )
+        self._lock = threading.Lock()
+        self._puts_since_eviction_check = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS retrievals ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS retrievals_last_access ON retrievals (last_access)"
+        )
+        self._connection.commit()
+
+    def _hash_key(self, key: Tuple) -> str:
+        key_str = json.dumps([self._namespace, key], default=str)
+        return hashlib.blake2b(key_str.encode("utf-8"), digest_size=20).hexdigest()
+
+    def get(self, key: Tuple) -> Optional[List[Dict]]:
+        hashed_key = self._hash_key(key)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, last_access FROM retrievals WHERE key = ?", (hashed_key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            now = time.time()
+            if now - row[1] > self.LAST_ACCESS_UPDATE_INTERVAL_SECONDS:
+                self._connection.execute(
+                    "UPDATE retrievals SET last_access = ? WHERE key = ?", (now, hashed_key)
+                )
+                self._connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: Tuple, retrieval: List[Dict]) -> None:
+        hashed_key = self._hash_key(key)
+        value = json.dumps(retrieval)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO retrievals (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (hashed_key, value, len(value), time.time())
+            )
+            self._connection.commit()
+            self._puts_since_eviction_check += 1
+            if self._puts_since_eviction_check >= self.EVICTION_CHECK_INTERVAL:
+                self._puts_since_eviction_check = 0
+                self._evict()
+
+    def _size_bytes(self) -> int:
+        return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM retrievals").fetchone()[0]
+
+    def _evict(self) -> None:
+        # Evict down to 90% of the max size, so that it doesn't trigger again right away.
+        total_size = self._size_bytes()
+        if total_size <= self._max_size_bytes:
+            return
+        target_size = int(self._max_size_bytes * 0.9)
+        while total_size > target_size:
+            rows = self._connection.execute(
+                "SELECT key, size FROM retrievals ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                break
+            evicted_keys = []
+            for key, size in rows:
+                if total_size <= target_size:
+                    break
+                evicted_keys.append((key,))
+                total_size -= size
+            self._connection.executemany("DELETE FROM retrievals WHERE key = ?", evicted_keys)
+            self._connection.commit()
+            self.evictions += len(evicted_keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM retrievals")
+            self._connection.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            size, size_bytes = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM retrievals"
+            ).fetchone()
+            return {
+                "path": self._path,
+                "size": size,
+                "size_bytes": size_bytes,
+                "max_size_bytes": self._max_size_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class TieredRetrievalCache:
+    """
+    Looks up the caches in order (e.g., memory then disk), and on a hit, fills the earlier
+    tiers that missed. Puts go to all tiers.
+    """
+
+    def __init__(self, caches: List):
+        self._caches = caches
+
+    def get(self, key: Tuple) -> Optional[List[Dict]]:
+        for index, cache in enumerate(self._caches):
+            retrieval = cache.get(key)
+            if retrieval is not None:
+                for earlier_cache in self._caches[:index]:
+                    earlier_cache.put(key, retrieval)
+                return retrieval
+        return None
+
+    def put(self, key: Tuple, retrieval: List[Dict]) -> None:
+        for cache in self._caches:
+            cache.put(key, retrieval)
+
+    def clear(self) -> None:
+        for cache in self._caches:
+            cache.clear()
+
+    def stats(self) -> Dict:
+        return {"tiers": [cache.stats() for cache in self._caches]}
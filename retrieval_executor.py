@@ -0,0 +1,268 @@
+"""
+Runs UnifiedRetriever methods off the server's event loop.
+
+Each retriever family (elasticsearch, blink, dpr, contriever) gets its own pool, configured
+by the executor_pools entry of .retriever_config.jsonnet, e.g.:
+
+    "executor_pools": {
+        "elasticsearch": {"type": "thread", "size": 16}, # I/O-bound, threads overlap the ES calls.
+        "dpr": {"type": "process", "size": 2}, # CPU-bound, each process loads its own encoder+index.
+    }
+
+Families that aren't configured get a single thread. Thread pools share the retriever of the
+server process, whereas every process of a process pool initializes its own UnifiedRetriever
+with only the retrievers that family needs.
+
+If a result_cache is given, it's looked up before anything is dispatched to the pools.
+
+Single retrievals of the dense retrievers (DPR, Contriever, BLINK) that arrive close together
+can be coalesced (see micro_batcher.py) and run as one batched retrieval, as their encoders and
+indices handle a batch of queries much faster than the same queries one by one. It's opted into
+per retriever family by the micro_batching entry, with DEFAULT_MICRO_BATCH_CONFIG for the window
+settings that aren't given, e.g.:
+
+    "micro_batching": {
+        "dpr": {"max_batch_size": 32, "max_wait_seconds": 0.002},
+        "contriever": {}, # i.e., the default window.
+    }
+
+The families that aren't listed run each single retrieval on its own.
+"""
+
+from typing import List, Dict, Tuple
+from collections import defaultdict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+import multiprocessing
+import inspect
+import asyncio
+import copy
+
+from unified_retriever import UnifiedRetriever
+from retrieval_cache import RetrievalCache, make_cache_key
+from micro_batcher import MicroBatcher
+from incremental_updates import get_update_log_directory, get_update_log_version
+
+
+RETRIEVAL_METHOD_TO_FAMILY = {
+    "retrieve_from_elasticsearch": "elasticsearch",
+    "retrieve_from_blink": "blink",
+    "retrieve_from_blink_and_elasticsearch": "blink",
+    "retrieve_from_dpr": "dpr",
+    "retrieve_from_contriever": "contriever",
+}
+
+# retrievers needed to serve each family's retrieval methods.
+FAMILY_TO_RETRIEVERS = {
+    "elasticsearch": ("elasticsearch",),
+    "blink": ("blink", "elasticsearch"),
+    "dpr": ("dpr",),
+    "contriever": ("contriever",),
+}
+
+DEFAULT_POOL_CONFIG = {"type": "thread", "size": 1}
+
+# retrieval methods whose single retrievals can be micro-batched, by family.
+MICRO_BATCHED_RETRIEVAL_METHODS = {
+    "dpr": ("retrieve_from_dpr",),
+    "contriever": ("retrieve_from_contriever",),
+    "blink": ("retrieve_from_blink", "retrieve_from_blink_and_elasticsearch"),
+}
+
+# window of the families listed in micro_batching, for the settings they don't give.
+DEFAULT_MICRO_BATCH_CONFIG = {"max_batch_size": 32, "max_wait_seconds": 0.002}
+
+
+def get_update_log_directories(retriever_init_args: Dict) -> Dict[str, str]:
+    # family -> the update log of its index (see incremental_updates.py), if it can have one.
+    init_args = inspect.signature(UnifiedRetriever).bind(**retriever_init_args)
+    init_args.apply_defaults()
+    init_args = init_args.arguments
+    update_log_directories = {}
+    for family in ("dpr", "contriever"):
+        if family not in init_args["initialize_retrievers"]:
+            continue
+        if family == "dpr" and init_args["dpr_faiss_index_type"] != "flat":
+            continue
+        dataset_name = init_args[f"{family}_dataset_name"]
+        corpus_name = "musique" if dataset_name == "musique_ans" else dataset_name
+        update_log_directories[family] = get_update_log_directory(family, corpus_name)
+    return update_log_directories
+
+
+_worker_retriever = None
+
+
+def _initialize_worker(retriever_init_args: Dict) -> None:
+    global _worker_retriever
+    _worker_retriever = UnifiedRetriever(**retriever_init_args)
+
+
+def _retrieve_in_worker(retrieval_method: str, arguments: Dict) -> List[Dict]:
+    return getattr(_worker_retriever, retrieval_method)(**arguments)
+
+
+def _retrieve_batch_in_worker(arguments_list: List[Dict]) -> List[List[Dict]]:
+    return _worker_retriever.retrieve_batch(arguments_list)
+
+
+class RetrievalExecutor:
+
+    def __init__(
+            self,
+            retriever_init_args: Dict,
+            executor_pools: Dict = None,
+            result_cache: RetrievalCache = None,
+            micro_batching: Dict = None,
+        ):
+        executor_pools = executor_pools or {}
+        micro_batching = micro_batching or {}
+        self.result_cache = result_cache
+        self._update_log_directories = get_update_log_directories(retriever_init_args)
+
+        initialize_retrievers = retriever_init_args.get(
+            "initialize_retrievers", ("blink", "elasticsearch", "dpr", "contriever")
+        )
+        for family, pool_config in executor_pools.items():
+            assert family in FAMILY_TO_RETRIEVERS, f"Unknown retriever family {family} in executor_pools."
+            assert pool_config.get("type", "thread") in ("thread", "process"), \
+                f"The executor pool type for {family} must be thread or process."
+        for family in micro_batching:
+            assert family in MICRO_BATCHED_RETRIEVAL_METHODS, f"Can't micro-batch retriever family {family}."
+
+        self._pools: Dict[str, Executor] = {}
+        self._pool_types: Dict[str, str] = {}
+        thread_retrievers = set()
+        for family in initialize_retrievers:
+            pool_config = {**DEFAULT_POOL_CONFIG, **executor_pools.get(family, {})}
+            family_retrievers = [
+                retriever_name for retriever_name in FAMILY_TO_RETRIEVERS[family]
+                if retriever_name in initialize_retrievers
+            ]
+            if pool_config["type"] == "thread":
+                thread_retrievers.update(family_retrievers)
+                self._pools[family] = ThreadPoolExecutor(
+                    max_workers=pool_config["size"], thread_name_prefix=f"{family}_retrieval"
+                )
+            else:
+                worker_init_args = copy.deepcopy(retriever_init_args)
+                worker_init_args["initialize_retrievers"] = family_retrievers
+                # spawn, not fork, as torch/faiss/ES client state doesn't survive a fork.
+                self._pools[family] = ProcessPoolExecutor(
+                    max_workers=pool_config["size"],
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_initialize_worker,
+                    initargs=(worker_init_args,),
+                )
+            self._pool_types[family] = pool_config["type"]
+
+        # The retrievers used by thread pools live in this (the server) process.
+        server_init_args = dict(retriever_init_args)
+        server_init_args["initialize_retrievers"] = [
+            retriever_name for retriever_name in initialize_retrievers if retriever_name in thread_retrievers
+        ]
+        self.retriever = UnifiedRetriever(**server_init_args)
+
+        self._micro_batchers: Dict[str, MicroBatcher] = {
+            family: MicroBatcher(
+                partial(self._run_batch_in_pool, family),
+                **{**DEFAULT_MICRO_BATCH_CONFIG, **micro_batching.get(family, {})}
+            )
+            for family in micro_batching if family in self._pools
+        }
+
+    def _make_cache_key(self, retrieval_method: str, arguments: Dict) -> Tuple:
+        # with the version of the family's update log, so that the cached retrievals (also the
+        # ones on disk, after a restart) from before an add or delete aren't served after it.
+        cache_key = make_cache_key(retrieval_method, arguments)
+        update_log_directory = self._update_log_directories.get(RETRIEVAL_METHOD_TO_FAMILY[retrieval_method])
+        if update_log_directory is not None:
+            cache_key += (("update_log_version", get_update_log_version(update_log_directory)),)
+        return cache_key
+
+    def _get_family(self, retrieval_method: str) -> str:
+        family = RETRIEVAL_METHOD_TO_FAMILY[retrieval_method]
+        if family not in self._pools:
+            raise Exception(f"The {family} retriever is not initialized.")
+        return family
+
+    def _is_awaitable(self, family: str, retrieval_method: str) -> bool:
+        # e.g., ES retrievals with elasticsearch_use_async=True are awaited on the event loop.
+        return self._pool_types[family] == "thread" and self.retriever.supports_async(retrieval_method)
+
+    async def retrieve(self, retrieval_method: str, arguments: Dict) -> List[Dict]:
+        if self.result_cache is not None:
+            cache_key = self._make_cache_key(retrieval_method, arguments)
+            retrieval = self.result_cache.get(cache_key)
+            if retrieval is not None:
+                return retrieval
+
+        family = self._get_family(retrieval_method)
+        if self._is_awaitable(family, retrieval_method):
+            retrieval = await getattr(self.retriever, "async_" + retrieval_method)(**arguments)
+        elif family in self._micro_batchers and retrieval_method in MICRO_BATCHED_RETRIEVAL_METHODS[family]:
+            retrieval = await self._micro_batchers[family].submit(
+                {"retrieval_method": retrieval_method, **arguments}
+            )
+        else:
+            if self._pool_types[family] == "thread":
+                function = partial(getattr(self.retriever, retrieval_method), **arguments)
+            else:
+                function = partial(_retrieve_in_worker, retrieval_method, arguments)
+            loop = asyncio.get_running_loop()
+            retrieval = await loop.run_in_executor(self._pools[family], function)
+
+        if self.result_cache is not None:
+            self.result_cache.put(cache_key, retrieval)
+        return retrieval
+
+    async def retrieve_batch(self, arguments_list: List[Dict]) -> List[List[Dict]]:
+        """
+        Splits the batch by retriever family, runs each family's part as one
+        UnifiedRetriever.retrieve_batch call in its pool, and gathers them concurrently.
+        Only the cache misses are dispatched.
+        """
+        retrievals = [None] * len(arguments_list)
+        cache_keys = [None] * len(arguments_list)
+        family_to_indices = defaultdict(list)
+        for index, arguments in enumerate(arguments_list):
+            if self.result_cache is not None:
+                arguments_ = {key: value for key, value in arguments.items() if key != "retrieval_method"}
+                cache_keys[index] = self._make_cache_key(arguments["retrieval_method"], arguments_)
+                retrievals[index] = self.result_cache.get(cache_keys[index])
+                if retrievals[index] is not None:
+                    continue
+            family_to_indices[self._get_family(arguments["retrieval_method"])].append(index)
+
+        futures = []
+        for family, indices in family_to_indices.items():
+            family_arguments_list = [arguments_list[index] for index in indices]
+            retrieval_methods = {arguments["retrieval_method"] for arguments in family_arguments_list}
+            if len(retrieval_methods) == 1 and self._is_awaitable(family, next(iter(retrieval_methods))):
+                async_batch_method = getattr(self.retriever, "async_" + retrieval_methods.pop() + "_batch")
+                futures.append(async_batch_method([
+                    {key: value for key, value in arguments.items() if key != "retrieval_method"}
+                    for arguments in family_arguments_list
+                ]))
+                continue
+            futures.append(self._run_batch_in_pool(family, family_arguments_list))
+
+        family_retrievals = await asyncio.gather(*futures)
+        for indices, retrievals_ in zip(family_to_indices.values(), family_retrievals):
+            for index, retrieval in zip(indices, retrievals_):
+                retrievals[index] = retrieval
+                if self.result_cache is not None:
+                    self.result_cache.put(cache_keys[index], retrieval)
+        return retrievals
+
+    async def _run_batch_in_pool(self, family: str, arguments_list: List[Dict]) -> List[List[Dict]]:
+        if self._pool_types[family] == "thread":
+            function = partial(self.retriever.retrieve_batch, arguments_list)
+        else:
+            function = partial(_retrieve_batch_in_worker, arguments_list)
+        return await asyncio.get_running_loop().run_in_executor(self._pools[family], function)
+
+    async def shutdown(self) -> None:
+        for pool in self._pools.values():
+            pool.shutdown(wait=False)
+        await self.retriever.async_close()
@@ -1,41 +1,93 @@
 import json
 import _jsonnet
+from typing import List, Dict
 from time import perf_counter
 from fastapi import FastAPI, Request
 
-from unified_retriever import UnifiedRetriever
+from retrieval_executor import RetrievalExecutor
+from retrieval_cache import RetrievalCache, DiskRetrievalCache, TieredRetrievalCache
 
 retriever_init_args = json.loads(
     _jsonnet.evaluate_file(".retriever_config.jsonnet")
 )
-retriever = UnifiedRetriever(**retriever_init_args)
+# Pool and cache settings are for the server, not UnifiedRetriever.
+# See retrieval_executor.py, retrieval_cache.py and micro_batcher.py
+executor_pools = retriever_init_args.pop("executor_pools", {})
+micro_batching = retriever_init_args.pop("micro_batching", {})
+result_cache_args = retriever_init_args.pop("result_cache", None)
+disk_cache_args = retriever_init_args.pop("disk_cache", None)
+result_caches = []
+if result_cache_args is not None:
+    result_caches.append(RetrievalCache(**result_cache_args))
+if disk_cache_args is not None:
+    result_caches.append(DiskRetrievalCache(retriever_init_args=retriever_init_args, **disk_cache_args))
+result_cache = None
+if len(result_caches) == 1:
+    result_cache = result_caches[0]
+elif len(result_caches) > 1:
+    result_cache = TieredRetrievalCache(result_caches)
+retrieval_executor = RetrievalExecutor(retriever_init_args, executor_pools, result_cache, micro_batching)
+
+RETRIEVAL_METHODS = (
+    "retrieve_from_elasticsearch",
+    "retrieve_from_blink",
+    "retrieve_from_blink_and_elasticsearch",
+    "retrieve_from_dpr",
+    "retrieve_from_contriever"
+)
 
 app = FastAPI()
 
+
+def add_default_corpus_name(retrieval: List[Dict]) -> List[Dict]:
+    for retrieval_ in retrieval:
+        if "corpus_name" not in retrieval_:
+            retrieval_["corpus_name"] = retriever_init_args["dataset_name"]
+    return retrieval
+
+
+@app.on_event("shutdown")
+async def shutdown_retrieval_executor():
+    await retrieval_executor.shutdown()
+
 @app.get("/")
 async def index():
     return {"message": f"Hello! This is a retriever server."}
 
+@app.get("/cache_stats/")
+async def cache_stats():
+    if result_cache is None:
+        return {"message": "The result cache is not enabled."}
+    return result_cache.stats()
+
 @app.post("/retrieve/")
 async def retrieve(
         arguments: Request # see the corresponding method in unified_retriever.py
     ):
         arguments = await arguments.json()
         retrieval_method = arguments.pop("retrieval_method")
-        assert retrieval_method in (
-            "retrieve_from_elasticsearch",
-            "retrieve_from_blink",
-            "retrieve_from_blink_and_elasticsearch",
-            "retrieve_from_dpr",
-            "retrieve_from_contriever"
-        )
+        assert retrieval_method in RETRIEVAL_METHODS
         start_time = perf_counter()
-        retrieval = getattr(retriever, retrieval_method)(**arguments)
+        retrieval = await retrieval_executor.retrieve(retrieval_method, arguments)
 
-        for retrieval_ in retrieval:
-            if "corpus_name" not in retrieval_:
-                retrieval_["corpus_name"] = retriever_init_args["dataset_name"]
+        retrieval = add_default_corpus_name(retrieval)
 
         end_time = perf_counter()
         time_in_seconds = round(end_time - start_time, 1)
         return {"retrieval": retrieval, "time_in_seconds": time_in_seconds}
+
+@app.post("/retrieve_batch/")
+async def retrieve_batch(
+        arguments_list: Request # list of /retrieve/ arguments, retrieval_methods can be mixed.
+    ):
+        arguments_list = await arguments_list.json()
+        for arguments in arguments_list:
+            assert arguments["retrieval_method"] in RETRIEVAL_METHODS
+        start_time = perf_counter()
+        retrievals = await retrieval_executor.retrieve_batch(arguments_list)
+
+        retrievals = [add_default_corpus_name(retrieval) for retrieval in retrievals]
+
+        end_time = perf_counter()
+        time_in_seconds = round(end_time - start_time, 1)
+        return {"retrievals": retrievals, "time_in_seconds": time_in_seconds}
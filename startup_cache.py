@@ -0,0 +1,154 @@
+"""
+Manifest of the source files (e.g., paragraphs.tsv, index.faiss) that derived startup
+structures (e.g., id maps saved as .npy) were built from, to tell whether they can be reused.
+
+Files are fingerprinted by size, mtime and content hash. The hash is only recomputed when the
+size or mtime changed, so checking an unchanged multi-GB file is instant, and a file that was
+only touched (same content) doesn't invalidate the cache.
+
+Concurrently starting processes (e.g., uvicorn workers) rebuild an invalid cache only once:
+it's built into a temporary directory under a file lock, and renamed into place.
+"""
+
+from typing import Dict, Optional, Callable
+from contextlib import contextmanager
+import tempfile
+import hashlib
+import shutil
+import fcntl
+import json
+import os
+
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def hash_file(filepath: str, chunk_size: int = 2**20) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+@contextmanager
+def file_lock(lock_path: str, blocking: bool = True):
+    # exclusive (advisory) lock across processes, released when the block exits (or the process dies).
+    # Yields whether it's taken, which it's always unless not blocking and another process has it.
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    with open(lock_path, "a") as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def replace_directory(new_directory: str, directory: str) -> None:
+    # directories can't be replaced atomically, so the old one is moved away first.
+    old_directory = directory + ".old"
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(directory):
+        os.rename(directory, old_directory)
+    os.rename(new_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def get_file_fingerprint(filepath: str, previous_fingerprint: Optional[Dict] = None) -> Dict:
+    stat = os.stat(filepath)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if (
+        previous_fingerprint is not None
+        and previous_fingerprint["size"] == fingerprint["size"]
+        and previous_fingerprint["mtime"] == fingerprint["mtime"]
+    ):
+        fingerprint["hash"] = previous_fingerprint["hash"]
+    else:
+        fingerprint["hash"] = hash_file(filepath)
+    return fingerprint
+
+
+class StartupCache:
+    """
+    A directory of derived structures and the manifest of the source_paths (name -> path)
+    they were built from, plus any metadata saved with them.
+    """
+
+    def __init__(self, directory: str, source_paths: Dict[str, str]):
+        self.directory = directory
+        self._source_paths = source_paths
+        self._read_manifest()
+
+    def _read_manifest(self) -> None:
+        self._manifest = None
+        manifest_path = os.path.join(self.directory, MANIFEST_FILE_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                self._manifest = json.load(file)
+        self._fingerprints = None
+
+    def _get_fingerprints(self) -> Dict:
+        if self._fingerprints is None:
+            previous_fingerprints = (self._manifest or {}).get("sources", {})
+            self._fingerprints = {
+                name: get_file_fingerprint(path, previous_fingerprints.get(name))
+                for name, path in self._source_paths.items()
+            }
+        return self._fingerprints
+
+    def is_valid(self) -> bool:
+        if self._manifest is None or set(self._manifest["sources"]) != set(self._source_paths):
+            return False
+        return all(
+            fingerprint["hash"] == self._manifest["sources"][name]["hash"]
+            for name, fingerprint in self._get_fingerprints().items()
+        )
+
+    def get(self, key: str):
+        return self._manifest["metadata"][key]
+
+    def save(self, metadata: Dict = None) -> None:
+        self._fingerprints = None # the sources may have been updated since they were checked.
+        self._write_manifest(self.directory, metadata)
+
+    def _write_manifest(self, directory: str, metadata: Dict = None) -> None:
+        # written last (and atomically), so a manifest always describes complete structures.
+        self._manifest = {"sources": self._get_fingerprints(), "metadata": metadata or {}}
+        manifest_path = os.path.join(directory, MANIFEST_FILE_NAME)
+        os.makedirs(directory, exist_ok=True)
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump(self._manifest, file, indent=4)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def rebuild(self, build: Callable[[str], Dict]) -> None:
+        """
+        Rebuilds the cache with build(directory), which writes the structures to the (empty)
+        directory and returns the metadata to save with them, unless another process has
+        rebuilt it (from the same sources) while this one waited for the lock.
+        """
+        with file_lock(self.directory + ".lock"):
+            self._read_manifest()
+            if self.is_valid():
+                return
+            parent_directory = os.path.dirname(os.path.abspath(self.directory))
+            os.makedirs(parent_directory, exist_ok=True)
+            temporary_directory = tempfile.mkdtemp(
+                prefix=os.path.basename(self.directory) + ".building.", dir=parent_directory
+            )
+            try:
+                metadata = build(temporary_directory)
+                self._fingerprints = None
+                self._write_manifest(temporary_directory, metadata)
+                replace_directory(temporary_directory, self.directory)
+            finally:
+                shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    def invalidate(self) -> None:
+        manifest_path = os.path.join(self.directory, MANIFEST_FILE_NAME)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        self._manifest = None
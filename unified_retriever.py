@@ -1,4 +1,6 @@
 from typing import List, Dict, Tuple
+from collections import defaultdict
+import inspect
 
 
 class UnifiedRetriever:
@@ -35,18 +37,35 @@ class UnifiedRetriever:
         elasticsearch_dataset_name: str = "auto",
         elasticsearch_host: str = "http://localhost/",
         elasticsearch_port: int = 9200,
+        elasticsearch_connections_per_node: int = 10,
+        elasticsearch_request_timeout: float = 30,
+        elasticsearch_keep_alive_timeout: float = 15,
+        elasticsearch_use_async: bool = False,
         # Blink init args:
         blink_models_path: str = None,
         blink_faiss_index_type: str = "flat", # "flat" or "hnsw",
         blink_fast: bool = False,
         blink_top_k: int = 1,
+        blink_mmap_index: bool = False, # memory-map the faiss index (shared by workers, faster startup)
         # DPR init args:
         dpr_dataset_name: str = "hotpotqa",
-        dpr_faiss_index_type: str = "flat", # "flat" or "hnsw",
+        dpr_faiss_index_type: str = "flat", # "flat", "hnsw", "ivf_flat", "ivf_pq" or "sq8"
+        dpr_nprobe: int = None, # default nprobe for ivf_* index types
+        dpr_ef_search: int = None, # default efSearch for hnsw index type
+        dpr_mmap_index: bool = False, # memory-map the faiss index (shared by workers, faster startup)
         dpr_query_model_path: str = "facebook/dpr-question_encoder-multiset-base",
         dpr_device: str = "cpu",
+        dpr_encoder_backend: str = "torch", # "torch", "int8" or "onnx" (cpu only), see query_encoders.py
+        dpr_query_embedding_cache_size_mb: float = 64, # 0 to turn off.
         # Contriever init args:
         contriever_dataset_name: str = "hotpotqa",
+        contriever_mmap_index: bool = False, # memory-map the faiss index (shared by workers, faster startup)
+        contriever_encoder_backend: str = "torch", # "torch", "int8" or "onnx" (cpu only)
+        contriever_device: str = None, # default: cuda for the torch encoder backend, cpu for the others.
+        contriever_num_threads: int = None, # cpu threads of the query encoder.
+        contriever_query_embedding_cache_size_mb: float = 64, # 0 to turn off.
+        # float32 or float16 (half the memory) vectors in the above query embedding caches.
+        query_embedding_cache_dtype: str = "float32",
         # what to initialize:
         initialize_retrievers: Tuple[str, str] = ("blink", "elasticsearch", "dpr", "contriever"),
     ):
@@ -69,6 +88,10 @@ class UnifiedRetriever:
                 corpus_name=elasticsearch_corpus_name,
                 elasticsearch_host=elasticsearch_host,
                 elasticsearch_port=elasticsearch_port,
+                connections_per_node=elasticsearch_connections_per_node,
+                request_timeout=elasticsearch_request_timeout,
+                keep_alive_timeout=elasticsearch_keep_alive_timeout,
+                use_async=elasticsearch_use_async,
             )
 
         self._blink_retriever = None
@@ -80,7 +103,8 @@ class UnifiedRetriever:
                 blink_models_path=blink_models_path,
                 faiss_index=blink_faiss_index_type,
                 fast=blink_fast,
-                top_k=blink_top_k
+                top_k=blink_top_k,
+                mmap_index=blink_mmap_index,
             )
 
         self._dpr_retriever = None
@@ -89,14 +113,28 @@ class UnifiedRetriever:
             self._dpr_retriever = DprRetriever(
                 corpus_name=dpr_corpus_name,
                 index_type=dpr_faiss_index_type,
+                nprobe=dpr_nprobe,
+                ef_search=dpr_ef_search,
+                mmap_index=dpr_mmap_index,
                 hf_query_model_name_or_path=dpr_query_model_path,
                 device=dpr_device,
+                encoder_backend=dpr_encoder_backend,
+                query_embedding_cache_size_mb=dpr_query_embedding_cache_size_mb,
+                query_embedding_cache_dtype=query_embedding_cache_dtype,
             )
 
         self._contriever_retriever = None
         if "contriever" in initialize_retrievers:
             from contriever_retriever import ContrieverRetriever
-            self._contriever_retriever = ContrieverRetriever(corpus_name=contriever_corpus_name)
+            self._contriever_retriever = ContrieverRetriever(
+                corpus_name=contriever_corpus_name,
+                encoder_backend=contriever_encoder_backend,
+                device=contriever_device,
+                num_threads=contriever_num_threads,
+                mmap_index=contriever_mmap_index,
+                query_embedding_cache_size_mb=contriever_query_embedding_cache_size_mb,
+                query_embedding_cache_dtype=query_embedding_cache_dtype,
+            )
 
 
     def retrieve_from_elasticsearch(
@@ -109,11 +147,72 @@ class UnifiedRetriever:
             allowed_paragraph_types: List[str] = None,
             paragraph_index: int = None,
             corpus_name: str = None,
+            fields: List[str] = None,
         ) -> List[Dict]:
         """
         Option 1: retrieve_from_elasticsearch
             Given some query text,
             1. Directly retrieve from elasticsearch (could be querying titles or paragraph_texts)
+
+        fields, if given, limits the records in each result to these (and score), e.g.,
+        ["title", "paragraph_text"], so that the rest aren't fetched from ES at all.
+        """
+
+        method_name, method_kwargs = self._make_elasticsearch_call(
+            query_text=query_text, max_hits_count=max_hits_count, max_buffer_count=max_buffer_count,
+            document_type=document_type, allowed_titles=allowed_titles,
+            allowed_paragraph_types=allowed_paragraph_types, paragraph_index=paragraph_index,
+            corpus_name=corpus_name, fields=fields,
+        )
+        paragraphs_results = getattr(self._elasticsearch_retriever, method_name)(**method_kwargs)
+        return paragraphs_results
+
+
+    async def async_retrieve_from_elasticsearch(self, **arguments) -> List[Dict]:
+        """
+        Same as retrieve_from_elasticsearch, but awaits the async ES client (elasticsearch_use_async=True).
+        """
+        method_name, method_kwargs = self._make_elasticsearch_call(**arguments)
+        return await getattr(self._elasticsearch_retriever, "async_" + method_name)(**method_kwargs)
+
+
+    async def async_retrieve_from_elasticsearch_batch(self, arguments_list: List[Dict]) -> List[List[Dict]]:
+        calls = [self._make_elasticsearch_call(**arguments) for arguments in arguments_list]
+        return await self._elasticsearch_retriever.async_multi_retrieve(calls)
+
+
+    def supports_async(self, retrieval_method: str) -> bool:
+        """
+        Whether retrieval_method has an async_ version that can be awaited on the event loop.
+        """
+        return (
+            retrieval_method == "retrieve_from_elasticsearch"
+            and self._elasticsearch_retriever is not None
+            and self._elasticsearch_retriever.is_async
+        )
+
+
+    async def async_close(self) -> None:
+        if self._elasticsearch_retriever is not None:
+            await self._elasticsearch_retriever.async_close()
+
+
+    def _make_elasticsearch_call(
+            self,
+            query_text: str,
+            max_hits_count: int = 3,
+            max_buffer_count: int = 100,
+            document_type: str = "paragraph_text",
+            allowed_titles: List[str] = None,
+            allowed_paragraph_types: List[str] = None,
+            paragraph_index: int = None,
+            corpus_name: str = None,
+            fields: List[str] = None,
+        ) -> Tuple[str, Dict]:
+        """
+        Maps the arguments of retrieve_from_elasticsearch to the ElasticsearchRetriever
+        method name and its keyword arguments, so the same call can be run directly or
+        as part of a multi-search.
         """
 
         # NOTE: Don't use title_section_path_paragraph_text for natcq. For some reason three should clauses
@@ -137,48 +236,49 @@ class UnifiedRetriever:
 
         if document_type == "paragraph_text":
             is_abstract = True if self._limit_to_abstracts else None # Note "None" and not False
-            paragraphs_results = self._elasticsearch_retriever.retrieve_paragraphs(
-                query_text, is_abstract=is_abstract, max_hits_count=max_hits_count,
+            return "retrieve_paragraphs", dict(
+                query_text=query_text, is_abstract=is_abstract, max_hits_count=max_hits_count,
                 allowed_titles=allowed_titles, allowed_paragraph_types=allowed_paragraph_types,
-                paragraph_index=paragraph_index, corpus_name=corpus_name, max_buffer_count=max_buffer_count
+                paragraph_index=paragraph_index, corpus_name=corpus_name, max_buffer_count=max_buffer_count,
+                fields=fields
             )
         elif document_type == "title_paragraph_text":
             is_abstract = True if self._limit_to_abstracts else None # Note "None" and not False
             # assert allowed_titles is None
-            paragraphs_results = self._elasticsearch_retriever.retrieve_paragraphs(
-                query_text, is_abstract=is_abstract, max_hits_count=max_hits_count,
+            return "retrieve_paragraphs", dict(
+                query_text=query_text, is_abstract=is_abstract, max_hits_count=max_hits_count,
                 allowed_titles=allowed_titles, allowed_paragraph_types=allowed_paragraph_types,
                 paragraph_index=paragraph_index, corpus_name=corpus_name, query_title_field_too=True,
-                max_buffer_count=max_buffer_count
+                max_buffer_count=max_buffer_count, fields=fields
             )
         elif document_type == "section_path_paragraph_text":
             is_abstract = True if self._limit_to_abstracts else None # Note "None" and not False
             # assert allowed_titles is None
-            paragraphs_results = self._elasticsearch_retriever.retrieve_paragraphs(
-                query_text, is_abstract=is_abstract, max_hits_count=max_hits_count,
+            return "retrieve_paragraphs", dict(
+                query_text=query_text, is_abstract=is_abstract, max_hits_count=max_hits_count,
                 allowed_titles=allowed_titles, allowed_paragraph_types=allowed_paragraph_types,
                 paragraph_index=paragraph_index, corpus_name=corpus_name, query_title_field_too=False,
-                query_section_path_field_too=True, max_buffer_count=max_buffer_count
+                query_section_path_field_too=True, max_buffer_count=max_buffer_count, fields=fields
             )
         elif document_type == "title_section_path_paragraph_text":
             is_abstract = True if self._limit_to_abstracts else None # Note "None" and not False
             # assert allowed_titles is None
-            paragraphs_results = self._elasticsearch_retriever.retrieve_paragraphs(
-                query_text, is_abstract=is_abstract, max_hits_count=max_hits_count,
+            return "retrieve_paragraphs", dict(
+                query_text=query_text, is_abstract=is_abstract, max_hits_count=max_hits_count,
                 allowed_titles=allowed_titles, allowed_paragraph_types=allowed_paragraph_types,
                 paragraph_index=paragraph_index, corpus_name=corpus_name, query_title_field_too=True,
-                query_section_path_field_too=True, max_buffer_count=max_buffer_count
+                query_section_path_field_too=True, max_buffer_count=max_buffer_count, fields=fields
             )
         elif document_type == "title":
-            paragraphs_results = self._elasticsearch_retriever.retrieve_titles(
-                query_text, max_hits_count=max_hits_count, corpus_name=corpus_name
+            return "retrieve_titles", dict(
+                query_text=query_text, max_hits_count=max_hits_count, corpus_name=corpus_name,
+                fields=fields
             )
         elif document_type == "id":
             assert max_hits_count == 1
-            paragraphs_results = self._elasticsearch_retriever.retrieve_by_id(
-                query_text, corpus_name=corpus_name
+            return "retrieve_by_id", dict(
+                query_id=query_text, corpus_name=corpus_name, fields=fields
             )
-        return paragraphs_results
 
 
     def retrieve_from_blink(
@@ -196,7 +296,10 @@ class UnifiedRetriever:
             raise Exception("BLINK retriever not initialized.")
 
         blink_titles_results = self._blink_retriever.retrieve_paragraphs(query_text)
+        return self._make_blink_results(blink_titles_results, max_hits_count)
+
 
+    def _make_blink_results(self, blink_titles_results: List[Dict], max_hits_count: int) -> List[Dict]:
         results = [
             {"title": result["title"], "paragraph_text": result["text"]}
             for result in blink_titles_results
@@ -233,6 +336,17 @@ class UnifiedRetriever:
             raise Exception("BLINK retriever not initialized.")
 
         blink_titles_results = self._blink_retriever.retrieve_paragraphs(query_text)
+        blink_titles = self._get_blink_titles(blink_titles_results, skip_blink_titles)
+
+        # All the blink titles are mapped to corpus titles in a single ES multi-search.
+        blink_titles_retrievals = self._elasticsearch_retriever.retrieve_titles_batch(
+            query_texts=blink_titles, max_hits_count=max_hits_count,
+            corpus_name=corpus_name
+        )
+        return self._make_blink_and_elasticsearch_results(blink_titles_retrievals)
+
+
+    def _get_blink_titles(self, blink_titles_results: List[Dict], skip_blink_titles: List = None) -> List[str]:
         blink_titles = {result["title"] for result in blink_titles_results}
 
         skip_blink_titles = skip_blink_titles or []
@@ -240,14 +354,13 @@ class UnifiedRetriever:
             blink_title for blink_title in blink_titles
             if blink_title not in skip_blink_titles
         }
+        return list(blink_titles)
+
 
+    def _make_blink_and_elasticsearch_results(self, blink_titles_retrievals: List[List[Dict]]) -> List[Dict]:
         results = []
         selected_titles = set()
-        for blink_title in blink_titles:
-            retrievals = self._elasticsearch_retriever.retrieve_titles(
-                query_text=blink_title, max_hits_count=max_hits_count,
-                corpus_name=corpus_name
-            )
+        for retrievals in blink_titles_retrievals:
 
             for retrieval in retrievals:
 
@@ -265,14 +378,23 @@ class UnifiedRetriever:
             self,
             query_text: str,
             max_hits_count: int = 3,
+            nprobe: int = None,
+            ef_search: int = None,
+            allowed_titles: List[str] = None,
         ) -> List[Dict]:
         """
         Option 5: retrieve_from_dpr
+            nprobe (for ivf_* dpr_faiss_index_type) and ef_search (for hnsw) override the
+            index defaults for this retrieval: higher is better recall but slower.
+            allowed_titles (needs the dpr docstore) restricts the search to their paragraphs.
         """
         if self._dpr_retriever is None:
             raise Exception("DPR retriever not initialized.")
 
-        results = self._dpr_retriever.retrieve_paragraphs(query_text=query_text, max_hits_count=max_hits_count)
+        results = self._dpr_retriever.retrieve_paragraphs(
+            query_text=query_text, max_hits_count=max_hits_count, nprobe=nprobe, ef_search=ef_search,
+            allowed_titles=allowed_titles,
+        )
         return results
 
     def retrieve_from_contriever(
@@ -292,3 +414,158 @@ class UnifiedRetriever:
             max_hits_count=max_hits_count, allowed_titles=allowed_titles
         )
         return results
+
+
+    def retrieve_batch(self, arguments_list: List[Dict]) -> List[List[Dict]]:
+        """
+        Runs many retrievals (possibly of different retrieval_methods) together. Each item in
+        arguments_list is the arguments dict of one retrieval, including its retrieval_method.
+        Retrievals are grouped by retrieval_method and each group is run through the batched
+        version of the method if it exists (e.g., retrieve_from_elasticsearch_batch), otherwise
+        one by one. The retrievals are returned in the same order as arguments_list.
+        """
+        retrieval_method_to_indices = defaultdict(list)
+        for index, arguments in enumerate(arguments_list):
+            retrieval_method_to_indices[arguments["retrieval_method"]].append(index)
+
+        retrievals = [None] * len(arguments_list)
+        for retrieval_method, indices in retrieval_method_to_indices.items():
+            group_arguments_list = [
+                {key: value for key, value in arguments_list[index].items() if key != "retrieval_method"}
+                for index in indices
+            ]
+            # the batch methods only read the arguments they know of, so unsupported (or missing)
+            # ones are rejected here just like the single retrieval method would.
+            signature = inspect.signature(getattr(self, retrieval_method))
+            for arguments in group_arguments_list:
+                try:
+                    signature.bind(**arguments)
+                except TypeError as error:
+                    raise TypeError(f"Invalid arguments for {retrieval_method}: {error}") from error
+            batch_method = getattr(self, retrieval_method + "_batch", None)
+            if batch_method is not None:
+                group_retrievals = batch_method(group_arguments_list)
+            else:
+                group_retrievals = [
+                    getattr(self, retrieval_method)(**arguments) for arguments in group_arguments_list
+                ]
+            for index, retrieval in zip(indices, group_retrievals):
+                retrievals[index] = retrieval
+
+        return retrievals
+
+
+    def retrieve_from_elasticsearch_batch(self, arguments_list: List[Dict]) -> List[List[Dict]]:
+        """
+        Batched retrieve_from_elasticsearch: all retrievals go in a single ES multi-search.
+        """
+        calls = [self._make_elasticsearch_call(**arguments) for arguments in arguments_list]
+        return self._elasticsearch_retriever.multi_retrieve(calls)
+
+
+    def retrieve_from_dpr_batch(self, arguments_list: List[Dict]) -> List[List[Dict]]:
+        """
+        Batched retrieve_from_dpr: all queries (with the same nprobe/ef_search and max_hits_count)
+        are encoded and searched in the faiss index together.
+        """
+        if self._dpr_retriever is None:
+            raise Exception("DPR retriever not initialized.")
+
+        # grouped by max_hits_count too, as the top k of an approximate (e.g., hnsw or ivf) search
+        # for more hits isn't always the same as the search for k hits.
+        search_parameters_to_indices = defaultdict(list)
+        for index, arguments in enumerate(arguments_list):
+            search_parameters = (
+                arguments.get("nprobe"), arguments.get("ef_search"), arguments.get("max_hits_count", 3)
+            )
+            search_parameters_to_indices[search_parameters].append(index)
+
+        retrievals = [None] * len(arguments_list)
+        for (nprobe, ef_search, max_hits_count), indices in search_parameters_to_indices.items():
+            batch_results = self._dpr_retriever.retrieve_paragraphs_batch(
+                query_texts=[arguments_list[index]["query_text"] for index in indices],
+                max_hits_count=max_hits_count, nprobe=nprobe, ef_search=ef_search,
+                allowed_titles_list=[arguments_list[index].get("allowed_titles") for index in indices],
+            )
+            for index, results in zip(indices, batch_results):
+                retrievals[index] = results
+        return retrievals
+
+
+    def retrieve_from_contriever_batch(self, arguments_list: List[Dict]) -> List[List[Dict]]:
+        """
+        Batched retrieve_from_contriever: for each corpus_name, all queries are embedded together,
+        and the queries without allowed_titles are searched in the faiss index together.
+        """
+        if self._contriever_retriever is None:
+            raise Exception("Contriever retriever not initialized.")
+
+        corpus_name_to_indices = defaultdict(list)
+        for index, arguments in enumerate(arguments_list):
+            corpus_name_to_indices[arguments.get("corpus_name", "original")].append(index)
+
+        retrievals = [None] * len(arguments_list)
+        for corpus_name, indices in corpus_name_to_indices.items():
+            group_arguments_list = [arguments_list[index] for index in indices]
+            group_retrievals = self._contriever_retriever.retrieve_paragraphs_batch(
+                query_texts=[arguments["query_text"] for arguments in group_arguments_list],
+                corpus_name=corpus_name,
+                max_hits_counts=[arguments.get("max_hits_count", 3) for arguments in group_arguments_list],
+                allowed_titles_list=[arguments.get("allowed_titles") for arguments in group_arguments_list],
+            )
+            for index, retrieval in zip(indices, group_retrievals):
+                retrievals[index] = retrieval
+        return retrievals
+
+
+    def retrieve_from_blink_batch(self, arguments_list: List[Dict]) -> List[List[Dict]]:
+        """
+        Batched retrieve_from_blink: the biencoder (and crossencoder) run on all queries together.
+        """
+        if self._blink_retriever is None:
+            raise Exception("BLINK retriever not initialized.")
+
+        batch_blink_titles_results = self._blink_retriever.retrieve_paragraphs_batch(
+            [arguments["query_text"] for arguments in arguments_list]
+        )
+        return [
+            self._make_blink_results(blink_titles_results, arguments.get("max_hits_count", 3))
+            for blink_titles_results, arguments in zip(batch_blink_titles_results, arguments_list)
+        ]
+
+
+    def retrieve_from_blink_and_elasticsearch_batch(self, arguments_list: List[Dict]) -> List[List[Dict]]:
+        """
+        Batched retrieve_from_blink_and_elasticsearch: BLINK runs on all queries together, and the
+        blink titles of all queries are mapped to corpus titles in a single ES multi-search.
+        """
+        if self._elasticsearch_retriever is None:
+            raise Exception("Elasticsearch retriever not initialized.")
+
+        if self._blink_retriever is None:
+            raise Exception("BLINK retriever not initialized.")
+
+        batch_blink_titles_results = self._blink_retriever.retrieve_paragraphs_batch(
+            [arguments["query_text"] for arguments in arguments_list]
+        )
+        batch_blink_titles = [
+            self._get_blink_titles(blink_titles_results, arguments.get("skip_blink_titles"))
+            for blink_titles_results, arguments in zip(batch_blink_titles_results, arguments_list)
+        ]
+        calls = [
+            ("retrieve_titles", {
+                "query_text": blink_title, "max_hits_count": arguments.get("max_hits_count", 3),
+                "corpus_name": arguments.get("corpus_name")
+            })
+            for blink_titles, arguments in zip(batch_blink_titles, arguments_list)
+            for blink_title in blink_titles
+        ]
+        all_blink_titles_retrievals = self._elasticsearch_retriever.multi_retrieve(calls)
+
+        results = []
+        start = 0
+        for blink_titles in batch_blink_titles:
+            blink_titles_retrievals = all_blink_titles_retrievals[start:start + len(blink_titles)]
+            results.append(self._make_blink_and_elasticsearch_results(blink_titles_retrievals))
+            start += len(blink_titles)
+        return results
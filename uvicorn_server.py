@@ -14,6 +14,10 @@ def main():
         choices=("start", "stop", "status", "log")
     )
     parser.add_argument("--port", "-p", type=int, help="port number", default=8000)
+    parser.add_argument(
+        "--workers", "-w", type=int, default=1,
+        help="number of uvicorn worker processes (use *_mmap_index to share the faiss indices among them)"
+    )
     args = parser.parse_args()
 
     pid_path = os.path.expanduser(f"~/.uv_{args.port}.pid")
@@ -28,7 +32,10 @@ def main():
         if os.path.exists(pid_path):
             exit(f"uvicorn pid file ({pid_path}) aleady exists. Turn off uvicorn first.")
 
-        command = f"nohup uvicorn retriever_server:app --port {args.port} > {log_path} 2>&1 & \necho $! > {pid_path}"
+        command = (
+            f"nohup uvicorn retriever_server:app --port {args.port} --workers {args.workers} "
+            f"> {log_path} 2>&1 & \necho $! > {pid_path}"
+        )
         subprocess.Popen(command, shell=True)
 
         time.sleep(1)